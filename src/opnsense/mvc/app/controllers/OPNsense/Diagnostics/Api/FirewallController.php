@@ -60,9 +60,14 @@ class FirewallController extends ApiControllerBase
 
     public function streamLogAction()
     {
+        /* optional server side filters and batching, see read_log.py */
+        $params = [];
+        foreach (['batch', 'interface', 'action', 'src', 'dst', 'port', 'rid'] as $key) {
+            $params[] = empty($this->request->get($key)) ? "" : $this->request->get($key);
+        }
         return $this->configdStream(
-            'filter stream log',
-            [],
+            count(array_filter($params)) > 0 ? 'filter stream log_filter' : 'filter stream log',
+            count(array_filter($params)) > 0 ? $params : [],
             [
                 'Content-Type: text/event-stream',
                 'Cache-Control: no-cache'
@@ -27,7 +27,7 @@
 
     --------------------------------------------------------------------------------------
     download maxmind GeoLite2 Free database into easy to use alias files [<COUNTRY>-<PROTO>] located
-    in /usr/local/share/GeoIP/alias
+    in /usr/local/share/GeoIP/alias and a binary (memory mapped) index in /usr/local/share/GeoIP/alias.idx
 """
 from lib.alias.geoip import GEOIP
 
@@ -28,7 +28,7 @@
 import argparse
 import ujson
 import subprocess
-from lib.states import query_states
+from lib.states import iter_states
 
 
 if __name__ == '__main__':
@@ -41,8 +41,8 @@ if __name__ == '__main__':
 
     # collect all unique state id's
     commands = dict()
-    for record in query_states(rule_label=inputargs.label, filter_str=inputargs.filter):
-        commands[record['id']] = "/sbin/pfctl -k id -k %s" % record['id']
+    for record in iter_states(rule_label=inputargs.label, filter_str=inputargs.filter):
+        commands[record.id] = "/sbin/pfctl -k id -k %s" % record.id
 
     # drop list of states in chunks
     chunk_size = 500
@@ -30,6 +30,7 @@
 """
 import subprocess
 import os
+import glob
 import sys
 import ujson
 
@@ -41,9 +42,12 @@ if __name__ == '__main__':
     # only try to remove alias if it exists
     if len(sys.argv) > 1 and sys.argv[1] in tables:
         # cleanup related alias file
-        for suffix in  ['txt', 'md5.txt', 'self.txt']:
+        for suffix in  ['txt', 'md5.txt', 'self.txt', 'http.txt']:
             if os.path.isfile('/var/db/aliastables/%s.%s' % (sys.argv[1], suffix)):
                 os.remove('/var/db/aliastables/%s.%s' % (sys.argv[1], suffix))
+        # cached url contents
+        for filename in glob.glob('/var/db/aliastables/%s.*.url.txt' % sys.argv[1]):
+            os.remove(filename)
         subprocess.run(['/sbin/pfctl', '-t', sys.argv[1], '-T', 'kill'], capture_output=True)
         # all good, exit 0
         sys.exit(0)
@@ -189,6 +189,7 @@ class Alias(object):
                                 self._resolve_content.add(address)
                         # resolve hostnames (async) if there are any in the collected set
                         self._resolve_content = self._resolve_content.union(address_parser.resolve_dns())
+                        address_parser.cleanup(self.items())
                 except (IOError, DNSException) as e:
                     syslog.syslog(syslog.LOG_ERR, 'alias resolve error %s (%s)' % (self._name, e))
                     self._resolve_content = set(undo_content.split("\n"))
@@ -278,12 +279,17 @@ class AliasParser(object):
     def __init__(self, source_tree):
         self._source_tree = source_tree
         self._aliases = dict()
+        # resolved alias contents (without dependencies) and dependency lists, kept during this objects lifetime
+        self._resolved = dict()
+        self._alias_deps = dict()
 
     def read(self):
         """ read aliases
             :return: None
         """
         self._aliases = dict()
+        self._resolved = dict()
+        self._alias_deps = dict()
         external_aliases = list()
         alias_parameters = dict()
         alias_parameters['known_aliases'] = [x.text for x in self._source_tree.iterfind('table/name')]
@@ -326,6 +332,46 @@ class AliasParser(object):
                     self.get_alias_deps(dep, alias_deps)
         return alias_deps
 
+    def prefetch(self, use_cached=None):
+        """ start fetching remote content (url types) for all aliases which need to be resolved, downloads run
+            concurrently and are collected when the alias is resolved.
+            Hostnames (host, network types) of all aliases are queued to be resolved at once, so names used in
+            multiple aliases are only requested once.
+            :param use_cached: function, returns True when the cached content of the provided alias name should be used
+            :return: None
+        """
+        for alias in self:
+            if use_cached is not None and use_cached(alias.get_name()):
+                continue
+            if alias.get_type() in ['url', 'urltable', 'host', 'network', 'networkgroup'] \
+                    and (alias.expired() or alias.changed()):
+                address_parser = alias.get_parser()
+                for item in alias.items():
+                    address_parser.prefetch(item)
+
+    def get_content(self, alias, use_cached=None):
+        """ fetch alias content including all dependencies, every alias is only resolved once.
+            :param alias: alias name
+            :param use_cached: function, returns True when the cached content of the provided alias name should be used
+            :return: tuple (set of addresses, alias or any of its dependencies changed or expired)
+        """
+        if alias not in self._alias_deps:
+            self._alias_deps[alias] = self.get_alias_deps(alias)
+        result = set()
+        changed_or_expired = False
+        for alias_name in [alias] + [x for x in self._alias_deps[alias] if x != alias]:
+            if alias_name not in self._resolved and alias_name in self._aliases:
+                this_alias = self._aliases[alias_name]
+                if use_cached is not None and use_cached(alias_name):
+                    content = set(this_alias.cached())
+                else:
+                    content = set(this_alias.resolve())
+                self._resolved[alias_name] = (content, max(this_alias.changed(), this_alias.expired()))
+            if alias_name in self._resolved:
+                result.update(self._resolved[alias_name][0])
+                changed_or_expired = max(changed_or_expired, self._resolved[alias_name][1])
+        return result, changed_or_expired
+
     def get(self, name):
         """ get alias by name
             :param name: alias name
@@ -23,6 +23,7 @@
     ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
     POSSIBILITY OF SUCH DAMAGE.
 """
+import os
 import syslog
 import ipaddress
 import itertools
@@ -30,6 +31,7 @@ import asyncio
 import dns.resolver
 import syslog
 import time
+import ujson
 from dns.rdatatype import RdataType
 from dns.asyncresolver import Resolver
 
@@ -82,9 +84,28 @@ class BaseContentParser:
         # try to resolve provided address (queue for retrieval)
         self._dnsResolver.add(address)
 
+    def prefetch(self, address):
+        """ queue hostname for resolving, all hostnames prefetched are requested at once on the first resolve_dns()
+            :param address: address, network or hostname
+            :return: None
+        """
+        address = address.strip()
+        if address.find('/') == -1:
+            try:
+                ipaddress.ip_address(address.split('-')[0].lstrip('!'))
+            except ValueError:
+                AsyncDNSResolver.prefetch(address)
+
     def resolve_dns(self):
          return self._dnsResolver.collect().addresses()
 
+    def cleanup(self, addresses):
+        """ remove state kept for entries no longer part of the alias, called after a successful resolve
+            :param addresses: current alias entries
+            :return: None
+        """
+        pass
+
 
 class AsyncDNSResolver:
     """ Asynchronous DNS resolver, collect addresses for hostnames collected in request queue.
@@ -95,60 +116,150 @@ class AsyncDNSResolver:
         asyncresolver.add('mail.example.com')
         asyncresolver.collect()
         print(asyncresolver.addresses())
+
+        Responses are kept in a process wide cache (persisted between runs) which respects the record ttl's,
+        hostnames queued using prefetch() are resolved together with the first collect() call so hostnames
+        shared between aliases are only requested once.
     """
-    batch_size = 100
+    max_concurrent = 100                                    # number of queries in flight
     report_size = 10000
+    negative_ttl = 60                                       # seconds to cache non existing names / records
+    _cache_filename = '/var/db/aliastables/dnscache.json'
+    _cache = None                                           # hostname => {expire, addresses, cnames}
+    _requested = set()                                      # hostnames requested during this process lifetime
+    _prefetch_queue = set()
 
     def __init__(self, origin="<unknown>"):
-        self._request_queue = list()
-        self._requested = set()
+        self._request_queue = set()
         self._response = set()
         self._origin = origin
         self._domains_queued = 0
 
     def add(self, hostname):
-        self._request_queue.append(hostname)
+        self._request_queue.add(hostname)
+
+    @classmethod
+    def prefetch(cls, hostname):
+        """ queue hostname to be resolved on the next collect() of any resolver
+            :param hostname: hostname
+            :return: None
+        """
+        cls._prefetch_queue.add(hostname)
 
-    async def request_ittr(self):
+    @classmethod
+    def _load_cache(cls):
+        if cls._cache is None:
+            cls._cache = dict()
+            if os.path.isfile(cls._cache_filename):
+                try:
+                    cls._cache = ujson.loads(open(cls._cache_filename).read())
+                except ValueError:
+                    syslog.syslog(syslog.LOG_ERR, 'unable to parse dns cache %s' % cls._cache_filename)
+
+    @classmethod
+    def _save_cache(cls):
+        if os.path.isdir(os.path.dirname(cls._cache_filename)):
+            now = time.time()
+            with open('%s.tmp' % cls._cache_filename, 'w') as f_out:
+                f_out.write(ujson.dumps({x: y for x, y in cls._cache.items() if y['expire'] > now}))
+            os.replace('%s.tmp' % cls._cache_filename, cls._cache_filename)
+
+    @classmethod
+    def _is_cached(cls, hostname):
+        if hostname in cls._requested:
+            return True
+        return hostname in cls._cache and cls._cache[hostname]['expire'] > time.time()
+
+    @staticmethod
+    async def _request(dnsResolver, hostname, record_type):
+        try:
+            return hostname, await dnsResolver.resolve(hostname, record_type)
+        except Exception as e:
+            return hostname, e
+
+    async def request_ittr(self, hostnames):
         dnsResolver = Resolver()
         dnsResolver.timeout = 2
         collected_errors = set()
-        while len(self._request_queue) > 0:
-            tasks = []
-            while len(tasks) < self.batch_size and len(self._request_queue) > 0:
-                hostname = self._request_queue.pop()
-                if hostname not in self._requested:
-                    self._domains_queued += 1
-                    # make sure we only request a host once
-                    for record_type in ['A', 'AAAA']:
-                        tasks.append(dnsResolver.resolve(hostname, record_type))
-                    self._requested.add(hostname)
-            if len(tasks) > 0:
-                responses = await asyncio.gather(*tasks, return_exceptions=True)
-                for response in responses:
+        request_queue = list(hostnames)
+        visited = set()
+        pending = set()
+        responses = dict()
+        while len(request_queue) > 0 or len(pending) > 0:
+            # keep max_concurrent queries in flight, a slow response doesn't block the next requests
+            while len(pending) < self.max_concurrent and len(request_queue) > 0:
+                hostname = request_queue.pop()
+                if hostname in visited:
+                    continue
+                visited.add(hostname)
+                if self._is_cached(hostname):
+                    # cname targets may expire before the record pointing to them
+                    if hostname in self._cache:
+                        request_queue.extend(self._cache[hostname]['cnames'])
+                    continue
+                self._requested.add(hostname)
+                self._domains_queued += 1
+                responses[hostname] = {'expire': None, 'addresses': list(), 'cnames': list(), 'pending': 2}
+                for record_type in ['A', 'AAAA']:
+                    pending.add(asyncio.ensure_future(self._request(dnsResolver, hostname, record_type)))
+                if self._domains_queued % self.report_size == 0:
+                    syslog.syslog(
+                        syslog.LOG_NOTICE, 'requested %d hostnames for %s' % (self._domains_queued, self._origin)
+                    )
+            if len(pending) > 0:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    hostname, response = task.result()
+                    entry = responses[hostname]
                     if type(response) is dns.resolver.Answer:
+                        expire = response.expiration
                         for item in response.response.answer:
                             if type(item) is dns.rrset.RRset:
                                 for addr in item.items:
                                     if addr.rdtype is RdataType.CNAME:
                                         # query cname (recursion)
-                                        self._request_queue.append(addr.target)
+                                        cname = addr.target.to_text(omit_final_dot=True)
+                                        entry['cnames'].append(cname)
+                                        request_queue.append(cname)
                                     else:
-                                        self._response.add(addr.address)
-                    elif type(response) in [dns.resolver.NXDOMAIN, dns.exception.Timeout, dns.resolver.NoNameservers]:
+                                        entry['addresses'].append(addr.address)
+                    elif type(response) in [dns.resolver.NXDOMAIN, dns.resolver.NoAnswer]:
+                        expire = time.time() + self.negative_ttl
+                    else:
+                        # timeouts and server failures are only remembered during this run
+                        expire = time.time()
+                    if type(response) in [dns.resolver.NXDOMAIN, dns.exception.Timeout, dns.resolver.NoNameservers]:
                         if str(response) not in collected_errors:
                             syslog.syslog(syslog.LOG_ERR, '%s [for %s]' % (response, self._origin))
                             collected_errors.add(str(response))
-            if self._domains_queued % self.report_size == 0:
-                syslog.syslog(syslog.LOG_NOTICE, 'requested %d hostnames for %s' % (self._domains_queued, self._origin))
+                    entry['expire'] = expire if entry['expire'] is None else min(entry['expire'], expire)
+                    entry['pending'] -= 1
+                    if entry['pending'] == 0:
+                        del entry['pending']
+                        self._cache[hostname] = responses.pop(hostname)
+
+    def _collect_cached(self, hostname, seen):
+        """ collect addresses for hostname (and its cnames) from cache
+        """
+        if hostname not in seen and hostname in self._cache:
+            seen.add(hostname)
+            self._response.update(self._cache[hostname]['addresses'])
+            for cname in self._cache[hostname]['cnames']:
+                self._collect_cached(cname, seen)
 
     def collect(self):
-        if len(self._request_queue) > 0:
+        if len(self._request_queue) > 0 or len(self._prefetch_queue) > 0:
             start_time = time.time()
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
-            asyncio.run(self.request_ittr())
-            loop.close()
+            self._load_cache()
+            hostnames = self._request_queue | self._prefetch_queue
+            self._prefetch_queue.clear()
+            asyncio.run(self.request_ittr(hostnames))
+            if self._domains_queued > 0:
+                self._save_cache()
+            seen = set()
+            for hostname in self._request_queue:
+                self._collect_cached(hostname, seen)
+            self._request_queue = set()
             syslog.syslog(syslog.LOG_NOTICE, 'resolving %d hostnames (%d addresses) for %s took %.2f seconds' % (
                 self._domains_queued, len(self._response), self._origin, time.time() - start_time
             ))
@@ -31,7 +31,9 @@ import os
 import syslog
 import gzip
 import requests
+from socket import AF_INET, AF_INET6
 from .base import BaseContentParser
+from .prefixindex import PrefixIndex, PrefixIndexBuilder
 
 
 class BGPASN(BaseContentParser):
@@ -40,6 +42,8 @@ class BGPASN(BaseContentParser):
     _asn_ttl =  (86400 - 90)                                        # validity in seconds of the local copy
     _asn_fhandle = None                                             # file handle to local copy
     _asn_db = {}                                                    # cache
+    _asn_index_filename = '/usr/local/share/bgp/asn.idx'            # (binary) index of the local copy
+    _asn_index = None                                               # opened index, tuple (mtime, PrefixIndex)
 
     @classmethod
     def _update(cls):
@@ -66,11 +70,15 @@ class BGPASN(BaseContentParser):
                 cls._asn_fhandle.seek(0)
                 cls._asn_fhandle.truncate()
                 count = 0
+                index_builder = PrefixIndexBuilder()
                 for line in gf:
                     parts = line.decode().strip().split()
                     if len(parts) == 2:
                         cls._asn_fhandle.write("%s,%s\n" % tuple(parts))
+                        index_builder.add(parts[1], parts[0])
                         count += 1
+                cls._asn_fhandle.flush()
+                index_builder.write(cls._asn_index_filename)
                 fcntl.flock(cls._asn_fhandle, fcntl.LOCK_UN)
                 syslog.syslog(syslog.LOG_NOTICE, 'dowloaded ASN list (%d entries)' % count)
             else:
@@ -81,6 +89,47 @@ class BGPASN(BaseContentParser):
                 raise IOError('error fetching BGP ASN url %s' % cls._asn_source)
         else:
             cls._asn_fhandle = open(cls._asn_filename, 'rt')
+            if not os.path.isfile(cls._asn_index_filename) or \
+                    os.stat(cls._asn_index_filename).st_mtime < os.stat(cls._asn_filename).st_mtime:
+                # local copy without (recent) index, e.g. after upgrade
+                cls._build_index()
+
+    @classmethod
+    def _build_index(cls):
+        """ (re)build index from local copy
+        """
+        index_builder = PrefixIndexBuilder()
+        with open(cls._asn_filename, 'rt') as f_in:
+            for row in csv.reader(f_in, delimiter=',', quotechar='"'):
+                if len(row) == 2:
+                    index_builder.add(row[1], row[0])
+        index_builder.write(cls._asn_index_filename)
+
+    @classmethod
+    def index(cls):
+        """ open (memory mapped) asn index, reopened when updated
+            :return: PrefixIndex or None when not available
+        """
+        if not os.path.isfile(cls._asn_index_filename):
+            return None
+        mtime = os.stat(cls._asn_index_filename).st_mtime
+        if cls._asn_index is None or cls._asn_index[0] != mtime:
+            try:
+                cls._asn_index = (mtime, PrefixIndex(cls._asn_index_filename))
+            except (ValueError, OSError) as e:
+                syslog.syslog(syslog.LOG_ERR, 'asn index unavailable : %s' % e)
+                return None
+        return cls._asn_index[1]
+
+    @classmethod
+    def lookup(cls, address):
+        """ lookup origin AS for address (longest prefix match)
+            :param address: ip address
+            :return: asn or None when not found
+        """
+        index = cls.index()
+        result = index.lookup(address) if index is not None else None
+        return result[0] if result is not None else None
 
     def __init__(self, proto='IPv4', **kwargs):
         super().__init__(**kwargs)
@@ -90,6 +139,13 @@ class BGPASN(BaseContentParser):
             self._update()
 
     def iter_addresses(self, asn):
+        index = self.index()
+        if index is not None:
+            families = [AF_INET if x == 'IPv4' else AF_INET6 for x in self.proto if x in ['IPv4', 'IPv6']]
+            for address in index.networks(asn, families):
+                yield address
+            return
+
         if len(self._asn_db) == 0:
             self._asn_fhandle.seek(0)
             for row in csv.reader(self._asn_fhandle, delimiter=',', quotechar='"'):
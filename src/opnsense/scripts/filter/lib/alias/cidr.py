@@ -0,0 +1,149 @@
+"""
+    Copyright (c) 2023 Ad Schellevis <ad@opnsense.org>
+    All rights reserved.
+
+    Redistribution and use in source and binary forms, with or without
+    modification, are permitted provided that the following conditions are met:
+
+    1. Redistributions of source code must retain the above copyright notice,
+     this list of conditions and the following disclaimer.
+
+    2. Redistributions in binary form must reproduce the above copyright
+     notice, this list of conditions and the following disclaimer in the
+     documentation and/or other materials provided with the distribution.
+
+    THIS SOFTWARE IS PROVIDED ``AS IS'' AND ANY EXPRESS OR IMPLIED WARRANTIES,
+    INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY
+    AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+    AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY,
+    OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+    SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+    INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+    CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+    ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+    POSSIBILITY OF SUCH DAMAGE.
+
+    --------------------------------------------------------------------------------------
+    address normalization and CIDR aggregation for pf tables
+"""
+from socket import inet_pton, inet_ntop, AF_INET, AF_INET6
+
+
+class PrefixTree:
+    """ binary prefix (radix) tree for a single address family, nodes are stored per prefix length as sets of
+        network addresses (integers), so sibling and ancestor lookups don't need to walk the tree.
+    """
+    def __init__(self, max_prefixlen):
+        self._max_prefixlen = max_prefixlen
+        self._nodes = dict()
+
+    def add(self, network, prefixlen):
+        """ add network
+            :param network: network address (int, host bits cleared)
+            :param prefixlen: prefix length
+        """
+        if prefixlen not in self._nodes:
+            self._nodes[prefixlen] = set()
+        self._nodes[prefixlen].add(network)
+
+    def collapse(self):
+        """ minimal set of networks covering the same addresses
+            :return: iterator of tuples (network, prefixlen)
+        """
+        # merge siblings bottom up, a node is complete when both its children are
+        for prefixlen in range(self._max_prefixlen, 0, -1):
+            if not self._nodes.get(prefixlen):
+                continue
+            networks = self._nodes[prefixlen]
+            host_bit = 1 << (self._max_prefixlen - prefixlen)
+            for network in [x for x in networks if not x & host_bit and x | host_bit in networks]:
+                networks.discard(network)
+                networks.discard(network | host_bit)
+                self.add(network, prefixlen - 1)
+        # skip networks covered by a shorter prefix
+        collapsed = dict()
+        for prefixlen in sorted(self._nodes):
+            parents = [(self._max_prefixlen - x, collapsed[x]) for x in collapsed if collapsed[x]]
+            collapsed[prefixlen] = set()
+            for network in self._nodes[prefixlen]:
+                for shift, parent_networks in parents:
+                    if (network >> shift) << shift in parent_networks:
+                        break
+                else:
+                    collapsed[prefixlen].add(network)
+                    yield network, prefixlen
+
+
+def parse_address(address):
+    """ parse address or network
+        :param address: address or network (CIDR notation)
+        :return: tuple (family, network, prefixlen) or None when not parseable
+    """
+    address, separator, prefixlen = address.partition('/')
+    if address.find(':') > -1:
+        family, max_prefixlen = AF_INET6, 128
+    else:
+        family, max_prefixlen = AF_INET, 32
+    try:
+        network = int.from_bytes(inet_pton(family, address), 'big')
+    except OSError:
+        return None
+    if separator:
+        if not prefixlen.isdigit() or int(prefixlen) > max_prefixlen:
+            return None
+        prefixlen = int(prefixlen)
+    else:
+        prefixlen = max_prefixlen
+    host_bits = max_prefixlen - prefixlen
+    return family, (network >> host_bits) << host_bits, prefixlen
+
+
+def format_address(family, network, prefixlen):
+    """ format network the same way pfctl lists table entries, hosts without prefix length
+        :param family: AF_INET or AF_INET6
+        :param network: network address (int)
+        :param prefixlen: prefix length
+        :return: string
+    """
+    max_prefixlen = 32 if family == AF_INET else 128
+    address = inet_ntop(family, network.to_bytes(max_prefixlen // 8, 'big'))
+    return address if prefixlen == max_prefixlen else '%s/%d' % (address, prefixlen)
+
+
+def normalize_addresses(addresses):
+    """ normalize table entries, entries which can't be parsed (e.g. hostnames) are returned unaltered
+        :param addresses: iterable of addresses and networks, negations prefixed with !
+        :return: set
+    """
+    result = set()
+    for address in addresses:
+        if not address:
+            continue
+        negate = '!' if address.startswith('!') else ''
+        parsed = parse_address(address.lstrip('!'))
+        result.add('%s%s' % (negate, format_address(*parsed)) if parsed else address)
+    return result
+
+
+def collapse_addresses(addresses):
+    """ collapse table entries into the minimal set of networks, tables containing negations are only normalized
+        since merging could change the longest prefix match outcome in pf.
+        :param addresses: list or set of addresses and networks, negations prefixed with !
+        :return: set
+    """
+    trees = {AF_INET: PrefixTree(32), AF_INET6: PrefixTree(128)}
+    result = set()
+    for address in addresses:
+        if not address:
+            continue
+        elif address.startswith('!'):
+            return normalize_addresses(addresses)
+        parsed = parse_address(address)
+        if parsed:
+            trees[parsed[0]].add(parsed[1], parsed[2])
+        else:
+            result.add(address)
+    for family in trees:
+        for network, prefixlen in trees[family].collapse():
+            result.add(format_address(family, network, prefixlen))
+    return result
@@ -32,14 +32,18 @@ import ujson
 import requests
 import zipfile
 import syslog
+from socket import AF_INET, AF_INET6
 from configparser import ConfigParser
 from .base import BaseContentParser
+from .prefixindex import PrefixIndex, PrefixIndexBuilder
 
 
 class GEOIP(BaseContentParser):
     _updater_conf = '/usr/local/etc/filter_geoip.conf'
     _stats_output = '/usr/local/share/GeoIP/alias.stats'
     _target_dir = '/usr/local/share/GeoIP/alias'
+    _index_filename = '/usr/local/share/GeoIP/alias.idx'
+    _index = None
 
     @classmethod
     def _update(cls):
@@ -96,7 +100,8 @@ class GEOIP(BaseContentParser):
                                             country_codes[parts[0]] = parts[4]
                                         elif parts[2] == 'EU':
                                             country_codes[parts[0]] = parts[2]
-                                # process all details into files per country / protocol
+                                # process all details into files per country / protocol and a (binary) index
+                                index_builder = PrefixIndexBuilder()
                                 for proto in ['IPv4', 'IPv6']:
                                     if result['address_sources'][proto] is not None:
                                         output_handles = dict()
@@ -113,9 +118,12 @@ class GEOIP(BaseContentParser):
                                                     )
                                                     result['file_count'] += 1
                                                 output_handles[country_code].write("%s\n" % parts[0])
+                                                index_builder.add(country_code, parts[0])
                                                 result['address_count'] += 1
                                         for country_code in output_handles:
                                             output_handles[country_code].close()
+                                index_builder.write(cls._index_filename)
+                                del index_builder
                     except zipfile.BadZipFile as e:
                         syslog.syslog(syslog.LOG_ERR, 'geoip update failed : %s' % e)
                         return result
@@ -131,6 +139,32 @@ class GEOIP(BaseContentParser):
     def download(self):
         return self._update()
 
+    @classmethod
+    def index(cls):
+        """ open (memory mapped) geoip index, reopened when updated
+            :return: PrefixIndex or None when not available
+        """
+        if not os.path.isfile(cls._index_filename):
+            return None
+        mtime = os.stat(cls._index_filename).st_mtime
+        if cls._index is None or cls._index[0] != mtime:
+            try:
+                cls._index = (mtime, PrefixIndex(cls._index_filename))
+            except (ValueError, OSError) as e:
+                syslog.syslog(syslog.LOG_ERR, 'geoip index unavailable : %s' % e)
+                return None
+        return cls._index[1]
+
+    @classmethod
+    def lookup(cls, address):
+        """ lookup country for address
+            :param address: ip address
+            :return: country code or None when not found
+        """
+        index = cls.index()
+        result = index.lookup(address) if index is not None else None
+        return result[0] if result is not None else None
+
     def iter_addresses(self, country):
         do_update = True
         if os.path.isfile('%s/NL-IPv4' % self._target_dir):
@@ -143,6 +177,13 @@ class GEOIP(BaseContentParser):
                 'geoip updated (files: %(file_count)d lines: %(address_count)d)' % self._update()
             )
 
+        index = self.index()
+        if index is not None:
+            families = [AF_INET if x == 'IPv4' else AF_INET6 for x in self._proto if x in ['IPv4', 'IPv6']]
+            for address in index.networks(country, families):
+                yield address
+            return
+
         for proto in self._proto:
             geoip_filename = "%s/%s-%s" % ( self._target_dir, country, proto)
             if os.path.isfile(geoip_filename):
@@ -60,6 +60,26 @@ class PF:
         )
         return sp.stderr.strip()
 
+    @staticmethod
+    def add(table_name, addresses):
+        sp = subprocess.run(
+            ['/sbin/pfctl', '-t', table_name, '-T', 'add', '-f', '-'],
+            input='\n'.join(addresses),
+            capture_output=True,
+            text=True
+        )
+        return sp.stderr.strip()
+
+    @staticmethod
+    def delete(table_name, addresses):
+        sp = subprocess.run(
+            ['/sbin/pfctl', '-t', table_name, '-T', 'delete', '-f', '-'],
+            input='\n'.join(addresses),
+            capture_output=True,
+            text=True
+        )
+        return sp.stderr.strip()
+
     @staticmethod
     def remove(table_name):
         subprocess.run(['/sbin/pfctl', '-t', table_name, '-T', 'kill'], capture_output=True)
@@ -0,0 +1,239 @@
+"""
+    Copyright (c) 2023 Ad Schellevis <ad@opnsense.org>
+    All rights reserved.
+
+    Redistribution and use in source and binary forms, with or without
+    modification, are permitted provided that the following conditions are met:
+
+    1. Redistributions of source code must retain the above copyright notice,
+     this list of conditions and the following disclaimer.
+
+    2. Redistributions in binary form must reproduce the above copyright
+     notice, this list of conditions and the following disclaimer in the
+     documentation and/or other materials provided with the distribution.
+
+    THIS SOFTWARE IS PROVIDED ``AS IS'' AND ANY EXPRESS OR IMPLIED WARRANTIES,
+    INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY
+    AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+    AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY,
+    OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+    SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+    INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+    CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+    ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+    POSSIBILITY OF SUCH DAMAGE.
+
+    --------------------------------------------------------------------------------------
+    memory mapped (binary) index of networks per label (country, asn, ...) supporting fast extraction of all
+    networks of a label and (longest prefix) address to label lookups.
+
+    file layout, all integers in native byte order (validated using the byte order marker):
+        header          magic, version, byte order marker, number of labels, number of ipv4 and ipv6 networks
+        labels          sorted label records (label, ipv4 offset, ipv4 count, ipv6 offset, ipv6 count)
+        per family      network start address (ipv6 as high and low 64 bits), prefix length,
+                        parent (enclosing network index or -1), label index, all ordered by address
+                        positions: network indexes grouped by label (offset and count in the label record)
+"""
+import mmap
+import os
+import struct
+from array import array
+from socket import AF_INET, AF_INET6
+from .cidr import parse_address, format_address
+
+
+class PrefixIndexBuilder:
+    """ collect networks per label and write a PrefixIndex file
+    """
+    def __init__(self):
+        self._labels = dict()
+        self._networks = {AF_INET: [array('Q'), array('B'), array('I')], AF_INET6: [list(), array('B'), array('I')]}
+
+    def add(self, label, network):
+        """ add network
+            :param label: label (max 16 bytes)
+            :param network: network (CIDR notation) or address
+            :return: bool, False when not parseable
+        """
+        parsed = parse_address(network)
+        if parsed is None:
+            return False
+        if label not in self._labels:
+            self._labels[label] = len(self._labels)
+        starts, prefixlens, labels = self._networks[parsed[0]]
+        starts.append(parsed[1])
+        prefixlens.append(parsed[2])
+        labels.append(self._labels[label])
+        return True
+
+    @staticmethod
+    def _pad(f_out):
+        f_out.write(bytes(-f_out.tell() % 8))
+
+    def write(self, filename):
+        """ write index (atomic replace)
+            :param filename: target filename
+            :return: None
+        """
+        label_names = sorted(self._labels, key=lambda x: x.encode())
+        label_order = array('I', bytes(4 * len(label_names)))
+        for idx, label in enumerate(label_names):
+            label_order[self._labels[label]] = idx
+        sections = list()
+        label_ranges = [[0, 0, 0, 0] for x in label_names]
+        for family_idx, family in enumerate([AF_INET, AF_INET6]):
+            max_prefixlen = 32 if family == AF_INET else 128
+            starts, prefixlens, labels = self._networks[family]
+            # order by address, least specific first
+            order = sorted(range(len(starts)), key=lambda x: (starts[x] << 8) | prefixlens[x])
+            parents = array('i')
+            stack = list()
+            for idx in order:
+                while stack and (starts[idx] >> (max_prefixlen - stack[-1][1])) != stack[-1][0]:
+                    stack.pop()
+                parents.append(stack[-1][2] if stack else -1)
+                stack.append((starts[idx] >> (max_prefixlen - prefixlens[idx]), prefixlens[idx], len(parents) - 1))
+            sorted_labels = array('I', [label_order[labels[x]] for x in order])
+            positions = array('I', sorted(range(len(order)), key=lambda x: sorted_labels[x]))
+            for position_idx, network_idx in enumerate(positions):
+                label_range = label_ranges[sorted_labels[network_idx]]
+                if label_range[family_idx * 2 + 1] == 0:
+                    label_range[family_idx * 2] = position_idx
+                label_range[family_idx * 2 + 1] += 1
+            if family == AF_INET:
+                sections.append(array('I', [starts[x] for x in order]))
+            else:
+                sections.append(array('Q', [starts[x] >> 64 for x in order]))
+                sections.append(array('Q', [starts[x] & 0xffffffffffffffff for x in order]))
+            sections += [array('B', [prefixlens[x] for x in order]), parents, sorted_labels, positions]
+
+        with open('%s.tmp' % filename, 'wb') as f_out:
+            f_out.write(PrefixIndex.header.pack(
+                PrefixIndex.magic, PrefixIndex.version, PrefixIndex.byte_order_marker, len(label_names),
+                len(self._networks[AF_INET][0]), len(self._networks[AF_INET6][0])
+            ))
+            for idx, label in enumerate(label_names):
+                f_out.write(PrefixIndex.label_record.pack(label.encode(), *label_ranges[idx]))
+            for section in sections:
+                self._pad(f_out)
+                section.tofile(f_out)
+        os.replace('%s.tmp' % filename, filename)
+
+
+class PrefixIndex:
+    """ read PrefixIndex files (see PrefixIndexBuilder)
+    """
+    magic = b'PFXINDEX'
+    version = 1
+    byte_order_marker = 0x01020304
+    header = struct.Struct('=8sIIIII')
+    label_record = struct.Struct('=16sIIII')
+
+    def __init__(self, filename):
+        """ open index
+            :param filename: index filename
+            :raises ValueError: when the file isn't a (compatible) index
+        """
+        with open(filename, 'rb') as f_in:
+            self._mmap = mmap.mmap(f_in.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, marker, self._label_count, count4, count6 = self.header.unpack_from(self._mmap)
+        if magic != self.magic or version != self.version or marker != self.byte_order_marker:
+            raise ValueError('incompatible index %s' % filename)
+        self._labels_offset = self.header.size
+        offset = self._labels_offset + self._label_count * self.label_record.size
+        self._sections = dict()
+        for family, count, typecodes in [
+            (AF_INET, count4, ['I', 'B', 'i', 'I', 'I']), (AF_INET6, count6, ['Q', 'Q', 'B', 'i', 'I', 'I'])
+        ]:
+            self._sections[family] = list()
+            for typecode in typecodes:
+                offset += -offset % 8
+                size = count * struct.calcsize(typecode)
+                self._sections[family].append(memoryview(self._mmap)[offset:offset + size].cast(typecode))
+                offset += size
+
+    def __len__(self):
+        return self._label_count
+
+    def close(self):
+        for family in self._sections:
+            for section in self._sections[family]:
+                section.release()
+        self._sections = dict()
+        self._mmap.close()
+
+    def _label(self, idx):
+        return self.label_record.unpack_from(self._mmap, self._labels_offset + idx * self.label_record.size)
+
+    def labels(self):
+        """
+            :return: iterator of all labels in this index (sorted)
+        """
+        for idx in range(self._label_count):
+            yield self._label(idx)[0].rstrip(b'\0').decode()
+
+    def _find_label(self, label):
+        """ binary search label record
+            :param label: label
+            :return: label record or None
+        """
+        label = label.encode()[:16].ljust(16, b'\0')
+        low, high = 0, self._label_count
+        while low < high:
+            mid = (low + high) // 2
+            if self._label(mid)[0] < label:
+                low = mid + 1
+            else:
+                high = mid
+        if low < self._label_count and self._label(low)[0] == label:
+            return self._label(low)
+        return None
+
+    def _start(self, family, idx):
+        sections = self._sections[family]
+        return sections[0][idx] if family == AF_INET else (sections[0][idx] << 64) | sections[1][idx]
+
+    def networks(self, label, families=(AF_INET, AF_INET6)):
+        """ networks registered for label
+            :param label: label
+            :param families: address families to return
+            :return: iterator of networks (CIDR notation, hosts without prefix length)
+        """
+        record = self._find_label(label)
+        if record is not None:
+            for family_idx, family in enumerate([AF_INET, AF_INET6]):
+                if family in families:
+                    offset, count = record[1 + family_idx * 2], record[2 + family_idx * 2]
+                    prefixlens = self._sections[family][-4]
+                    positions = self._sections[family][-1]
+                    for network_idx in positions[offset:offset + count]:
+                        yield format_address(family, self._start(family, network_idx), prefixlens[network_idx])
+
+    def lookup(self, address):
+        """ find the most specific network containing address
+            :param address: ip address
+            :return: tuple (label, network) or None when not found
+        """
+        parsed = parse_address(address)
+        if parsed is None:
+            return None
+        family, value = parsed[0], parsed[1]
+        max_prefixlen = 32 if family == AF_INET else 128
+        prefixlens, parents, labels = self._sections[family][-4:-1]
+        # last network starting at or before address
+        low, high = 0, len(prefixlens)
+        while low < high:
+            mid = (low + high) // 2
+            if self._start(family, mid) <= value:
+                low = mid + 1
+            else:
+                high = mid
+        idx = low - 1
+        # walk enclosing networks until one contains the address
+        while idx >= 0:
+            host_bits = max_prefixlen - prefixlens[idx]
+            if (value >> host_bits) == (self._start(family, idx) >> host_bits):
+                label = self._label(labels[idx])[0].rstrip(b'\0').decode()
+                return label, format_address(family, self._start(family, idx), prefixlens[idx])
+            idx = parents[idx]
+        return None
@@ -24,50 +24,201 @@
     ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
     POSSIBILITY OF SUCH DAMAGE.
 """
+import glob
+import os
 import re
+import shutil
 import syslog
+import tempfile
+import threading
+import ujson
 import requests
 import urllib3
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import md5
+from io import TextIOWrapper
+from urllib.parse import urlparse
 from .base import BaseContentParser
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
 
+class UriFetcher:
+    """ fetch urls concurrently, shared by all url type aliases.
+        Keeps a (pooled) session per host and spools response bodies to temporary files (in memory up to
+        spool_size bytes), which can be read line by line when the alias is resolved.
+    """
+    max_workers = 8
+    spool_size = 1024 * 1024
+    chunk_size = 64 * 1024
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._executor = None
+        self._sessions = dict()
+        self._requests = dict()
+
+    def _session(self, url):
+        host = urlparse(url).netloc
+        with self._lock:
+            if host not in self._sessions:
+                self._sessions[host] = requests.Session()
+            return self._sessions[host]
+
+    def _fetch(self, url, timeout, verify, headers):
+        """ fetch url
+            :return: tuple (status_code, response headers, spooled body or None)
+        """
+        with self._session(url).get(url, stream=True, timeout=timeout, verify=verify, headers=headers) as req:
+            body = None
+            if req.status_code == 200:
+                req.raw.decode_content = True
+                body = tempfile.SpooledTemporaryFile(max_size=self.spool_size)
+                shutil.copyfileobj(req.raw, body, self.chunk_size)
+                body.seek(0)
+            return req.status_code, req.headers, body
+
+    def request(self, key, url, timeout=120, verify=True, headers=None):
+        """ queue request, only the first request for a key is executed
+            :param key: request identifier
+            :param url: url to fetch
+            :param timeout: request timeout in seconds
+            :param verify: verify ssl certificates
+            :param headers: request headers (conditional requests)
+            :return: None
+        """
+        with self._lock:
+            if key not in self._requests:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(max_workers=self.max_workers)
+                self._requests[key] = self._executor.submit(self._fetch, url, timeout, verify, headers)
+
+    def response(self, key, url, timeout=120, verify=True, headers=None):
+        """ collect response, queues the request when not requested before
+            :return: tuple (status_code, response headers, spooled body or None)
+        """
+        self.request(key, url, timeout, verify, headers)
+        with self._lock:
+            future = self._requests.pop(key)
+        return future.result()
+
+
 class UriParser(BaseContentParser):
+    _fetcher = UriFetcher()
+    _state_dir = '/var/db/aliastables'
 
     def __init__(self, timeout=120, ssl_no_verify=False, **kwargs):
         super().__init__(**kwargs)
         self._timeout = timeout
         self._ssl_no_verify = ssl_no_verify
+        self._name = kwargs.get('name')
+        # keep conditional request state and extracted entries when we know where to store them
+        self._use_cache = self._name is not None and os.path.isdir(self._state_dir)
+
+    def _state_filename(self):
+        return '%s/%s.http.txt' % (self._state_dir, self._name)
+
+    def _cache_filename(self, url):
+        return '%s/%s.%s.url.txt' % (self._state_dir, self._name, md5(url.encode()).hexdigest())
+
+    def _read_state(self):
+        """ read conditional request state (etag, last-modified) per url for this alias
+            :return: dict
+        """
+        if self._use_cache and os.path.isfile(self._state_filename()):
+            try:
+                return ujson.loads(open(self._state_filename()).read())
+            except ValueError:
+                pass
+        return dict()
+
+    def _request_headers(self, url):
+        """ conditional request headers, only when the previous content is available
+            :param url: url
+            :return: dict
+        """
+        headers = dict()
+        state = self._read_state().get(url, {})
+        if self._use_cache and os.path.isfile(self._cache_filename(url)):
+            if state.get('etag'):
+                headers['If-None-Match'] = state['etag']
+            if state.get('last_modified'):
+                headers['If-Modified-Since'] = state['last_modified']
+        return headers
+
+    def _update_state(self, url, headers):
+        state = self._read_state()
+        state[url] = {'etag': headers.get('ETag'), 'last_modified': headers.get('Last-Modified')}
+        with open(self._state_filename(), 'w') as f_out:
+            f_out.write(ujson.dumps(state))
+
+    def cleanup(self, addresses):
+        """ drop cached entries and conditional request state of urls no longer part of this alias
+            :param addresses: current alias urls
+            :return: None
+        """
+        if not self._use_cache:
+            return
+        addresses = set(addresses)
+        current = set(self._cache_filename(x) for x in addresses)
+        for filename in glob.glob('%s/%s.*.url.txt' % (self._state_dir, glob.escape(self._name))):
+            if filename not in current:
+                os.remove(filename)
+        state = self._read_state()
+        if len(set(state) - addresses) > 0:
+            with open(self._state_filename(), 'w') as f_out:
+                f_out.write(ujson.dumps({x: state[x] for x in state if x in addresses}))
+
+    def prefetch(self, url):
+        """ start fetching url in the background
+            :param url: url
+            :return: None
+        """
+        self._fetcher.request(
+            (self._name, url), url, self._timeout, not self._ssl_no_verify, self._request_headers(url)
+        )
 
     def iter_addresses(self, url):
         """ return unparsed (raw) alias entries without dependencies
             :param url: url
             :return: iterator
         """
-        # set request parameters
-        req_opts = dict()
-        req_opts['url'] = url
-        req_opts['stream'] = True
-        req_opts['timeout'] = self._timeout
-        if self._ssl_no_verify:
-            req_opts['verify'] = False
-
-        # fetch data
         try:
-            req = requests.get(**req_opts)
-            if req.status_code == 200:
-                # only handle content if response is correct
-                req.raw.decode_content = True
-                lines = req.raw.read().decode().splitlines()
-                syslog.syslog(syslog.LOG_NOTICE, 'fetch alias url %s (lines: %s)' % (url, len(lines)))
-                for line in lines:
-                    raw_address = re.split(r'[\s,;|#]+', line)[0]
-                    if raw_address and not raw_address.startswith('//'):
-                        for address in super().iter_addresses(raw_address):
-                            yield address
-            else:
-                syslog.syslog(syslog.LOG_ERR, 'error fetching alias url %s [http_code:%s]' % (url, req.status_code))
-                raise IOError('error fetching alias url %s' % (url))
-        except:
+            status_code, headers, body = self._fetcher.response(
+                (self._name, url), url, self._timeout, not self._ssl_no_verify, self._request_headers(url)
+            )
+        except Exception:
             syslog.syslog(syslog.LOG_ERR, 'error fetching alias url %s' % (url))
             raise IOError('error fetching alias url %s' % (url))
+
+        cache_filename = self._cache_filename(url)
+        if status_code == 304:
+            # not modified, use the entries extracted last time
+            with open(cache_filename, 'r') as f_in:
+                lines = 0
+                for raw_address in f_in:
+                    lines += 1
+                    for address in super().iter_addresses(raw_address):
+                        yield address
+            syslog.syslog(syslog.LOG_NOTICE, 'fetch alias url %s (not modified, lines: %s)' % (url, lines))
+        elif status_code == 200:
+            # only handle content if response is correct, keep extracted entries for conditional requests
+            try:
+                with body, open('%s.tmp' % cache_filename if self._use_cache else os.devnull, 'w') as f_cache:
+                    lines = 0
+                    for line in TextIOWrapper(body, encoding='utf-8'):
+                        lines += 1
+                        raw_address = re.split(r'[\s,;|#]+', line)[0]
+                        if raw_address and not raw_address.startswith('//'):
+                            f_cache.write('%s\n' % raw_address)
+                            for address in super().iter_addresses(raw_address):
+                                yield address
+            except Exception:
+                syslog.syslog(syslog.LOG_ERR, 'error fetching alias url %s' % (url))
+                raise IOError('error fetching alias url %s' % (url))
+            syslog.syslog(syslog.LOG_NOTICE, 'fetch alias url %s (lines: %s)' % (url, lines))
+            if self._use_cache:
+                os.replace('%s.tmp' % cache_filename, cache_filename)
+                self._update_state(url, headers)
+        else:
+            syslog.syslog(syslog.LOG_ERR, 'error fetching alias url %s [http_code:%s]' % (url, status_code))
+            raise IOError('error fetching alias url %s' % (url))
@@ -0,0 +1,161 @@
+"""
+    Copyright (c) 2017-2023 Ad Schellevis <ad@opnsense.org>
+    All rights reserved.
+
+    Redistribution and use in source and binary forms, with or without
+    modification, are permitted provided that the following conditions are met:
+
+    1. Redistributions of source code must retain the above copyright notice,
+     this list of conditions and the following disclaimer.
+
+    2. Redistributions in binary form must reproduce the above copyright
+     notice, this list of conditions and the following disclaimer in the
+     documentation and/or other materials provided with the distribution.
+
+    THIS SOFTWARE IS PROVIDED ``AS IS'' AND ANY EXPRESS OR IMPLIED WARRANTIES,
+    INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY
+    AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+    AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY,
+    OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+    SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+    INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+    CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+    ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+    POSSIBILITY OF SUCH DAMAGE.
+
+    --------------------------------------------------------------------------------------
+    filter log (filterlog) record parsing
+"""
+import re
+from hashlib import md5
+from .rulecache import RuleCache
+
+
+# define log layouts, every endpoint contains all options
+# source : https://github.com/opnsense/ports/blob/master/opnsense/filterlog/files/description.txt
+fields_general = 'rulenr,subrulenr,anchorname,rid,interface,reason,action,dir,ipversion'.split(',')
+
+fields_ipv4 = fields_general + 'tos,ecn,ttl,id,offset,ipflags,protonum,protoname,length,src,dst'.split(',')
+fields_ipv4_udp = fields_ipv4 + 'srcport,dstport,datalen'.split(',')
+fields_ipv4_tcp = fields_ipv4 + 'srcport,dstport,datalen,tcpflags,seq,ack,urp,tcpopts'.split(',')
+fields_ipv4_carp = fields_ipv4 + 'type,ttl,vhid,version,advskew,advbase'.split(',')
+
+fields_ipv6 = fields_general + 'class,flow,hoplimit,protoname,protonum,length,src,dst'.split(',')
+fields_ipv6_udp = fields_ipv6 + 'srcport,dstport,datalen'.split(',')
+fields_ipv6_tcp = fields_ipv6 + 'srcport,dstport,datalen,tcpflags,seq,ack,urp,tcpopts'.split(',')
+fields_ipv6_carp = fields_ipv6 + 'type,hoplimit,vhid,version,advskew,advbase'.split(',')
+
+# layout per ip version: (base layout, position of the protocol number, layouts per protocol number)
+layouts = {
+    '4': (fields_ipv4, fields_ipv4.index('protonum'), {
+        '17': fields_ipv4_udp, '6': fields_ipv4_tcp, '112': fields_ipv4_carp
+    }),
+    '6': (fields_ipv6, fields_ipv6.index('protonum'), {
+        '17': fields_ipv6_udp, '6': fields_ipv6_tcp, '112': fields_ipv6_carp
+    }),
+}
+
+# define hex digits
+HEX_DIGITS = set("0123456789abcdef")
+
+# rfc3164 format identifier, e.g. "Oct 18 12:00:00 host filterlog[123]: ..."
+rfc3164_ident = re.compile(r'filterlog\[\d*\]:')
+
+# rule descriptions of the last seen rule cache, tuple (RuleCache, dict)
+_rule_details = None
+
+
+def fetch_rule_details():
+    """ Fetch rule descriptions from the current running config if available
+        :return : rule details per rule id
+    """
+    global _rule_details
+    cache = RuleCache.open()
+    if _rule_details is None or _rule_details[0] is not cache:
+        rule_map = dict()
+        for rid, descr, line in cache.labels():
+            # detect either calculated md5 hash (calcRuleHash) or rule uuid
+            if descr is not None and len(rid) >= 32 and set(rid.replace('-', '')).issubset(HEX_DIGITS):
+                rule_map[rid] = descr
+        _rule_details = (cache, rule_map)
+
+    return _rule_details[1]
+
+
+def split_record(line):
+    """ split log line into its header and filterlog fields
+        :param line: log line
+        :return: tuple (timestamp, host, list of fields) or None when not parseable
+    """
+    match = rfc3164_ident.search(line)
+    if match:
+        # rfc3164 format
+        tmp = line[:match.start()].split()
+        return ' '.join(tmp[:-1]), tmp[-1] if tmp else '', line[match.end():].strip().split(',')
+    else:
+        # rfc5424 format
+        tmp = line.split()
+        if len(tmp) < 3:
+            return None
+        return tmp[1].split('+')[0], tmp[2], tmp[-1].strip().split(',')
+
+
+def record_layout(fields):
+    """ select the layout (field names) for the provided filterlog fields
+        :param fields: list of fields
+        :return: list of field names
+    """
+    if len(fields) > 8 and fields[8] in layouts:
+        spec, protonum_pos, proto_specs = layouts[fields[8]]
+        if len(fields) > protonum_pos:
+            return proto_specs.get(fields[protonum_pos], spec)
+        return spec
+    return fields_general
+
+
+def record_rid(fields):
+    """ extract rule id from filterlog fields, older formats append the id to the record
+        :param fields: list of fields
+        :return: string
+    """
+    if fields[3] == '0' and fields[6] in ['pass', 'block']:
+        extra = fields[len(record_layout(fields)):]
+        if len(extra) > 0 and len(extra[-1]) >= 32 and set(extra[-1].replace('-', '')).issubset(HEX_DIGITS):
+            return extra[-1]
+    return fields[3]
+
+
+def parse_record(record, running_conf_descr):
+    """ parse filterlog record
+        :param record: dict containing the log line
+        :param running_conf_descr: rule descriptions (see fetch_rule_details())
+        :return: rule or None when not a filterlog record
+    """
+    parts = split_record(record['line'])
+    if parts is None or len(parts[2]) <= fields_general.index('action'):
+        # not a filter log line, skip
+        return None
+    fields = parts[2]
+    spec = record_layout(fields)
+    rule = dict(zip(spec, fields))
+    rule['__timestamp__'] = parts[0]
+    rule['__host__'] = parts[1]
+    rule['__digest__'] = md5(record['line'].encode()).hexdigest()
+    # full spec
+    rule['__spec__'] = spec
+
+    rule['label'] = ''
+    if rule['rid'] != '0':
+        # rule id in latest record format, don't use rule sequence number in that case
+        if rule['rid'] in running_conf_descr:
+            rule['label'] = running_conf_descr[rule['rid']]
+    elif rule['action'] not in ['pass', 'block']:
+        # no id for translation rules
+        rule['label'] = "%s rule" % rule['action']
+    else:
+        # rule id appended in record format, don't use rule sequence number in that case either
+        rule['rid'] = record_rid(fields)
+        if rule['rid'] in running_conf_descr:
+            rule['label'] = running_conf_descr[rule['rid']]
+
+    return rule
@@ -0,0 +1,263 @@
+"""
+    Copyright (c) 2017-2023 Ad Schellevis <ad@opnsense.org>
+    All rights reserved.
+
+    Redistribution and use in source and binary forms, with or without
+    modification, are permitted provided that the following conditions are met:
+
+    1. Redistributions of source code must retain the above copyright notice,
+     this list of conditions and the following disclaimer.
+
+    2. Redistributions in binary form must reproduce the above copyright
+     notice, this list of conditions and the following disclaimer in the
+     documentation and/or other materials provided with the distribution.
+
+    THIS SOFTWARE IS PROVIDED ``AS IS'' AND ANY EXPRESS OR IMPLIED WARRANTIES,
+    INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY
+    AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+    AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY,
+    OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+    SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+    INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+    CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+    ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+    POSSIBILITY OF SUCH DAMAGE.
+
+    --------------------------------------------------------------------------------------
+    columnar (parquet) archive of the filter logs for fast aggregations.
+
+    every log in /var/log/filter is compacted incrementally into zstd compressed parquet segments
+    (/var/db/filterlog/archive/<log>.<seq>.parquet), segments of closed logs are merged into a single file
+    (<log>.parquet). data not compacted yet (the tail of the current log) is parsed when querying, which
+    keeps the archive exact between compactor runs. logs unknown to the archive (first use, rotated or replaced logs)
+    are compacted before querying, so a query only has to parse what was written since the last compactor run.
+
+    requires duckdb_helper (/usr/local/opnsense/site-python) to be importable.
+"""
+import fcntl
+import glob
+import os
+import tempfile
+import ujson
+from duckdb_helper import DbConnection
+from .log import split_record, record_layout, record_rid, fields_general
+from .logindex import parse_timestamp
+
+
+class FilterLogArchive:
+    """ compact filter logs into parquet and expose them as a (duckdb) view named "filterlog"
+    """
+    archive_dir = '/var/db/filterlog/archive'
+    log_mask = '/var/log/filter/filter_*.log'
+    columns = [
+        ('time', 'BIGINT'),
+        ('interface', 'VARCHAR'),
+        ('action', 'VARCHAR'),
+        ('dir', 'VARCHAR'),
+        ('rid', 'VARCHAR'),
+        ('ipversion', 'TINYINT'),
+        ('protoname', 'VARCHAR'),
+        ('src', 'VARCHAR'),
+        ('dst', 'VARCHAR'),
+        ('srcport', 'INTEGER'),
+        ('dstport', 'INTEGER'),
+        ('length', 'INTEGER'),
+    ]
+
+    def __init__(self):
+        self._state_filename = '%s/state.json' % self.archive_dir
+        self._lock = None
+        self._state = dict()
+
+    def _open(self, exclusive):
+        """ lock and load archive state, shared for readers, exclusive for the compactor
+            :param exclusive: exclusive lock
+        """
+        if not os.path.isdir(self.archive_dir):
+            os.makedirs(self.archive_dir)
+        self._lock = open('%s/state.lock' % self.archive_dir, 'a+')
+        fcntl.flock(self._lock, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        self._state = dict()
+        if os.path.isfile(self._state_filename):
+            try:
+                with open(self._state_filename) as f_in:
+                    self._state = ujson.loads(f_in.read())
+            except ValueError:
+                self._state = dict()
+
+    def _close(self):
+        if self._lock is not None:
+            fcntl.flock(self._lock, fcntl.LOCK_UN)
+            self._lock.close()
+            self._lock = None
+
+    def _save_state(self):
+        with open('%s.tmp' % self._state_filename, 'w') as f_out:
+            f_out.write(ujson.dumps(self._state))
+        os.replace('%s.tmp' % self._state_filename, self._state_filename)
+
+    @staticmethod
+    def logs():
+        """
+            :return: list of filter logs, oldest first
+        """
+        return sorted(glob.glob(FilterLogArchive.log_mask))
+
+    def _write_rows(self, filename, offset, f_out):
+        """ extract columns from log lines starting at offset into tab separated output
+            :param filename: log filename
+            :param offset: byte offset to start at (start of a line)
+            :param f_out: output stream
+            :return: tuple (offset after the last complete line, number of rows written)
+        """
+        rows = 0
+        with open(filename, 'rb') as f_in:
+            f_in.seek(offset)
+            for raw in f_in:
+                if not raw.endswith(b'\n'):
+                    # incomplete line, collect next time
+                    break
+                offset += len(raw)
+                if raw.find(b'filterlog') == -1:
+                    continue
+                parts = split_record(raw.decode(errors='replace').strip().strip('\u0000'))
+                if parts is None or len(parts[2]) <= fields_general.index('action'):
+                    continue
+                fields = parts[2]
+                record = dict(zip(record_layout(fields), fields))
+                record['time'] = parse_timestamp(parts[0])
+                record['rid'] = record_rid(fields)
+                values = list()
+                for column, column_type in self.columns:
+                    value = record.get(column, '')
+                    if column_type != 'VARCHAR' and not str(value).isdigit():
+                        value = ''
+                    values.append(str(value).replace('\t', ' '))
+                f_out.write('\t'.join(values))
+                f_out.write('\n')
+                rows += 1
+        return offset, rows
+
+    def _read_csv(self, filename):
+        return "read_csv('%s', delim='\\t', header=false, nullstr='', quote='', escape='', columns={%s})" % (
+            filename, ', '.join(["'%s': '%s'" % x for x in self.columns])
+        )
+
+    def _compact(self, db, filename, closed):
+        """ compact new data in filename into a new segment, merge segments when the log is closed
+            :param db: duckdb connection
+            :param filename: log filename
+            :param closed: log is closed (no more data expected)
+            :return: number of rows added
+        """
+        basename = os.path.basename(filename)
+        inode = os.stat(filename).st_ino
+        state = self._state.get(basename, {})
+        if state.get('inode') != inode or state.get('offset', 0) > os.path.getsize(filename):
+            # new or replaced log
+            self._remove_segments(state)
+            state = {'inode': inode, 'offset': 0, 'segments': [], 'closed': False}
+        rows = 0
+        if os.path.getsize(filename) > state['offset']:
+            with tempfile.NamedTemporaryFile('w', dir=self.archive_dir, suffix='.tsv') as f_tmp:
+                offset, rows = self._write_rows(filename, state['offset'], f_tmp)
+                f_tmp.flush()
+                if rows > 0:
+                    segment = '%s.%04d.parquet' % (basename, len(state['segments']) + 1)
+                    db.connection.execute("COPY (SELECT * FROM %s ORDER BY time) TO '%s/%s' (%s)" % (
+                        self._read_csv(f_tmp.name), self.archive_dir, segment, "FORMAT PARQUET, COMPRESSION ZSTD"
+                    ))
+                    state['segments'].append(segment)
+                state['offset'] = offset
+        if closed and not state['closed']:
+            if len(state['segments']) > 1:
+                segment = '%s.parquet' % basename
+                db.connection.execute("COPY (SELECT * FROM %s ORDER BY time) TO '%s/%s.tmp' (%s)" % (
+                    self._parquet(state['segments']), self.archive_dir, segment, "FORMAT PARQUET, COMPRESSION ZSTD"
+                ))
+                os.replace('%s/%s.tmp' % (self.archive_dir, segment), '%s/%s' % (self.archive_dir, segment))
+                self._remove_segments(state, keep=[segment])
+                state['segments'] = [segment]
+            state['closed'] = True
+        self._state[basename] = state
+        return rows
+
+    def _parquet(self, segments):
+        return "read_parquet([%s])" % ', '.join(["'%s/%s'" % (self.archive_dir, x) for x in segments])
+
+    def _remove_segments(self, state, keep=()):
+        for segment in state.get('segments', []):
+            if segment not in keep and os.path.isfile('%s/%s' % (self.archive_dir, segment)):
+                os.remove('%s/%s' % (self.archive_dir, segment))
+
+    def compact(self):
+        """ compact all filter logs, remove archived data of logs no longer on disk
+            :return: dict with number of rows added per log
+        """
+        result = dict()
+        self._open(exclusive=True)
+        try:
+            logs = self.logs()
+            with DbConnection(':memory:', read_only=False) as db:
+                for idx, filename in enumerate(logs):
+                    result[os.path.basename(filename)] = self._compact(db, filename, idx < len(logs) - 1)
+            current = [os.path.basename(x) for x in logs]
+            for basename in list(self._state):
+                if basename not in current:
+                    self._remove_segments(self._state[basename])
+                    del self._state[basename]
+            self._save_state()
+        finally:
+            self._close()
+        return result
+
+    def _uncompacted(self):
+        """
+            :return: list of logs not (or no longer) known to the archive, which would need a full parse
+        """
+        result = list()
+        for filename in self.logs():
+            if self._state.get(os.path.basename(filename), {}).get('inode') != os.stat(filename).st_ino:
+                result.append(filename)
+        return result
+
+    def query(self, sql, params=None):
+        """ execute query against the archive, archived data and the log tail (not yet compacted) are available
+            as view "filterlog"
+            :param sql: query
+            :param params: query parameters
+            :return: tuple (column names, rows)
+        """
+        self._open(exclusive=False)
+        try:
+            pending = len(self._uncompacted()) > 0
+        finally:
+            self._close()
+        if pending:
+            # initial compaction, avoid parsing complete logs for every request until the compactor runs
+            self.compact()
+        self._open(exclusive=False)
+        try:
+            with DbConnection(':memory:', read_only=False) as db, \
+                    tempfile.NamedTemporaryFile('w', dir=self.archive_dir, suffix='.tsv') as f_tmp:
+                segments = list()
+                rows = 0
+                for filename in self.logs():
+                    state = self._state.get(os.path.basename(filename), {})
+                    offset = 0
+                    if state.get('inode') == os.stat(filename).st_ino:
+                        segments += state['segments']
+                        offset = state['offset']
+                    rows += self._write_rows(filename, offset, f_tmp)[1]
+                f_tmp.flush()
+                db.connection.execute("CREATE TABLE tail (%s)" % ', '.join(['%s %s' % x for x in self.columns]))
+                if rows > 0:
+                    db.connection.execute("INSERT INTO tail SELECT * FROM %s" % self._read_csv(f_tmp.name))
+                sources = ["SELECT * FROM tail"]
+                if len(segments) > 0:
+                    sources.append("SELECT * FROM %s" % self._parquet(segments))
+                db.connection.execute("CREATE VIEW filterlog AS %s" % " UNION ALL ".join(sources))
+                cursor = db.connection.execute(sql, params if params is not None else [])
+                return [x[0] for x in cursor.description], cursor.fetchall()
+        finally:
+            self._close()
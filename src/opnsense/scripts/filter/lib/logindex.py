@@ -0,0 +1,272 @@
+"""
+    Copyright (c) 2017-2023 Ad Schellevis <ad@opnsense.org>
+    All rights reserved.
+
+    Redistribution and use in source and binary forms, with or without
+    modification, are permitted provided that the following conditions are met:
+
+    1. Redistributions of source code must retain the above copyright notice,
+     this list of conditions and the following disclaimer.
+
+    2. Redistributions in binary form must reproduce the above copyright
+     notice, this list of conditions and the following disclaimer in the
+     documentation and/or other materials provided with the distribution.
+
+    THIS SOFTWARE IS PROVIDED ``AS IS'' AND ANY EXPRESS OR IMPLIED WARRANTIES,
+    INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY
+    AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+    AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY,
+    OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+    SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+    INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+    CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+    ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+    POSSIBILITY OF SUCH DAMAGE.
+
+    --------------------------------------------------------------------------------------
+    sidecar index for (rotated) filter logs, an index file per log stored in /var/db/filterlog which is
+    updated incrementally (only new data appended to the log is parsed).
+
+    file layout, all integers in native byte order (validated using the byte order marker):
+        header          magic, version, byte order marker, inode of the log, number of bytes and records indexed
+        records         one per filterlog line (in log order) containing: offset and length of the line,
+                        timestamp, first 8 bytes of the digest (md5 of the line) and a crc32 of the rule id,
+                        interface and action to select lines without parsing them
+"""
+import datetime
+import fcntl
+import glob
+import mmap
+import os
+import struct
+import time
+import zlib
+from functools import lru_cache
+from hashlib import md5
+from .log import split_record, record_rid, fields_general
+
+
+@lru_cache(maxsize=4096)
+def parse_timestamp(timestamp):
+    """ convert log timestamp to unix time
+        :param timestamp: rfc5424 (iso) or rfc3164 formatted timestamp
+        :return: int, 0 when not parseable
+    """
+    try:
+        return int(datetime.datetime.fromisoformat(timestamp).timestamp())
+    except ValueError:
+        pass
+    try:
+        # rfc3164 lacks the year, assume the current one
+        return int(time.mktime(time.strptime('%d %s' % (time.localtime().tm_year, timestamp), '%Y %b %d %H:%M:%S')))
+    except ValueError:
+        return 0
+
+
+def field_hash(value):
+    return zlib.crc32(value.encode())
+
+
+class FilterLogIndex:
+    """ index for a single filter log, updated on open
+    """
+    magic = b'FLOGIDX\0'
+    version = 1
+    byte_order_marker = 0x01020304
+    header = struct.Struct('=8sIIQQQ')
+    record = struct.Struct('=QII8sIII')
+    index_dir = '/var/db/filterlog'
+    read_size = 1048576
+
+    def __init__(self, filename):
+        """ open (and update) index for log filename
+            :param filename: log filename
+        """
+        self._filename = filename
+        self._index_filename = '%s/%s.idx' % (self.index_dir, os.path.basename(filename))
+        self._log = open(filename, 'rb')
+        self._records = None
+        self._count = 0
+        self.update()
+
+    @classmethod
+    def cleanup(cls, filenames):
+        """ remove index files for logs no longer on disk
+            :param filenames: current log filenames
+            :return: None
+        """
+        current = set(['%s.idx' % os.path.basename(x) for x in filenames])
+        for filename in glob.glob('%s/*.idx' % cls.index_dir):
+            if os.path.basename(filename) not in current:
+                os.remove(filename)
+
+    def _index_lines(self, offset, f_out):
+        """ index all complete lines in the log starting at offset
+            :param offset: byte offset to start at
+            :param f_out: index file handle, positioned at the end
+            :return: tuple (offset up to where the log is indexed, number of records added)
+        """
+        added = 0
+        self._log.seek(offset)
+        data = b''
+        while True:
+            chunk = self._log.read(self.read_size)
+            if not chunk:
+                break
+            data += chunk
+            records = list()
+            eol = data.rfind(b'\n')
+            pos = 0
+            while pos <= eol:
+                line_end = data.find(b'\n', pos)
+                raw = data[pos:line_end]
+                if raw.find(b'filterlog') > -1:
+                    line = raw.decode(errors='replace').strip().strip('\u0000')
+                    parts = split_record(line)
+                    if parts is not None and len(parts[2]) > fields_general.index('action'):
+                        fields = parts[2]
+                        records.append(self.record.pack(
+                            offset + pos,
+                            len(raw),
+                            parse_timestamp(parts[0]),
+                            md5(line.encode()).digest()[:8],
+                            field_hash(record_rid(fields)),
+                            field_hash(fields[4]),
+                            field_hash(fields[6])
+                        ))
+                pos = line_end + 1
+            f_out.write(b''.join(records))
+            added += len(records)
+            offset += pos
+            data = data[pos:]
+        return offset, added
+
+    @classmethod
+    def _read_header(cls, index_filename, fstat):
+        """ read index header, validate it belongs to the current log
+            :param index_filename: index filename
+            :param fstat: stat result of the log
+            :return: tuple (bytes indexed, number of records) or None when invalid
+        """
+        if os.path.isfile(index_filename):
+            with open(index_filename, 'rb') as f_in:
+                hdr = f_in.read(cls.header.size)
+            if len(hdr) == cls.header.size:
+                magic, version, marker, inode, indexed, count = cls.header.unpack(hdr)
+                if (magic, version, marker, inode) == (cls.magic, cls.version, cls.byte_order_marker, fstat.st_ino) \
+                        and indexed <= fstat.st_size:
+                    return indexed, count
+        return None
+
+    @classmethod
+    def available(cls, filename):
+        """ check if a valid index exists for log filename, opening it only needs to index appended data
+            :param filename: log filename
+            :return: bool
+        """
+        try:
+            fstat = os.stat(filename)
+        except OSError:
+            return False
+        return cls._read_header('%s/%s.idx' % (cls.index_dir, os.path.basename(filename)), fstat) is not None
+
+    def update(self):
+        """ index data appended to the log since the last update, rebuild when the log was replaced or truncated
+            :return: None
+        """
+        self._release()
+        if not os.path.isdir(self.index_dir):
+            os.makedirs(self.index_dir)
+        # serialize updates between processes using a lock on the log itself
+        fcntl.flock(self._log, fcntl.LOCK_EX)
+        try:
+            fstat = os.fstat(self._log.fileno())
+            current = self._read_header(self._index_filename, fstat)
+            if current is None:
+                # (re)build into a new file, readers of the previous index keep their copy
+                with open('%s.tmp' % self._index_filename, 'wb') as f_out:
+                    f_out.write(bytes(self.header.size))
+                    indexed, count = self._index_lines(0, f_out)
+                    f_out.seek(0)
+                    f_out.write(self.header.pack(
+                        self.magic, self.version, self.byte_order_marker, fstat.st_ino, indexed, count
+                    ))
+                os.replace('%s.tmp' % self._index_filename, self._index_filename)
+            elif current[0] < fstat.st_size:
+                # append only, readers only use the records registered when they opened the index
+                with open(self._index_filename, 'r+b') as f_out:
+                    # drop records not registered in the header (interrupted update)
+                    f_out.truncate(self.header.size + current[1] * self.record.size)
+                    f_out.seek(0, os.SEEK_END)
+                    indexed, added = self._index_lines(current[0], f_out)
+                    count = current[1] + added
+                    f_out.flush()
+                    f_out.seek(0)
+                    f_out.write(self.header.pack(
+                        self.magic, self.version, self.byte_order_marker, fstat.st_ino, indexed, count
+                    ))
+            else:
+                count = current[1]
+        finally:
+            fcntl.flock(self._log, fcntl.LOCK_UN)
+        self._count = count
+        with open(self._index_filename, 'rb') as f_in:
+            self._records = mmap.mmap(f_in.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _release(self):
+        if self._records is not None:
+            self._records.close()
+            self._records = None
+
+    def __len__(self):
+        return self._count
+
+    def find_digest(self, digest):
+        """ find the (last) record with the provided digest
+            :param digest: md5 digest (hex)
+            :return: record number or None when not found
+        """
+        try:
+            needle = bytes.fromhex(digest)[:8]
+        except ValueError:
+            return None
+        if len(needle) != 8:
+            return None
+        digest_pos = self.header.size + struct.calcsize('=QII')
+        pos = self.header.size + len(self) * self.record.size
+        while True:
+            pos = self._records.rfind(needle, self.header.size, pos)
+            if pos == -1:
+                return None
+            elif (pos - digest_pos) % self.record.size == 0:
+                return (pos - digest_pos) // self.record.size
+            pos += len(needle) - 1
+
+    def lines(self, digest=None, since=None, rid=None, interface=None, action=None):
+        """ iterate log lines newest first, using the index to select lines
+            :param digest: stop after the line with this digest (md5 hex) when found, the line itself is always
+                           returned (even when not selected) so callers can detect the end of new data
+            :param since: stop at lines older than this unix timestamp
+            :param rid: only lines for this rule id
+            :param interface: only lines for this interface
+            :param action: only lines with this action
+            :return: iterator of lines (may include hash collisions, callers should validate the parsed record)
+        """
+        last = self.find_digest(digest) if digest else None
+        selectors = [
+            (4, field_hash(rid) if rid else None),
+            (5, field_hash(interface) if interface else None),
+            (6, field_hash(action) if action else None)
+        ]
+        selectors = [x for x in selectors if x[1] is not None]
+        for idx in range(len(self) - 1, -1 if last is None else last - 1, -1):
+            record = self.record.unpack_from(self._records, self.header.size + idx * self.record.size)
+            if since is not None and 0 < record[2] < since:
+                break
+            if idx == last or all(record[x[0]] == x[1] for x in selectors):
+                self._log.seek(record[0])
+                yield self._log.read(record[1]).decode(errors='replace').strip().strip('\u0000')
+
+    def close(self):
+        self._release()
+        self._log.close()
@@ -0,0 +1,247 @@
+"""
+    Copyright (c) 2024 Ad Schellevis <ad@opnsense.org>
+    All rights reserved.
+
+    Redistribution and use in source and binary forms, with or without
+    modification, are permitted provided that the following conditions are met:
+
+    1. Redistributions of source code must retain the above copyright notice,
+     this list of conditions and the following disclaimer.
+
+    2. Redistributions in binary form must reproduce the above copyright
+     notice, this list of conditions and the following disclaimer in the
+     documentation and/or other materials provided with the distribution.
+
+    THIS SOFTWARE IS PROVIDED ``AS IS'' AND ANY EXPRESS OR IMPLIED WARRANTIES,
+    INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY
+    AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+    AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY,
+    OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+    SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+    INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+    CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+    ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+    POSSIBILITY OF SUCH DAMAGE.
+
+    --------------------------------------------------------------------------------------
+    compiled rule metadata of the loaded ruleset, shared by the filter scripts (states, logs, rule ids).
+    The cache is rebuilt when /tmp/rules.debug changes, readers only validate the header and map the file.
+
+    file layout, all integers in native byte order (validated using the byte order marker):
+        header          magic, version, byte order marker, mtime (ns), size and inode of rules.debug,
+                        number of pf rules and labels
+        pf rules        sorted by pf rule number (as string): offset and length of the number, label index
+        labels          sorted by label (rule id): offset and length of the label and its description, line number
+                        in rules.debug (0 when not found)
+        strings         utf-8 encoded strings referenced by the tables above
+"""
+import fcntl
+import mmap
+import os
+import struct
+import subprocess
+
+
+class RuleCache:
+    """ rule id (label) -> description and pf rule number -> rule id mapping of the running ruleset
+    """
+    magic = b'RULEMAP\0'
+    version = 2
+    byte_order_marker = 0x01020304
+    header = struct.Struct('=8sIIQQQII')
+    rule_entry = struct.Struct('=III')
+    label_entry = struct.Struct('=IIIII')
+    no_descr = 0xffffffff
+    rules_filename = '/tmp/rules.debug'
+    cache_filename = '/tmp/cache_rule_labels.bin'
+    _current = None
+
+    def __init__(self, filename):
+        """ open (memory mapped) cache file
+            :param filename: cache filename
+        """
+        with open(filename, 'rb') as f_in:
+            self._data = mmap.mmap(f_in.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self._data) < self.header.size:
+            raise ValueError('invalid rule cache %s' % filename)
+        magic, version, marker, mtime, size, inode, self._rule_count, self._label_count = \
+            self.header.unpack_from(self._data, 0)
+        if (magic, version, marker) != (self.magic, self.version, self.byte_order_marker):
+            raise ValueError('invalid rule cache %s' % filename)
+        self.source = (mtime, size, inode)
+        self._labels_offset = self.header.size + self._rule_count * self.rule_entry.size
+        self._strings_offset = self._labels_offset + self._label_count * self.label_entry.size
+        if len(self._data) < self._strings_offset:
+            raise ValueError('truncated rule cache %s' % filename)
+
+    @classmethod
+    def source_of(cls):
+        """
+            :return: tuple (mtime, size, inode) identifying the current rules.debug, zeros when not found
+        """
+        try:
+            fstat = os.stat(cls.rules_filename)
+            return fstat.st_mtime_ns, fstat.st_size, fstat.st_ino
+        except OSError:
+            return 0, 0, 0
+
+    @classmethod
+    def open(cls):
+        """ open the cache of the running ruleset, compile it when outdated.
+            The instance is kept and reused as long as rules.debug doesn't change.
+            :return: RuleCache
+        """
+        source = cls.source_of()
+        if cls._current is not None and cls._current.source == source:
+            return cls._current
+        cache = cls._open_cache(source)
+        if cache is None:
+            with open('%s.lock' % cls.cache_filename, 'a+') as lock_handle:
+                fcntl.flock(lock_handle, fcntl.LOCK_EX)
+                # another process might have compiled the cache while we were waiting
+                cache = cls._open_cache(source)
+                if cache is None:
+                    cls.compile(source)
+                    cache = cls._open_cache(source)
+        cls._current = cache
+        return cache
+
+    @classmethod
+    def _open_cache(cls, source):
+        """
+            :param source: expected source (see source_of())
+            :return: RuleCache or None when not available or outdated
+        """
+        try:
+            cache = cls(cls.cache_filename)
+        except (ValueError, OSError):
+            return None
+        return cache if cache.source == source else None
+
+    @classmethod
+    def compile(cls, source):
+        """ compile rule metadata from rules.debug and the loaded pf ruleset
+            :param source: source identification (see source_of())
+            :return: None
+        """
+        descriptions = dict()
+        line_numbers = dict()
+        # query descriptions from active ruleset so we can search and display rule descriptions as well.
+        if os.path.isfile(cls.rules_filename):
+            with open(cls.rules_filename, "rt", encoding="utf-8") as f_in:
+                for line_number, line in enumerate(f_in, 1):
+                    if line.find(' label ') > -1:
+                        lbl = line.split(' label ')[-1]
+                        if lbl.count('"') >= 2:
+                            descriptions[lbl.split('"')[1]] = ''.join(lbl.split('"')[2:]).strip().strip('# : ')
+                            line_numbers.setdefault(lbl.split('"')[1], line_number)
+
+        rules = dict()
+        try:
+            output = subprocess.run(['/sbin/pfctl', '-vvPsr'], capture_output=True, text=True).stdout
+        except OSError:
+            # pf not available, only descriptions
+            output = ''
+        for line in output.strip().split('\n'):
+            if line.startswith('@') and line.find(' label ') > -1:
+                rules[line.split()[0][1:]] = ''.join(line.split(' label ')[-1:]).strip()[1:].split('"')[0]
+
+        labels = sorted(set(descriptions) | set(rules.values()), key=lambda x: x.encode())
+        label_idx = {label: idx for idx, label in enumerate(labels)}
+        strings = bytearray()
+
+        def add_string(value):
+            offset = len(strings)
+            strings.extend(value.encode())
+            return offset, len(strings) - offset
+
+        rule_table = list()
+        for rulenr in sorted(rules, key=lambda x: x.encode()):
+            rule_table.append(cls.rule_entry.pack(*add_string(rulenr), label_idx[rules[rulenr]]))
+        label_table = list()
+        for label in labels:
+            if label in descriptions:
+                descr = add_string(descriptions[label])
+            else:
+                descr = (0, cls.no_descr)
+            label_table.append(cls.label_entry.pack(*add_string(label), *descr, line_numbers.get(label, 0)))
+
+        # write into a new file, readers of the previous version keep their copy
+        with open('%s.tmp' % cls.cache_filename, 'wb') as f_out:
+            f_out.write(cls.header.pack(
+                cls.magic, cls.version, cls.byte_order_marker, *source, len(rule_table), len(label_table)
+            ))
+            f_out.write(b''.join(rule_table))
+            f_out.write(b''.join(label_table))
+            f_out.write(strings)
+        os.replace('%s.tmp' % cls.cache_filename, cls.cache_filename)
+
+    def _string(self, offset, length):
+        start = self._strings_offset + offset
+        return self._data[start:start + length].decode()
+
+    def _label(self, idx):
+        """
+            :param idx: label index
+            :return: tuple (label, description or None when not in rules.debug, line number in rules.debug)
+        """
+        rid_offset, rid_len, descr_offset, descr_len, line = self.label_entry.unpack_from(
+            self._data, self._labels_offset + idx * self.label_entry.size
+        )
+        descr = self._string(descr_offset, descr_len) if descr_len != self.no_descr else None
+        return self._string(rid_offset, rid_len), descr, line
+
+    def _search(self, key, offset, count, entry):
+        """ binary search sorted table, the first two fields of an entry reference the key string
+            :return: unpacked entry or None when not found
+        """
+        key = key.encode()
+        low, high = 0, count
+        while low < high:
+            mid = (low + high) // 2
+            record = entry.unpack_from(self._data, offset + mid * entry.size)
+            start = self._strings_offset + record[0]
+            value = self._data[start:start + record[1]]
+            if value < key:
+                low = mid + 1
+            elif value > key:
+                high = mid
+            else:
+                return record
+        return None
+
+    def rule(self, rulenr):
+        """ lookup pf rule number
+            :param rulenr: pf rule number (as reported by pfctl and filterlog)
+            :return: tuple (rule id, description, line number) or None when not found
+        """
+        record = self._search(str(rulenr), self.header.size, self._rule_count, self.rule_entry)
+        return self._label(record[2]) if record is not None else None
+
+    def descr(self, rid, default=None):
+        """ lookup description for rule id (label)
+            :param rid: rule id
+            :param default: value to return when not found or without description
+            :return: string
+        """
+        record = self._search(rid, self._labels_offset, self._label_count, self.label_entry)
+        if record is None or record[3] == self.no_descr:
+            return default
+        return self._string(record[2], record[3])
+
+    def rules(self):
+        """
+            :return: iterator of tuples (pf rule number, rule id, description, line number)
+        """
+        for idx in range(self._rule_count):
+            key_offset, key_len, label_idx = self.rule_entry.unpack_from(
+                self._data, self.header.size + idx * self.rule_entry.size
+            )
+            yield (self._string(key_offset, key_len),) + self._label(label_idx)
+
+    def labels(self):
+        """
+            :return: iterator of tuples (rule id, description, line number)
+        """
+        for idx in range(self._label_count):
+            yield self._label(idx)
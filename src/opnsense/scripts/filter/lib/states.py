@@ -24,40 +24,33 @@
     POSSIBILITY OF SUCH DAMAGE.
 
 """
-import fcntl
+import heapq
 import ipaddress
-import os
 import subprocess
-import ujson
+from functools import lru_cache
+from .rulecache import RuleCache
+
+
+@lru_cache(maxsize=65536)
+def split_ip_port(addr):
+    """ split pf address notation (1.2.3.4:80 or 2001:db8::1[80]) into its components
+        :param addr: address as reported by pfctl or pftop
+        :return: tuple (address, port, ipproto)
+    """
+    if addr.count(':') > 1:
+        # parse IPv6 address
+        tmp = addr.split('[')
+        return tmp[0], tmp[1].split(']')[0] if len(tmp) > 1 else '0', 'ipv6'
+    else:
+        # parse IPv4 address
+        tmp = addr.split(':')
+        return tmp[0], tmp[1] if len(tmp) > 1 else '0', 'ipv4'
 
 
 class AddressParser:
     def __init__(self):
-        self._addresses = {}
         self._in_network = {}
 
-    def split_ip_port(self, addr):
-        if addr not in self._addresses:
-            self._addresses[addr] = {
-                'port': '0'
-            }
-            if addr.count(':') > 1:
-                # parse IPv6 address
-                tmp = addr.split('[')
-                self._addresses[addr]['addr'] = tmp[0]
-                self._addresses[addr]['ipproto'] = 'ipv6'
-                if addr.find('[') > -1:
-                    self._addresses[addr]['port'] = tmp[1].split(']')[0]
-            else:
-                # parse IPv4 address
-                tmp = addr.split(':')
-                self._addresses[addr]['ipproto'] = 'ipv4'
-                self._addresses[addr]['addr'] = tmp[0]
-                if len(tmp) > 1:
-                    self._addresses[addr]['port'] = tmp[1]
-
-        return self._addresses[addr]
-
     def overlaps(self, net, addr: str):
         if net not in self._in_network:
             self._in_network[net] = {}
@@ -67,49 +60,159 @@ class AddressParser:
         return self._in_network[net][addr]
 
 
+class StateRecord:
+    """ compact pf state, only converted into a dict when it's being returned to the caller.
+        optional attributes (None) are omitted from the dict to stay compatible with the previous output
+    """
+    __slots__ = (
+        'label', 'descr', 'nat_addr', 'nat_port', 'gateway', 'iface', 'proto', 'ipproto', 'flags', 'direction',
+        'dst_addr', 'dst_port', 'src_addr', 'src_port', 'state', 'age', 'expires', 'pkts', 'bytes', 'rule', 'id',
+        'route_to', 'dup_to', 'reply_to', 'rtable'
+    )
+    _required = ('label', 'descr', 'nat_addr', 'nat_port', 'gateway')
+    _keys = {'route_to': 'route-to', 'dup_to': 'dup-to', 'reply_to': 'reply-to'}
+
+    def __init__(self, parts):
+        """ parse state header line, e.g. : all tcp 10.0.0.1:22 <- 10.0.0.2:51234 ESTABLISHED:ESTABLISHED
+            :param parts: header line split into parts
+        """
+        self.label = ''
+        self.descr = ''
+        self.nat_addr = None
+        self.nat_port = None
+        self.gateway = None
+        self.iface = parts[0]
+        self.proto = parts[1]
+        self.flags = []
+        self.age = self.expires = self.pkts = self.bytes = self.rule = self.id = None
+        self.route_to = self.dup_to = self.reply_to = self.rtable = None
+        if parts[3].find('(') > -1:
+            # NAT enabled
+            self.nat_addr, nat_port, _ = split_ip_port(parts[3][1:-1])
+            if nat_port != '0':
+                self.nat_port = nat_port
+
+        addr1, port1, self.ipproto = split_ip_port(parts[2])
+        addr2, port2, _ = split_ip_port(parts[-2])
+        if parts[-3] == '->':
+            self.direction = 'out'
+            self.src_addr, self.src_port, self.dst_addr, self.dst_port = addr1, port1, addr2, port2
+        else:
+            self.direction = 'in'
+            self.src_addr, self.src_port, self.dst_addr, self.dst_port = addr2, port2, addr1, port1
+        self.state = parts[-1]
+
+    def __getitem__(self, key):
+        """ dict style access using the output field names (e.g. src_addr, route-to)
+        """
+        attr = key.replace('-', '_')
+        if attr in self.__slots__:
+            value = getattr(self, attr)
+            if value is not None or attr in self._required:
+                return value
+        raise KeyError(key)
+
+    def __contains__(self, key):
+        try:
+            self[key]
+            return True
+        except KeyError:
+            return False
+
+    def as_dict(self):
+        """
+            :return: dict
+        """
+        result = {}
+        for attr in self.__slots__:
+            value = getattr(self, attr)
+            if value is not None or attr in self._required:
+                result[self._keys.get(attr, attr)] = value
+        return result
+
+
+class TopRecord:
+    """ compact pftop record
+    """
+    __slots__ = (
+        'proto', 'dir', 'src_addr', 'src_port', 'dst_addr', 'dst_port', 'gw_addr', 'gw_port', 'state', 'age',
+        'expire', 'pkts', 'bytes', 'avg', 'rule'
+    )
+    _pows = {'K': 1, 'M': 2, 'G': 3}
+    _time_marks = {'m': 60, 'h': 3600, 'd': 86400}
+
+    def __init__(self, parts):
+        """ parse pftop line, e.g. : tcp In 10.0.0.2:51234 10.0.0.1:22 ESTABLISHED:ESTABLISHED 00:01:02 ...
+            :param parts: line split into parts
+        """
+        self.proto = parts[0]
+        self.dir = parts[1].lower()
+        self.src_addr, self.src_port, _ = split_ip_port(parts[2])
+        self.dst_addr, self.dst_port, _ = split_ip_port(parts[3])
+        if parts[4].count(':') > 2 or parts[4].count('.') > 2:
+            self.gw_addr, self.gw_port, _ = split_ip_port(parts[4])
+            idx = 5
+        else:
+            self.gw_addr = self.gw_port = None
+            idx = 4
+        self.state = parts[idx]
+        self.age = self.parse_time(parts[idx+1])
+        self.expire = self.parse_time(parts[idx+2])
+        self.pkts = int(parts[idx+3]) if parts[idx+3].isdigit() else 0
+        if parts[idx+4].isdigit():
+            self.bytes = int(parts[idx+4])
+        elif parts[idx+4][:-1].isdigit() and parts[idx+4][-1] in self._pows:
+            self.bytes = int(parts[idx+4][:-1])*pow(1024, self._pows[parts[idx+4][-1]])
+        else:
+            self.bytes = 0
+        self.avg = int(parts[idx+5]) if parts[idx+5].isdigit() else 0
+        self.rule = parts[idx+6]
+
+    @classmethod
+    def parse_time(cls, value):
+        """ convert pftop time notation (hh:mm:ss, seconds or 1m, 2h, 3d) to seconds
+            :param value: time as reported by pftop
+            :return: int
+        """
+        if ':' in value:
+            tmp = value.split(':')
+            return int(tmp[0]) * 3600 + int(tmp[1]) * 60 + int(tmp[2]) if len(tmp) > 2 else 0
+        elif value.isdigit():
+            return int(value)
+        elif value[-1] in cls._time_marks and value[:-1].isdigit():
+            return int(value[:-1])*cls._time_marks[value[-1]]
+        return 0
+
+    def as_dict(self):
+        """
+            :return: dict
+        """
+        return {attr: getattr(self, attr) for attr in self.__slots__}
+
+
+def command_output(cmd):
+    """ stream the output of a command line by line without buffering it as a whole,
+        the process is killed when the consumer stops reading early.
+        :param cmd: command as list
+        :return: iterator
+    """
+    with subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True) as sp:
+        try:
+            yield from sp.stdout
+        finally:
+            if sp.poll() is None:
+                sp.kill()
+
+
 def fetch_rule_labels():
     """ Generate dict with labels per rule.
-        Since the output is directly related to the rules loaded by /tmp/rules.debug, we can safely cache the results
-        (into /tmp/cache_rule_labels.json) until /tmp/rules.debug changes.
-        :return: dict
+        Since the output is directly related to the rules loaded by /tmp/rules.debug, the (compiled) results are
+        cached until /tmp/rules.debug changes (see RuleCache).
+        :return: dict pf rule number => rule id, description and line number in rules.debug
     """
-    pf_rules_file = '/tmp/rules.debug'
-    fhandle = open('/tmp/cache_rule_labels.json', 'a+')
-    try:
-        fhandle.seek(0)
-        cached_labels = ujson.loads(fhandle.read())
-    except ValueError:
-        cached_labels = {'labels': {}}
-
-    pfr_mtime = os.stat(pf_rules_file).st_mtime if os.path.isfile(pf_rules_file) else 0
-    if cached_labels.get('mtime', 0) != pfr_mtime or cached_labels.get('labels', None) is None:
-        descriptions = dict()
-        # query descriptions from active ruleset so we can search and display rule descriptions as well.
-        if os.path.isfile(pf_rules_file):
-            with open(pf_rules_file, "rt", encoding="utf-8") as f_in:
-                for line in f_in:
-                    lbl = line.split(' label ')[-1] if line.find(' label ') > -1 else ""
-                    rule_label = lbl.split('"')[1] if lbl.count('"') >= 2 else None
-                    descriptions[rule_label] = ''.join(lbl.split('"')[2:]).strip().strip('# : ')
-
-        sp = subprocess.run(['/sbin/pfctl', '-vvPsr'], capture_output=True, text=True)
-        for line in sp.stdout.strip().split('\n'):
-            if line.startswith('@'):
-                line_id = line.split()[0][1:]
-                if line.find(' label ') > -1:
-                    rid = ''.join(line.split(' label ')[-1:]).strip()[1:].split('"')[0]
-                    cached_labels['labels'][line_id] = {'rid': rid, 'descr': None}
-                    if rid in descriptions:
-                        cached_labels['labels'][line_id]['descr'] = descriptions[rid]
-
-        fcntl.flock(fhandle, fcntl.LOCK_EX)
-        cached_labels['mtime'] = pfr_mtime
-        fhandle.seek(0)
-        fhandle.truncate()
-        fhandle.write(ujson.dumps(cached_labels))
-        fhandle.close()
-
-    return cached_labels['labels']
+    return {
+        rulenr: {'rid': rid, 'descr': descr, 'line': line} for rulenr, rid, descr, line in RuleCache.open().rules()
+    }
 
 
 def split_filter_clauses(filter_str):
@@ -121,7 +224,7 @@ def split_filter_clauses(filter_str):
             filter_port = None
             if addr.startswith('[') and addr.count(']') == 1:
                 filter_port = addr.split(']')[1].split(':')[1] if addr.split(']')[1].count(':') == 1 else None
-                addr = addr.split(']')[0]
+                addr = addr.split(']')[0][1:]
             elif addr.count(':') == 1:
                 filter_port = addr.split(':')[1]
                 addr = addr.split(':')[0]
@@ -132,190 +235,157 @@ def split_filter_clauses(filter_str):
     return (filter_net_clauses, filter_clauses)
 
 
-
-def query_states(rule_label, filter_str):
+def iter_states(rule_label='', filter_str='', lines=None, rule_labels=None):
+    """ stream pf states, parsed incrementally from the output of pfctl -vvs state.
+        Filtering happens per state as soon as it's complete, only matching states are yielded.
+        :param rule_label: label / rule id to search for
+        :param filter_str: filter (addresses, networks with optional port and search terms)
+        :param lines: iterable with pfctl -vvs state formatted lines, default reads from pfctl
+        :param rule_labels: rule labels as provided by fetch_rule_labels()
+        :return: iterator of StateRecord
+    """
     addr_parser = AddressParser()
-
-    result = list()
     filter_net_clauses, filter_clauses = split_filter_clauses(filter_str)
-
-    rule_labels = fetch_rule_labels()
-    lines = subprocess.run(['/sbin/pfctl', '-vvs', 'state'], capture_output=True, text=True).stdout.strip().split('\n')
+    rule_labels = fetch_rule_labels() if rule_labels is None else rule_labels
+    lines = command_output(['/sbin/pfctl', '-vvs', 'state']) if lines is None else lines
+    port_fields = {'src_addr': 'src_port', 'dst_addr': 'dst_port', 'nat_addr': 'nat_port'}
     record = None
     for line in lines:
+        if not line.startswith(" "):
+            parts = line.split()
+            record = StateRecord(parts) if len(parts) >= 6 else None
+            continue
+        elif record is None:
+            continue
         parts = line.split()
-        if line.startswith(" ") and len(parts) > 1 and record:
-            if parts[0] == 'age':
-                for part in line.split(","):
-                    part = part.strip()
-                    if part.startswith("rule "):
-                        record["rule"] = part.split()[-1]
-                        if record["rule"] in rule_labels:
-                            record["label"] = rule_labels[record["rule"]]["rid"]
-                            record["descr"] = rule_labels[record["rule"]]["descr"]
-                    elif part.startswith("age "):
-                        record["age"] = part.split()[-1]
-                    elif part.startswith("expires in"):
-                        record["expires"] = part.split()[-1]
-                    elif part.endswith("pkts"):
-                        record["pkts"] = [int(s) for s in part.split()[0].split(':')]
-                    elif part.endswith("bytes"):
-                        record["bytes"] = [int(s) for s in part.split()[0].split(':')]
-                    elif part in [
-                        'allow-opts', 'sloppy', 'no-sync', 'psync-ack', 'no-df', 'random-id', 'reassemble-tcp'
-                    ]:
-                        record["flags"].append(part)
-            elif parts[0] == "id:":
-                # XXX: in order to kill a state, we need to pass both the id and the creator, so it seeems to make
-                #      sense to uniquely identify the state by the combined number
-                record["id"] = "%s/%s" % (parts[1], parts[3])
-                if len(parts) > 5:
-                    # gateway, route-to, dup-to, reply-to option
-                    rt = parts[4].rstrip(':')
-                    if rt in ['route-to', 'dup-to', 'reply-to', 'gateway']:
-                        record[rt] = parts[5]
-                        if len(parts) > 7 and parts[7].isdigit():
-                            record['rtable'] = int(parts[7])
-                    elif rt == 'rtable' and  parts[5].isdigit():
-                        record['rtable'] = int(parts[5])
-            if rule_label != "" and record['label'].lower().find(rule_label) == -1:
-                # label
+        if len(parts) < 2:
+            continue
+        elif parts[0] == 'age':
+            for part in line.split(","):
+                part = part.strip()
+                if part.startswith("rule "):
+                    record.rule = part.split()[-1]
+                    if record.rule in rule_labels:
+                        record.label = rule_labels[record.rule]["rid"]
+                        record.descr = rule_labels[record.rule]["descr"]
+                elif part.startswith("age "):
+                    record.age = part.split()[-1]
+                elif part.startswith("expires in"):
+                    record.expires = part.split()[-1]
+                elif part.endswith("pkts"):
+                    record.pkts = [int(s) for s in part.split()[0].split(':')]
+                elif part.endswith("bytes"):
+                    record.bytes = [int(s) for s in part.split()[0].split(':')]
+                elif part in [
+                    'allow-opts', 'sloppy', 'no-sync', 'psync-ack', 'no-df', 'random-id', 'reassemble-tcp'
+                ]:
+                    record.flags.append(part)
+            if rule_label != "" and record.label.lower().find(rule_label) == -1:
+                # label doesn't match, skip the remainder of this state
+                record = None
+        elif parts[0] == "id:":
+            # XXX: in order to kill a state, we need to pass both the id and the creator, so it seeems to make
+            #      sense to uniquely identify the state by the combined number
+            record.id = "%s/%s" % (parts[1], parts[3])
+            if len(parts) > 5:
+                # gateway, route-to, dup-to, reply-to option
+                rt = parts[4].rstrip(':')
+                if rt in ['route-to', 'dup-to', 'reply-to', 'gateway']:
+                    setattr(record, rt.replace('-', '_'), parts[5])
+                    if len(parts) > 7 and parts[7].isdigit():
+                        record.rtable = int(parts[7])
+                elif rt == 'rtable' and parts[5].isdigit():
+                    record.rtable = int(parts[5])
+            # the id line completes the state, no need to inspect the remaining lines
+            state, record = record, None
+            if rule_label != "" and state.label.lower().find(rule_label) == -1:
+                continue
+            match = True
+            for filter_net in filter_net_clauses:
+                try:
+                    match = False
+                    for field in ['src_addr', 'dst_addr', 'nat_addr', 'gateway']:
+                        addr = getattr(state, field)
+                        if addr is not None and addr_parser.overlaps(filter_net[0], addr):
+                            if filter_net[1] is None or filter_net[1] == getattr(state, port_fields[field]):
+                                match = True
+                    if not match:
+                        break
+                except:
+                    continue
+            if not match:
                 continue
-            elif parts[0] == "id:" and (filter_clauses or filter_net_clauses):
-                match = False
-                for filter_net in filter_net_clauses:
-                    try:
-                        match = False
-                        for field in ['src_addr', 'dst_addr', 'nat_addr', 'gateway']:
-                            port_field = "%s_port" % field[0:3]
-                            if record[field] is not None and addr_parser.overlaps(filter_net[0], record[field]):
-                                if filter_net[1] is None or filter_net[1] == record[port_field]:
-                                    match = True
-                        if not match:
-                            break
-                    except:
-                        continue
-                if not match:
+
+            if filter_clauses:
+                search_line = " ".join(str(item) for item in filter(None, state.as_dict().values()))
+                if not all(search_line.find(filter_clause) > -1 for filter_clause in filter_clauses):
                     continue
 
-                if filter_clauses:
-                    search_line = " ".join(str(item) for item in filter(None, record.values()))
-                    for filter_clause in filter_clauses:
-                        if search_line.find(filter_clause) == -1:
-                            match = False
-                            break
-                    if not match:
-                        continue
-
-            if parts[0] == "id:":
-                # append to response
-                result.append(record)
-        elif len(parts) >= 6:
-            record = {
-                'label': '',
-                'descr': '',
-                'nat_addr': None,
-                'nat_port': None,
-                'gateway': None,
-                'iface': parts[0],
-                'proto': parts[1],
-                'ipproto': addr_parser.split_ip_port(parts[2])['ipproto'],
-                'flags': []
-            }
-            if parts[3].find('(') > -1:
-                # NAT enabled
-                nat_record = addr_parser.split_ip_port(parts[3][1:-1])
-                record['nat_addr'] = nat_record['addr']
-                if nat_record['port'] != '0':
-                    record['nat_port'] = nat_record['port']
-
-            if parts[-3] == '->':
-                record['direction'] = 'out'
-            else:
-                record['direction'] = 'in'
-
-            tmp_parts1 = addr_parser.split_ip_port(parts[2])
-            tmp_parts2 = addr_parser.split_ip_port(parts[-2])
-            record['dst_addr'] = tmp_parts2['addr'] if record['direction'] == 'out' else tmp_parts1['addr']
-            record['dst_port'] = tmp_parts2['port'] if record['direction'] == 'out' else tmp_parts1['port']
-            record['src_addr'] = tmp_parts1['addr'] if record['direction'] == 'out' else tmp_parts2['addr']
-            record['src_port'] = tmp_parts1['port'] if record['direction'] == 'out' else tmp_parts2['port']
-
-            record['state'] = parts[-1]
-
-    return result
+            yield state
+
+
+def select_states(states, offset=0, limit=None, sort_by=None):
+    """ select a page of (sorted) states, only the requested page is kept in memory
+        :param states: iterable of StateRecord
+        :param offset: number of states to skip
+        :param limit: maximum number of states to return, None for all
+        :param sort_by: tuple (field, descending) or None to keep the pf order
+        :return: tuple (total number of states, list of StateRecord)
+    """
+    total = 0
+    if sort_by is not None:
+        sort_key, sort_desc = sort_by
+
+        def counted():
+            nonlocal total
+            for state in states:
+                total += 1
+                yield state
+
+        def key_func(state):
+            return str(state[sort_key]).lower() if sort_key in state else ''
+
+        if limit is None:
+            result = sorted(counted(), key=key_func, reverse=sort_desc)[offset:]
+        else:
+            result = (heapq.nlargest if sort_desc else heapq.nsmallest)(offset + limit, counted(), key=key_func)
+            result = result[offset:]
+    else:
+        result = []
+        for state in states:
+            if offset <= total and (limit is None or total < offset + limit):
+                result.append(state)
+            total += 1
+
+    return total, result
+
+
+def query_states(rule_label, filter_str):
+    """ collect all (matching) states
+        :param rule_label: label / rule id to search for
+        :param filter_str: filter (addresses, networks with optional port and search terms)
+        :return: list of dicts
+    """
+    return [state.as_dict() for state in iter_states(rule_label, filter_str)]
+
 
+def iter_top(lines=None):
+    """ stream pftop output, parsed incrementally
+        :param lines: iterable with pftop formatted lines, default reads from pftop
+        :return: iterator of TopRecord
+    """
+    if lines is None:
+        lines = command_output(['/usr/local/sbin/pftop', '-w', '1000', '-b','-v', 'long','200000'])
+    for rownum, line in enumerate(lines):
+        parts = line.split()
+        if rownum >= 2 and len(parts) > 5:
+            yield TopRecord(parts)
 
 
 def query_top():
-    addr_parser = AddressParser()
-    result = {
-        'details': [],
+    return {
+        'details': [record.as_dict() for record in iter_top()],
         'metadata': {
             'labels': fetch_rule_labels()
         }
     }
-
-    sp = subprocess.run(
-        ['/usr/local/sbin/pftop', '-w', '1000', '-b','-v', 'long','200000'],
-        capture_output=True,
-        text=True
-    )
-
-    for rownum, line in enumerate(sp.stdout.strip().split('\n')):
-        parts = line.strip().split()
-        if rownum >= 2 and len(parts) > 5:
-            record = {
-                'proto': parts[0],
-                'dir': parts[1].lower(),
-                'src_addr': addr_parser.split_ip_port(parts[2])['addr'],
-                'src_port': addr_parser.split_ip_port(parts[2])['port'],
-                'dst_addr': addr_parser.split_ip_port(parts[3])['addr'],
-                'dst_port': addr_parser.split_ip_port(parts[3])['port'],
-                'gw_addr': None,
-                'gw_port': None
-            }
-            if parts[4].count(':') > 2 or parts[4].count('.') > 2:
-                record['gw_addr'] = addr_parser.split_ip_port(parts[4])['addr']
-                record['gw_port'] = addr_parser.split_ip_port(parts[4])['port']
-                idx = 5
-            else:
-                idx = 4
-
-            pows =  {
-                'K': 1,
-                'M': 2,
-                'G': 3,
-            }
-            time_marks =  {
-                'm': 60,
-                'h': 3600,
-                'd': 86400,
-            }
-            record['state'] = parts[idx]
-            record['age'] = parts[idx+1]
-            record['expire'] = parts[idx+2]
-            record['pkts'] = int(parts[idx+3]) if parts[idx+3].isdigit() else 0
-            if parts[idx+4].isdigit():
-                record['bytes'] = int(parts[idx+4])
-            elif parts[idx+4][:-1].isdigit() and parts[idx+4][-1] in pows:
-                record['bytes'] = int(parts[idx+4][:-1])*pow(1024, pows[parts[idx+4][-1]])
-            else:
-                record['bytes'] = 0
-            record['avg'] = int(parts[idx+5]) if parts[idx+5].isdigit() else 0
-            record['rule'] = parts[idx+6]
-            for timefield in ['age', 'expire']:
-                if ':' in record[timefield]:
-                    tmp = record[timefield].split(':')
-                    record[timefield] = int(tmp[0]) * 3600 + int(tmp[1]) * 60 + int(tmp[2]) if len(tmp) > 2 else 0
-                elif record[timefield].isdigit():
-                    record[timefield] = int(record[timefield])
-                elif record[timefield][-1] in time_marks and record[timefield][:-1].isdigit():
-                    record[timefield] = int(record[timefield][:-1])*time_marks[record[timefield][-1]]
-                else:
-                    record[timefield] = 0
-
-
-            result['details'].append(record)
-
-    return result
@@ -30,7 +30,7 @@
 """
 import ujson
 import argparse
-from lib.states import query_states
+from lib.states import iter_states, select_states
 
 
 if __name__ == '__main__':
@@ -43,26 +43,19 @@ if __name__ == '__main__':
     parser.add_argument('--sort_by', help='sort by (field asc|desc)', default='')
     inputargs = parser.parse_args()
 
+    # stream states, only the requested page is kept in memory
+    total_entries, details = select_states(
+        iter_states(rule_label=inputargs.label, filter_str=inputargs.filter),
+        offset=int(inputargs.offset) if inputargs.offset.isdigit() else 0,
+        limit=int(inputargs.limit) if inputargs.limit.isdigit() else None,
+        sort_by=(
+            inputargs.sort_by.split()[0], inputargs.sort_by.split()[-1] == 'desc'
+        ) if inputargs.sort_by.strip() != '' else None
+    )
     result = {
-        'details': query_states(rule_label=inputargs.label, filter_str=inputargs.filter)
+        'details': [state.as_dict() for state in details],
+        'total_entries': total_entries
     }
-    # sort results
-    if inputargs.sort_by.strip() != '':
-        sort_key = inputargs.sort_by.split()[0]
-        sort_desc = inputargs.sort_by.split()[-1] == 'desc'
-        result['details'] = sorted(
-            result['details'],
-            key=lambda k: str(k[sort_key]).lower() if sort_key in k else '',
-            reverse=sort_desc
-        )
-
-    result['total_entries'] = len(result['details'])
-    # apply offset and limit
-    if inputargs.offset.isdigit():
-        result['details'] = result['details'][int(inputargs.offset):]
-    if inputargs.limit.isdigit() and len(result['details']) >= int(inputargs.limit):
-        result['details'] = result['details'][:int(inputargs.limit)]
-
     result['total'] = len(result['details'])
 
     print(ujson.dumps(result))
@@ -0,0 +1,118 @@
+#!/usr/local/bin/python3
+
+"""
+    Copyright (c) 2023 Ad Schellevis <ad@opnsense.org>
+    All rights reserved.
+
+    Redistribution and use in source and binary forms, with or without
+    modification, are permitted provided that the following conditions are met:
+
+    1. Redistributions of source code must retain the above copyright notice,
+     this list of conditions and the following disclaimer.
+
+    2. Redistributions in binary form must reproduce the above copyright
+     notice, this list of conditions and the following disclaimer in the
+     documentation and/or other materials provided with the distribution.
+
+    THIS SOFTWARE IS PROVIDED ``AS IS'' AND ANY EXPRESS OR IMPLIED WARRANTIES,
+    INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY
+    AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+    AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY,
+    OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+    SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+    INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+    CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+    ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+    POSSIBILITY OF SUCH DAMAGE.
+
+    --------------------------------------------------------------------------------------
+    aggregate filter log data using the columnar archive (see lib/logarchive.py)
+
+    examples:
+        top 10 blocked sources per interface in the last 24 hours:
+            query_log.py --filter action=block --group_by interface,src --limit 10
+        number of records per 5 minutes for a rule:
+            query_log.py --filter rid=<rule id> --histogram 300
+"""
+import argparse
+import sys
+import time
+import ujson
+sys.path.insert(0, "/usr/local/opnsense/site-python")
+from lib.log import fetch_rule_details
+from lib.logarchive import FilterLogArchive
+
+fields = ['action', 'interface', 'dir', 'rid', 'ipversion', 'protoname', 'src', 'dst', 'srcport', 'dstport']
+
+
+def field_list(value):
+    if value.strip() == '':
+        # configd passes empty strings for omitted parameters
+        return ['src']
+    result = value.split(',')
+    for field in result:
+        if field not in fields:
+            raise argparse.ArgumentTypeError('unknown field %s' % field)
+    return result
+
+
+def field_filters(value):
+    result = list()
+    for item in value.split(','):
+        if item.strip() == '':
+            continue
+        field = item.split('=')[0]
+        if field not in fields or item.find('=') == -1:
+            raise argparse.ArgumentTypeError('invalid filter %s' % item)
+        result.append((field, item.split('=', 1)[1]))
+    return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    # numeric arguments are optional, configd passes empty strings for omitted parameters
+    parser.add_argument('--group_by', help='fields to group by (comma separated)', type=field_list, default=['src'])
+    parser.add_argument('--filter', help='field=value (comma separated)', type=field_filters, default=[])
+    parser.add_argument('--period', help='number of seconds to look back', default='')
+    parser.add_argument('--start', help='start time (unix timestamp), overrides period', default='')
+    parser.add_argument('--end', help='end time (unix timestamp)', default='')
+    parser.add_argument('--limit', help='number of groups to return (top N)', default='')
+    parser.add_argument('--histogram', help='return counts per interval (seconds) instead of groups', default='')
+    inputargs = parser.parse_args()
+    period = int(inputargs.period) if inputargs.period.isdigit() else 86400
+    limit = int(inputargs.limit) if inputargs.limit.isdigit() else 10
+    histogram = int(inputargs.histogram) if inputargs.histogram.isdigit() else None
+
+    start_time = time.time()
+    conditions = ['time >= ?']
+    params = [int(inputargs.start) if inputargs.start.isdigit() else int(start_time) - period]
+    if inputargs.end.isdigit():
+        conditions.append('time < ?')
+        params.append(int(inputargs.end))
+    for field, value in inputargs.filter:
+        conditions.append('%s = ?' % field)
+        params.append(int(value) if value.isdigit() and field in ['ipversion', 'srcport', 'dstport'] else value)
+
+    if histogram:
+        sql = """SELECT time - time %% %(interval)d AS time, count(*) AS count
+                 FROM filterlog WHERE %(conditions)s
+                 GROUP BY 1 ORDER BY 1""" % {
+            'interval': histogram,
+            'conditions': ' AND '.join(conditions)
+        }
+    else:
+        sql = """SELECT %(group_by)s, count(*) AS count, sum(length) AS bytes, min(time) AS first, max(time) AS last
+                 FROM filterlog WHERE %(conditions)s
+                 GROUP BY %(group_by)s ORDER BY count DESC LIMIT %(limit)d""" % {
+            'group_by': ', '.join(inputargs.group_by),
+            'conditions': ' AND '.join(conditions),
+            'limit': limit
+        }
+    columns, rows = FilterLogArchive().query(sql, params)
+    result = {'rows': [dict(zip(columns, row)) for row in rows]}
+    if 'rid' in columns:
+        running_conf_descr = fetch_rule_details()
+        for row in result['rows']:
+            row['label'] = running_conf_descr.get(row['rid'], '')
+    result['elapsed'] = time.time() - start_time
+    print(ujson.dumps(result))
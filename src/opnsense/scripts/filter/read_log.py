@@ -26,144 +26,125 @@
     POSSIBILITY OF SUCH DAMAGE.
 
     --------------------------------------------------------------------------------------
-    read filter log, limit by number of records or last received digest (md5 hash of row)
+    read filter log, limit by number of records or last received digest (md5 hash of row).
+    rotated logs in /var/log/filter are read using a sidecar index (see lib/logindex.py), which also allows
+    selecting lines by rule id, interface, action or time (/since <unix timestamp>) without parsing all of them.
+    records can be filtered further on source or destination network (/src, /dst) and port (/port).
+
+    stream mode (/stream 1) follows the latest log and sends server sent events, all filters except /since and
+    /digest apply. /batch <max records> sends the records collected every 100ms in a single event.
 """
 import os
 import sys
-import re
 import glob
-from hashlib import md5
+import fcntl
 import argparse
+import ipaddress
 import ujson
 import subprocess
 import time
 import select
+from functools import lru_cache
+from hashlib import md5
 sys.path.insert(0, "/usr/local/opnsense/site-python")
 from log_helper import reverse_log_reader
 from params import update_params
+from lib.log import fetch_rule_details, parse_record
+from lib.logindex import FilterLogIndex, parse_timestamp
 
 
-# define log layouts, every endpoint contains all options
-# source : https://github.com/opnsense/ports/blob/master/opnsense/filterlog/files/description.txt
-fields_general = 'rulenr,subrulenr,anchorname,rid,interface,reason,action,dir,ipversion'.split(',')
+def record_filter(parameters):
+    """ compile the selection parameters into a match function
+        :param parameters: parameters (rid, interface, action, src, dst, port)
+        :return: function returning True when the parsed rule matches
+    """
+    conditions = list()
+    for field in ['rid', 'interface', 'action']:
+        if parameters[field] != '':
+            conditions.append(lambda rule, field=field, value=parameters[field]: rule.get(field) == value)
+    for field in ['src', 'dst']:
+        if parameters[field] != '':
+            try:
+                network = ipaddress.ip_network(parameters[field], strict=False)
+            except ValueError:
+                # invalid network, nothing can match
+                network = None
+            conditions.append(lambda rule, field=field, network=network: address_in(rule.get(field), network))
+    if parameters['port'] != '':
+        conditions.append(lambda rule, value=parameters['port']: value in (rule.get('srcport'), rule.get('dstport')))
+
+    return lambda rule: all(condition(rule) for condition in conditions)
 
-fields_ipv4 = fields_general + 'tos,ecn,ttl,id,offset,ipflags,protonum,protoname,length,src,dst'.split(',')
-fields_ipv4_udp = fields_ipv4 + 'srcport,dstport,datalen'.split(',')
-fields_ipv4_tcp = fields_ipv4 + 'srcport,dstport,datalen,tcpflags,seq,ack,urp,tcpopts'.split(',')
-fields_ipv4_carp = fields_ipv4 + 'type,ttl,vhid,version,advskew,advbase'.split(',')
 
-fields_ipv6 = fields_general + 'class,flow,hoplimit,protoname,protonum,length,src,dst'.split(',')
-fields_ipv6_udp = fields_ipv6 + 'srcport,dstport,datalen'.split(',')
-fields_ipv6_tcp = fields_ipv6 + 'srcport,dstport,datalen,tcpflags,seq,ack,urp,tcpopts'.split(',')
-fields_ipv6_carp = fields_ipv6 + 'type,hoplimit,vhid,version,advskew,advbase'.split(',')
+@lru_cache(maxsize=65536)
+def address_in(address, network):
+    try:
+        return network is not None and ipaddress.ip_address(address) in network
+    except ValueError:
+        return False
 
-# define hex digits
-HEX_DIGITS = set("0123456789abcdef")
 
-def update_rule(target, metadata_target, ruleparts, spec):
-    """ update target rule with parts in spec
-        :param target: target rule
-        :param metadata_target: collected metadata
-        :param ruleparts: list of rule items
-        :param spec: full rule specification, depending on protocol and version
+def filter_logs():
+    """ list filter logs, newest first
+        :return: list of filenames
     """
-    while len(target) < len(spec) and len(ruleparts) > 0:
-        target[spec[len(target)]] = ruleparts.pop(0)
-    # full spec
-    metadata_target['__spec__'] = spec
-
-def fetch_rule_details():
-    """ Fetch rule descriptions from the current running config if available
-        :return : rule details per line number
+    result = []
+    if os.path.isdir('/var/log/filter'):
+        result = list(sorted(glob.glob("/var/log/filter/filter_*.log"), reverse=True))
+    if os.path.isfile('/var/log/filter.log'):
+        result.append('/var/log/filter.log')
+    return result
+
+
+def build_indexes():
+    """ (re)build indexes for rotated logs, runs detached from the caller (/index 1)
+        :return: None
     """
-    if os.path.isfile('/tmp/rules.debug'):
-        # parse running config, fetch all md5 hashed labels
-        rule_map = dict()
-        with open('/tmp/rules.debug', "rt", encoding="utf-8") as f_in:
-            for line in f_in:
-                if line.find(' label ') > -1:
-                    lbl = line.split(' label ')[-1]
-                    if lbl.count('"') >= 2:
-                        rule_md5 = lbl.split('"')[1]
-                        # detect either calculated md5 hash (calcRuleHash) or rule uuid
-                        if len(rule_md5) >= 32 and set(rule_md5.replace('-', '')).issubset(HEX_DIGITS):
-                            rule_map[rule_md5] = ''.join(lbl.split('"')[2:]).strip().strip('# : ')
-
-    return rule_map
-
-def parse_record(record, running_conf_descr):
-    """ parse filterlog record
-        :return: rule
+    with open('/tmp/filterlog_index.lock', 'a+') as lock_fh:
+        try:
+            fcntl.flock(lock_fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            # already running
+            return
+        for filename in filter_logs():
+            if filename.startswith('/var/log/filter/'):
+                try:
+                    FilterLogIndex(filename).close()
+                except OSError:
+                    pass
+
+
+def spawn_build_indexes():
+    """ index in the background, the caller reads the log sequentially in the meantime
+        :return: None
     """
-    rule = dict()
-    metadata = dict()
-    # rule metadata (unique hash, hostname, timestamp)
-    if re.search('filterlog\[\d*\]:', record['line']):
-        # rfc3164 format
-        log_ident = re.split('filterlog[^:]*:', record['line'])
-        tmp = log_ident[0].split()
-        metadata['__host__'] = tmp.pop()
-        metadata['__timestamp__'] = ' '.join(tmp)
-        rulep = log_ident[1].strip().split(',')
-    else:
-        # rfc5424 format
-        tmp = record['line'].split()
-        metadata['__timestamp__'] = tmp[1].split('+')[0]
-        metadata['__host__'] = tmp[2]
-        rulep = tmp[-1].strip().split(',')
-
-    metadata['__digest__'] = md5(record['line'].encode()).hexdigest()
-    update_rule(rule, metadata, rulep, fields_general)
-
-    if 'action' not in rule:
-        # not a filter log line, skip
-        return None
-    elif 'ipversion' in rule:
-        if rule['ipversion'] == '4':
-            update_rule(rule, metadata, rulep, fields_ipv4)
-            if 'protonum' in rule:
-                if rule['protonum'] == '17': # UDP
-                    update_rule(rule, metadata, rulep, fields_ipv4_udp)
-                elif rule['protonum'] == '6': # TCP
-                    update_rule(rule, metadata, rulep, fields_ipv4_tcp)
-                elif rule['protonum'] == '112': # CARP
-                    update_rule(rule, metadata, rulep, fields_ipv4_carp)
-        elif rule['ipversion'] == '6':
-            update_rule(rule, metadata, rulep, fields_ipv6)
-            if 'protonum' in rule:
-                if rule['protonum'] == '17': # UDP
-                    update_rule(rule, metadata, rulep, fields_ipv6_udp)
-                elif rule['protonum'] == '6': # TCP
-                    update_rule(rule, metadata, rulep, fields_ipv6_tcp)
-                elif rule['protonum'] == '112': # CARP
-                    update_rule(rule, metadata, rulep, fields_ipv6_carp)
-
-    rule.update(metadata)
-    rule['label'] = ''
-    if rule['rid'] != '0':
-        # rule id in latest record format, don't use rule sequence number in that case
-        if rule['rid'] in running_conf_descr:
-            rule['label'] = running_conf_descr[rule['rid']]
-    elif rule['action'] not in ['pass', 'block']:
-        # no id for translation rules
-        rule['label'] = "%s rule" % rule['action']
-    elif len(rulep) > 0 and len(rulep[-1]) >= 32 and set(rulep[-1].replace('-', '')).issubset(HEX_DIGITS):
-        # rule id appended in record format, don't use rule sequence number in that case either
-        rule['rid'] = rulep[-1]
-        if rulep[-1] in running_conf_descr:
-            rule['label'] = running_conf_descr[rulep[-1]]
-        # obsolete md5 in log record
-        else:
-            rule['label'] = ''
-
-    return rule
+    subprocess.Popen(
+        [sys.executable, os.path.realpath(__file__), '/index', '1'],
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        start_new_session=True
+    )
+
+
+def send_event(event, data=''):
+    print("event: %s\ndata: %s\n\n" % (event, data), flush=True)
 
 
 if __name__ == '__main__':
     # read parameters
-    parameters = {'limit': '0', 'digest': '', 'stream': False, 'nlines': '5'}
+    parameters = {
+        'limit': '0', 'digest': '', 'stream': False, 'nlines': '5', 'rid': '', 'interface': '', 'action': '',
+        'since': '0', 'src': '', 'dst': '', 'port': '', 'batch': '0', 'index': ''
+    }
     update_params(parameters)
+    if parameters['index'] != '':
+        build_indexes()
+        sys.exit(0)
     parameters['limit'] = int(parameters['limit'])
+    parameters['since'] = int(parameters['since']) if parameters['since'].isdigit() else 0
+    parameters['batch'] = int(parameters['batch']) if parameters['batch'].isdigit() else 0
+    record_matches = record_filter(parameters)
 
     # parse current running config
     running_conf_descr = fetch_rule_details()
@@ -174,69 +155,126 @@ if __name__ == '__main__':
             ['tail', '-n' + parameters['nlines'], '-F', '/var/log/filter/latest.log'],
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE,
-            bufsize=0,
-            text=True
+            bufsize=0
         )
 
+        # Without batching, a maximum of line_threshold messages are sent per throttle_interval.
+        # With batching (/batch <max records>), all matched records collected within the interval are sent as
+        # a single "batch" event containing up to <max records>.
+        # Records exceeding these limits are dropped and reported, either as part of the batch or using
+        # a separate "dropped" event.
         last_t = time.time()
         line_threshold = 10
-        line_count = 0
-        throttle_interval = 100 # ms
+        throttle_interval = 0.1
         counter = {}
-        start_t_ms = time.time() * 1000
+        pending = list()
+        dropped = 0
+        total_dropped = 0
+        data = b''
+        window_end = time.time() + throttle_interval
+        last_send = time.time()
         try:
             while True:
-                ready, _, _ = select.select([f.stdout], [], [], 1)
-                if not ready:
-                    # timeout, send keepalive
-                    print("event: keepalive\ndata:\n\n", flush=True)
-                    continue
-                line = f.stdout.readline()
-                if line and line.find('filterlog') > -1:
+                timeout = max(window_end - time.time(), 0) if pending or dropped else 1
+                ready, _, _ = select.select([f.stdout], [], [], timeout)
+                if ready:
+                    chunk = os.read(f.stdout.fileno(), 65536)
+                    if not chunk:
+                        break
+                    data += chunk
+                    lines = data.split(b'\n')
+                    data = lines.pop()
                     t = time.time()
                     if (t - last_t) > 30:
                         # update running conf
                         last_t = t
                         running_conf_descr = fetch_rule_details()
-                    rule = parse_record({'line': line}, running_conf_descr)
-                    if rule != None:
+                    for line in lines:
+                        if line.find(b'filterlog') == -1:
+                            continue
+                        rule = parse_record({'line': line.decode(errors='replace').strip()}, running_conf_descr)
+                        if rule is None or not record_matches(rule):
+                            continue
                         counter[rule['rid']] = counter.get(rule['rid'], 0) + 1
                         rule['counter'] = counter[rule['rid']]
+                        if len(pending) < (parameters['batch'] if parameters['batch'] > 0 else line_threshold):
+                            pending.append(rule)
+                        else:
+                            dropped += 1
 
-                        line_count += 1
-                        elapsed = (time.time() * 1000) - start_t_ms
-                        if elapsed < throttle_interval and line_count <= line_threshold:
-                            print(f"event: message\ndata: {ujson.dumps(rule)}\n\n", flush=True)
-                        elif elapsed >= throttle_interval:
-                            line_count = 0
-                            start_t_ms = time.time() * 1000
-                else:
-                    break
+                if time.time() >= window_end or not ready:
+                    total_dropped += dropped
+                    if parameters['batch'] > 0 and (pending or dropped):
+                        send_event('batch', ujson.dumps({
+                            'rules': pending, 'dropped': dropped, 'total_dropped': total_dropped
+                        }))
+                        last_send = time.time()
+                    elif pending or dropped:
+                        for rule in pending:
+                            send_event('message', ujson.dumps(rule))
+                        if dropped > 0:
+                            send_event('dropped', ujson.dumps({'dropped': dropped, 'total_dropped': total_dropped}))
+                        last_send = time.time()
+                    elif time.time() - last_send >= 1:
+                        # idle, send keepalive
+                        send_event('keepalive')
+                        last_send = time.time()
+                    pending = list()
+                    dropped = 0
+                    window_end = time.time() + throttle_interval
         except KeyboardInterrupt:
             f.kill()
     else:
         result = list()
-        filter_logs = []
-        if os.path.isdir('/var/log/filter'):
-            filter_logs = list(sorted(glob.glob("/var/log/filter/filter_*.log"), reverse=True))
-        if os.path.isfile('/var/log/filter.log'):
-            filter_logs.append('/var/log/filter.log')
-
-        for filename in filter_logs:
+        log_filenames = filter_logs()
+        digest = parameters['digest'].strip()
+        index_missing = False
+        for filename in log_filenames:
             do_exit = False
-            for record in reverse_log_reader(filename):
+            log_index = None
+            if filename.startswith('/var/log/filter/'):
+                # rotated logs, select lines using the (incrementally updated) index.
+                # building a new index requires parsing the whole log, which is done in the background.
+                if FilterLogIndex.available(filename):
+                    try:
+                        log_index = FilterLogIndex(filename)
+                    except OSError:
+                        log_index = None
+                else:
+                    index_missing = True
+            if log_index is not None:
+                records = ({'line': x} for x in log_index.lines(
+                    digest=digest,
+                    since=parameters['since'] if parameters['since'] > 0 else None,
+                    rid=parameters['rid'],
+                    interface=parameters['interface'],
+                    action=parameters['action']
+                ))
+            else:
+                records = reverse_log_reader(filename)
+            for record in records:
                 if record['line'].find('filterlog') > -1:
+                    # the last digest marks the end of new data, whether the record is selected or not
+                    is_last = digest != '' and md5(record['line'].encode()).hexdigest() == digest
                     rule = parse_record(record, running_conf_descr)
-                    if (rule != None):
-                        result.append(rule)
-                    # handle exit criteria, row limit or last digest
-                    if parameters['limit'] != 0 and len(result) >= parameters['limit']:
-                        do_exit = True
-                    elif parameters['digest'].strip() != '' and parameters['digest'] == rule['__digest__']:
+                    if rule is None:
+                        do_exit = is_last
+                    elif parameters['since'] > 0 and 0 < parse_timestamp(rule['__timestamp__']) < parameters['since']:
                         do_exit = True
+                    elif record_matches(rule):
+                        result.append(rule)
+                        # handle exit criteria, row limit or last digest
+                        do_exit = is_last or (parameters['limit'] != 0 and len(result) >= parameters['limit'])
+                    else:
+                        do_exit = is_last
                     if do_exit:
                         break
+            if log_index is not None:
+                log_index.close()
             if do_exit:
                 break
+        if index_missing:
+            spawn_build_indexes()
+        FilterLogIndex.cleanup(log_filenames)
 
         print (ujson.dumps(result))
@@ -1 +1,4 @@
 from .alias_tests import *
+from .log_tests import *
+from .rulecache_tests import *
+from .states_tests import *
@@ -2,10 +2,13 @@ import unittest
 import sys
 import os
 import subprocess
+import tempfile
 sys.path.insert(0, "%s/../lib" % os.path.dirname(__file__))
 from alias.arpcache import ArpCache
 from alias.base import BaseContentParser
 from alias.bgpasn import BGPASN
+from alias.cidr import collapse_addresses, normalize_addresses
+from alias.prefixindex import PrefixIndex, PrefixIndexBuilder
 from alias.geoip import GEOIP
 from alias.interface import InterfaceParser
 from alias.uri import UriParser
@@ -67,3 +70,51 @@ class TestAliasMethods(unittest.TestCase):
     def test_wildcard(self):
         payload = list(BaseContentParser(**self.properties).iter_addresses('192.168.0.0/0.0.255.0'))
         self.assertEqual(len(payload), 256, 'Invalid number of hosts')
+
+    def test_collapse(self):
+        payload = collapse_addresses(['192.168.0.0/25', '192.168.0.128/25', '192.168.0.1', '10.0.0.1', '10.0.0.0'])
+        self.assertEqual(payload, {'192.168.0.0/24', '10.0.0.0/31'}, 'Invalid collapse')
+        payload = collapse_addresses(['2001:db8::/33', '2001:db8:8000::/33', '2001:0db8:0000:0000:0000:0000:0000:1'])
+        self.assertEqual(payload, {'2001:db8::/32'}, 'Invalid collapse (ipv6)')
+
+    def test_collapse_negate(self):
+        payload = collapse_addresses(['192.168.0.0/25', '192.168.0.128/25', '!192.168.0.1/32'])
+        self.assertEqual(payload, {'192.168.0.0/25', '192.168.0.128/25', '!192.168.0.1'}, 'Negation collapsed')
+
+    def test_normalize(self):
+        payload = normalize_addresses(['2001:0fff:faaa:0000:0000:0000:0000:1005/128', '192.168.1.7/24', 'host'])
+        self.assertEqual(payload, {'2001:fff:faaa::1005', '192.168.1.0/24', 'host'}, 'Invalid normalization')
+
+    def test_prefix_index(self):
+        builder = PrefixIndexBuilder()
+        for label, network in [('NL', '192.168.0.0/16'), ('DE', '192.168.1.0/24'), ('NL', '2001:db8::/32')]:
+            builder.add(label, network)
+        with tempfile.NamedTemporaryFile() as tmp:
+            builder.write(tmp.name)
+            index = PrefixIndex(tmp.name)
+            self.assertEqual(list(index.labels()), ['DE', 'NL'], 'Invalid labels')
+            self.assertEqual(list(index.networks('NL')), ['192.168.0.0/16', '2001:db8::/32'], 'Invalid networks')
+            self.assertEqual(index.lookup('192.168.1.1'), ('DE', '192.168.1.0/24'), 'Invalid lookup')
+            self.assertEqual(index.lookup('192.168.2.1'), ('NL', '192.168.0.0/16'), 'Invalid lookup')
+            self.assertEqual(index.lookup('10.0.0.1'), None, 'Invalid lookup')
+            index.close()
+
+    def test_uri_cleanup(self):
+        urls = ['http://example.com/a.txt', 'http://example.com/b.txt']
+        default_state_dir = UriParser._state_dir
+        with tempfile.TemporaryDirectory() as state_dir:
+            UriParser._state_dir = state_dir
+            try:
+                parser = UriParser(**self.properties)
+                for url in urls:
+                    open(parser._cache_filename(url), 'w').write('192.168.1.1\n')
+                    parser._update_state(url, {'ETag': url})
+                parser.cleanup(urls[:1])
+                self.assertEqual(
+                    sorted(os.listdir(state_dir)),
+                    sorted([os.path.basename(parser._cache_filename(urls[0])), 'test_alias.http.txt']),
+                    'cached entries of removed url not cleaned up'
+                )
+                self.assertEqual(list(parser._read_state()), urls[:1], 'state of removed url not cleaned up')
+            finally:
+                UriParser._state_dir = default_state_dir
@@ -0,0 +1,138 @@
+import unittest
+import sys
+import os
+import shutil
+import tempfile
+from hashlib import md5
+sys.path.insert(0, "/usr/local/opnsense/site-python")
+sys.path.insert(0, "%s/.." % os.path.dirname(os.path.abspath(__file__)))
+from lib.logarchive import FilterLogArchive
+from lib.logindex import FilterLogIndex, parse_timestamp
+
+
+def log_lines(count, start=0, action='block', rid='0123456789abcdef0123456789abcdef'):
+    """ generate filterlog (rfc5424) lines, one per second starting at 2024-10-18 12:00:00 (utc)
+    """
+    result = []
+    for idx in range(start, start + count):
+        result.append(
+            '<134>1 2024-10-18T12:%02d:%02d+00:00 OPNsense.localdomain filterlog 123 - [meta sequenceId="%d"] '
+            '96,,,%s,em%d,match,%s,in,4,0x0,,64,0,0,DF,6,tcp,60,10.0.%d.%d,10.0.0.254,%d,22,0,S,123,,64240,,mss\n' % (
+                (idx // 60) % 60, idx % 60, idx, rid, idx % 2, action, idx // 250, idx % 250, 1024 + idx
+            )
+        )
+    return ''.join(result)
+
+
+class TestLogArchive(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.defaults = (FilterLogArchive.archive_dir, FilterLogArchive.log_mask)
+        FilterLogArchive.archive_dir = '%s/archive' % self.work_dir
+        FilterLogArchive.log_mask = '%s/filter_*.log' % self.work_dir
+
+    def tearDown(self):
+        FilterLogArchive.archive_dir, FilterLogArchive.log_mask = self.defaults
+        shutil.rmtree(self.work_dir)
+
+    def count(self, where='true'):
+        return FilterLogArchive().query('SELECT count(*) FROM filterlog WHERE %s' % where)[1][0][0]
+
+    def test_query_tail(self):
+        with open('%s/filter_20241018.log' % self.work_dir, 'w') as f_out:
+            f_out.write(log_lines(100))
+        self.assertEqual(self.count(), 100, 'uncompacted records missing')
+
+    def test_query_initial_compaction(self):
+        with open('%s/filter_20241018.log' % self.work_dir, 'w') as f_out:
+            f_out.write(log_lines(100))
+        self.assertEqual(self.count(), 100)
+        segments = [x for x in os.listdir(FilterLogArchive.archive_dir) if x.endswith('.parquet')]
+        self.assertEqual(segments, ['filter_20241018.log.0001.parquet'], 'new log not compacted on first query')
+        with open('%s/filter_20241018.log' % self.work_dir, 'a') as f_out:
+            f_out.write(log_lines(10, 100))
+        self.assertEqual(self.count(), 110)
+        self.assertEqual(FilterLogArchive().compact(), {'filter_20241018.log': 10}, 'tail should not be compacted')
+
+    def test_compact(self):
+        filename = '%s/filter_20241018.log' % self.work_dir
+        with open(filename, 'w') as f_out:
+            f_out.write(log_lines(100))
+        self.assertEqual(FilterLogArchive().compact(), {'filter_20241018.log': 100})
+        with open(filename, 'a') as f_out:
+            f_out.write(log_lines(50, 100, action='pass'))
+        self.assertEqual(self.count(), 150, 'archive and tail should be combined')
+        self.assertEqual(FilterLogArchive().compact(), {'filter_20241018.log': 50})
+        self.assertEqual(self.count("action = 'pass'"), 50)
+        self.assertEqual(self.count("interface = 'em1'"), 75)
+        # a newer log closes the previous one, its segments are merged
+        with open('%s/filter_20241019.log' % self.work_dir, 'w') as f_out:
+            f_out.write(log_lines(10, 150))
+        FilterLogArchive().compact()
+        segments = [x for x in os.listdir(FilterLogArchive.archive_dir) if x.startswith('filter_20241018')]
+        self.assertEqual(segments, ['filter_20241018.log.parquet'], 'segments not merged')
+        self.assertEqual(self.count(), 160)
+        # removed logs are dropped from the archive
+        os.remove(filename)
+        FilterLogArchive().compact()
+        self.assertEqual(self.count(), 10)
+
+    def test_incomplete_line(self):
+        with open('%s/filter_20241018.log' % self.work_dir, 'w') as f_out:
+            f_out.write(log_lines(10))
+            f_out.write(log_lines(1, 10)[:40])
+        self.assertEqual(FilterLogArchive().compact(), {'filter_20241018.log': 10})
+        with open('%s/filter_20241018.log' % self.work_dir, 'a') as f_out:
+            f_out.write(log_lines(1, 10)[40:])
+        self.assertEqual(FilterLogArchive().compact(), {'filter_20241018.log': 1})
+        self.assertEqual(self.count(), 11)
+
+
+class TestLogIndex(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.default_index_dir = FilterLogIndex.index_dir
+        FilterLogIndex.index_dir = '%s/index' % self.work_dir
+        self.filename = '%s/filter_20241018.log' % self.work_dir
+        with open(self.filename, 'w') as f_out:
+            f_out.write(log_lines(100))
+
+    def tearDown(self):
+        FilterLogIndex.index_dir = self.default_index_dir
+        shutil.rmtree(self.work_dir)
+
+    def test_update(self):
+        self.assertFalse(FilterLogIndex.available(self.filename))
+        log_index = FilterLogIndex(self.filename)
+        self.assertTrue(FilterLogIndex.available(self.filename))
+        self.assertEqual(len(log_index), 100)
+        with open(self.filename, 'a') as f_out:
+            f_out.write(log_lines(20, 100))
+        log_index.update()
+        self.assertEqual(len(log_index), 120)
+        lines = list(log_index.lines())
+        self.assertEqual(lines, log_lines(120).strip().split('\n')[::-1], 'expected all lines, newest first')
+        log_index.close()
+        # a replaced log invalidates the index
+        os.remove(self.filename)
+        with open(self.filename, 'w') as f_out:
+            f_out.write(log_lines(10))
+        self.assertFalse(FilterLogIndex.available(self.filename))
+
+    def test_select(self):
+        log_index = FilterLogIndex(self.filename)
+        self.assertEqual(len(list(log_index.lines(interface='em1'))), 50)
+        self.assertEqual(len(list(log_index.lines(interface='em1', action='pass'))), 0)
+        since = parse_timestamp('2024-10-18T12:01:30+00:00')
+        self.assertEqual(len(list(log_index.lines(since=since))), 10)
+        log_index.close()
+
+    def test_digest(self):
+        log_index = FilterLogIndex(self.filename)
+        last_line = log_lines(1, 50).strip()
+        lines = list(log_index.lines(digest=md5(last_line.encode()).hexdigest(), interface='em1'))
+        # selected lines newer than the digest, the line with the digest is always returned
+        self.assertEqual(len(lines), 26)
+        self.assertEqual(lines[-1], last_line)
+        self.assertEqual(len(list(log_index.lines(digest='0' * 32))), 100, 'unknown digest should not stop')
+        log_index.close()
@@ -0,0 +1,72 @@
+import unittest
+import sys
+import os
+import shutil
+import tempfile
+import types
+sys.path.insert(0, "%s/.." % os.path.dirname(os.path.abspath(__file__)))
+from lib import rulecache
+from lib.rulecache import RuleCache
+from lib.states import fetch_rule_labels
+
+RULES_DEBUG = """nat on em0 from any to any -> (em0)
+pass in quick on em0 inet proto tcp from any to any port 22 keep state label "0123456789abcdef0123456789abcdef" # : Allow SSH
+block in log quick on em0 label "fe2c9b1a-1234-4c3d-9abc-0123456789ab" # Block all
+pass out label "let out anything" # let out anything from firewall host itself
+"""
+
+PFCTL_RULES = """@0 scrub in all fragment reassemble
+@1 pass in quick on em0 inet proto tcp from any to any port = ssh flags S/SA keep state label "0123456789abcdef0123456789abcdef"
+  [ Evaluations: 0         Packets: 0         Bytes: 0           States: 0     ]
+@2 block drop in log quick on em0 all label "fe2c9b1a-1234-4c3d-9abc-0123456789ab"
+@3 pass out all flags S/SA keep state label "let out anything"
+@4 pass in all label "pfonly"
+@10 pass in all label "0123456789abcdef0123456789abcdef"
+"""
+
+
+class TestRuleCache(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.defaults = (RuleCache.rules_filename, RuleCache.cache_filename, rulecache.subprocess.run)
+        RuleCache.rules_filename = '%s/rules.debug' % self.work_dir
+        RuleCache.cache_filename = '%s/cache_rule_labels.bin' % self.work_dir
+        RuleCache._current = None
+        rulecache.subprocess.run = lambda cmd, **kwargs: types.SimpleNamespace(stdout=PFCTL_RULES)
+        with open(RuleCache.rules_filename, 'w') as f_out:
+            f_out.write(RULES_DEBUG)
+
+    def tearDown(self):
+        RuleCache.rules_filename, RuleCache.cache_filename, rulecache.subprocess.run = self.defaults
+        RuleCache._current = None
+        shutil.rmtree(self.work_dir)
+
+    def test_lookup(self):
+        cache = RuleCache.open()
+        self.assertEqual(cache.rule(1), ('0123456789abcdef0123456789abcdef', 'Allow SSH', 2))
+        self.assertEqual(cache.rule('10'), cache.rule(1))
+        self.assertEqual(cache.rule(4), ('pfonly', None, 0), 'label without description')
+        self.assertIsNone(cache.rule(0), 'rule without label')
+        self.assertEqual(cache.descr('let out anything'), 'let out anything from firewall host itself')
+        self.assertEqual(cache.descr('pfonly', '-'), '-')
+        self.assertIsNone(cache.descr('unknown'))
+        self.assertEqual(len(list(cache.labels())), 4)
+
+    def test_fetch_rule_labels(self):
+        labels = fetch_rule_labels()
+        self.assertEqual(sorted(labels), ['1', '10', '2', '3', '4'])
+        self.assertEqual(labels['2'], {
+            'rid': 'fe2c9b1a-1234-4c3d-9abc-0123456789ab', 'descr': 'Block all', 'line': 3
+        })
+
+    def test_refresh(self):
+        cache = RuleCache.open()
+        self.assertIs(RuleCache.open(), cache, 'cache should be reused')
+        with open(RuleCache.rules_filename, 'a') as f_out:
+            f_out.write('pass in label "new" # new rule\n')
+        cache = RuleCache.open()
+        self.assertEqual(cache.descr('new'), 'new rule', 'cache not refreshed')
+        # another process opening the current cache doesn't recompile it
+        RuleCache._current = None
+        rulecache.subprocess.run = None
+        self.assertEqual(RuleCache.open().descr('new'), 'new rule')
@@ -0,0 +1,112 @@
+import unittest
+import sys
+import os
+sys.path.insert(0, "%s/.." % os.path.dirname(os.path.abspath(__file__)))
+from lib.states import iter_states, select_states, split_ip_port
+
+# pfctl -vvs state samples: inbound, outbound nat, ipv6 and route-to
+PFCTL_STATES = """all tcp 192.168.1.1:22 <- 192.168.1.100:51234       ESTABLISHED:ESTABLISHED
+   [1234567 + 65535](+1234) wscale 7  [2345678 + 65535](+2345) wscale 7
+   age 00:10:00, expires in 23:59:59, 100:200 pkts, 10000:20000 bytes, rule 1, allow-opts
+   id: 6543210000000001 creatorid: 12345678 gateway: 0.0.0.0
+   origif: em0
+all tcp 203.0.113.5:40000 (192.168.1.20:50000) -> 198.51.100.1:443       ESTABLISHED:ESTABLISHED
+   [3456789 + 65535](+3456) wscale 7  [4567890 + 65535](+4567) wscale 7
+   age 00:00:10, expires in 24:00:00, 10:20 pkts, 1000:2000 bytes, rule 3
+   id: 6543210000000002 creatorid: 12345678 gateway: 0.0.0.0
+   origif: em1
+all udp 2001:db8::1[53] <- 2001:db8::2[40000]       MULTIPLE:SINGLE
+   age 00:00:01, expires in 00:00:30, 1:1 pkts, 80:120 bytes, rule 2
+   id: 6543210000000003 creatorid: 12345678 gateway: ::
+   origif: em0
+all icmp 192.168.1.20:8 -> 10.0.0.1:8       0:0
+   age 00:00:05, expires in 00:00:10, 2:2 pkts, 168:168 bytes, rule 3
+   id: 6543210000000004 creatorid: 12345678 route-to: 10.0.0.1@em2 rtable: 1
+   origif: em1
+""".splitlines(keepends=True)
+
+RULE_LABELS = {
+    '1': {'rid': '0123456789abcdef0123456789abcdef', 'descr': 'Allow SSH', 'line': 2},
+    '2': {'rid': 'fe2c9b1a-1234-4c3d-9abc-0123456789ab', 'descr': 'Allow DNS', 'line': 3},
+    '3': {'rid': 'let out anything', 'descr': 'let out anything from firewall host itself', 'line': 4}
+}
+
+
+class TestStates(unittest.TestCase):
+    def states(self, rule_label='', filter_str=''):
+        return [x.as_dict() for x in iter_states(rule_label, filter_str, PFCTL_STATES, RULE_LABELS)]
+
+    def test_split_ip_port(self):
+        self.assertEqual(split_ip_port('192.168.1.1:22'), ('192.168.1.1', '22', 'ipv4'))
+        self.assertEqual(split_ip_port('2001:db8::1[53]'), ('2001:db8::1', '53', 'ipv6'))
+        self.assertEqual(split_ip_port('2001:db8::1'), ('2001:db8::1', '0', 'ipv6'))
+
+    def test_parse(self):
+        states = self.states()
+        self.assertEqual(len(states), 4)
+        self.assertEqual(states[0]['direction'], 'in')
+        self.assertEqual((states[0]['src_addr'], states[0]['src_port']), ('192.168.1.100', '51234'))
+        self.assertEqual((states[0]['dst_addr'], states[0]['dst_port']), ('192.168.1.1', '22'))
+        self.assertEqual(states[0]['label'], RULE_LABELS['1']['rid'])
+        self.assertEqual(states[0]['descr'], 'Allow SSH')
+        self.assertEqual(states[0]['pkts'], [100, 200])
+        self.assertEqual(states[0]['bytes'], [10000, 20000])
+        self.assertEqual(states[0]['flags'], ['allow-opts'])
+        self.assertEqual(states[0]['id'], '6543210000000001/12345678')
+        self.assertEqual(states[0]['gateway'], '0.0.0.0')
+
+    def test_nat(self):
+        state = self.states()[1]
+        self.assertEqual(state['direction'], 'out')
+        self.assertEqual((state['src_addr'], state['src_port']), ('203.0.113.5', '40000'))
+        self.assertEqual((state['nat_addr'], state['nat_port']), ('192.168.1.20', '50000'))
+        self.assertEqual((state['dst_addr'], state['dst_port']), ('198.51.100.1', '443'))
+        self.assertIsNone(self.states()[0]['nat_addr'])
+
+    def test_ipv6(self):
+        state = self.states()[2]
+        self.assertEqual(state['ipproto'], 'ipv6')
+        self.assertEqual((state['src_addr'], state['src_port']), ('2001:db8::2', '40000'))
+        self.assertEqual((state['dst_addr'], state['dst_port']), ('2001:db8::1', '53'))
+        self.assertEqual(state['state'], 'MULTIPLE:SINGLE')
+
+    def test_route_to(self):
+        state = self.states()[3]
+        self.assertEqual(state['route-to'], '10.0.0.1@em2')
+        self.assertEqual(state['rtable'], 1)
+        self.assertIsNone(state['gateway'])
+        self.assertNotIn('route-to', self.states()[0])
+
+    def test_label_filter(self):
+        self.assertEqual([x['rule'] for x in self.states(rule_label='fe2c9b1a')], ['2'])
+        self.assertEqual(len(self.states(rule_label='let out')), 2)
+        self.assertEqual(len(self.states(rule_label='nomatch')), 0)
+
+    def test_network_filter(self):
+        self.assertEqual(len(self.states(filter_str='192.168.1.0/24')), 3, 'source, destination or nat address')
+        self.assertEqual([x['rule'] for x in self.states(filter_str='192.168.1.1:22')], ['1'])
+        self.assertEqual([x['rule'] for x in self.states(filter_str='[2001:db8::/64]:53')], ['2'])
+        self.assertEqual(len(self.states(filter_str='10.0.0.0/8 192.168.0.0/16')), 1, 'all clauses should match')
+
+    def test_text_filter(self):
+        self.assertEqual([x['rule'] for x in self.states(filter_str='MULTIPLE')], ['2'])
+        self.assertEqual(len(self.states(filter_str='ESTABLISHED')), 2)
+        self.assertEqual(len(self.states(filter_str='192.168.1.0/24 ESTABLISHED')), 2)
+        self.assertEqual(len(self.states(filter_str='nomatch')), 0)
+
+    def test_select(self):
+        states = list(iter_states('', '', PFCTL_STATES, RULE_LABELS))
+        total, page = select_states(iter(states), offset=1, limit=2)
+        self.assertEqual(total, 4)
+        self.assertEqual(page, states[1:3], 'pf order expected')
+        self.assertEqual(select_states(iter(states), offset=3)[1], states[3:])
+        for sort_desc in [False, True]:
+            expected = sorted(states, key=lambda x: x['src_addr'], reverse=sort_desc)
+            total, page = select_states(iter(states), offset=1, limit=2, sort_by=('src_addr', sort_desc))
+            self.assertEqual(total, 4)
+            self.assertEqual([x['src_addr'] for x in page], [x['src_addr'] for x in expected[1:3]])
+            total, page = select_states(iter(states), sort_by=('src_addr', sort_desc))
+            self.assertEqual([x['src_addr'] for x in page], [x['src_addr'] for x in expected])
+        # states without the sort field are ordered as empty value
+        total, page = select_states(iter(states), limit=1, sort_by=('route-to', False))
+        self.assertEqual(page[0]['rule'], '1')
@@ -38,6 +38,7 @@ import syslog
 import glob
 from lib.alias import AliasParser
 from lib.alias.pf import PF
+from lib.alias.cidr import collapse_addresses, normalize_addresses
 from lib.alias.geoip import GEOIP
 
 
@@ -78,54 +79,65 @@ if __name__ == '__main__':
                     to_update.append(alias.get_name())
 
     use_cached = lambda x: to_update is not None and x not in to_update
+    aliases.prefetch(use_cached)
     for alias in aliases:
         # fetch alias content including dependencies
         # when a distinct set of aliases is offered, use current contents for all other alias types
         alias_name = alias.get_name()
-        alias_content = alias.cached() if use_cached(alias_name) else alias.resolve()
-        alias_changed_or_expired = max(alias.changed(), alias.expired())
-        for related_alias_name in aliases.get_alias_deps(alias_name):
-            if related_alias_name != alias_name:
-                rel_alias = aliases.get(related_alias_name)
-                if rel_alias:
-                    alias_content += rel_alias.cached() if use_cached(related_alias_name) else rel_alias.resolve()
-                    alias_changed_or_expired = max(alias_changed_or_expired, rel_alias.changed(), rel_alias.expired())
+        alias_content, alias_changed_or_expired = aliases.get_content(alias_name, use_cached)
 
         # only try to replace the contents of this alias if we're responsible for it (know how to parse)
         if alias.get_parser():
-            # when the alias or any of it's dependencies has changed, generate new
+            # collapse into the minimal set of networks, formatted equal to the pf table listing
+            alias_content = collapse_addresses(alias_content)
+            if to_update is None:
+                # compare against current table contents when not trying to update a targetted list
+                alias_pf_content = normalize_addresses(PF.list_table(alias_name))
+                to_add = alias_content - alias_pf_content
+                to_delete = alias_pf_content - alias_content
+            else:
+                alias_pf_content = alias_content
+                to_add = alias_content if alias_changed_or_expired else set()
+                to_delete = set()
+
+            # when the alias or any of it's dependencies has changed (or pf differs), generate new
             alias_filename = '/var/db/aliastables/%s.txt' % alias_name
-            if alias_changed_or_expired or not os.path.isfile(alias_filename):
+            if alias_changed_or_expired or not os.path.isfile(alias_filename) or len(to_add) + len(to_delete) > 0:
                 alias_content_str = '\n'.join(sorted(alias_content))
                 if  not os.path.isfile(alias_filename) or alias_content_str != alias.read_alias_file(alias_filename):
                     # read before write, only save when the contents have changed
                     open(alias_filename, 'w').write(alias_content_str)
 
-            # list current alias content when not trying to update a targetted list
-            alias_pf_content = list(PF.list_table(alias_name)) if to_update is None else alias_content
-
-            if (len(alias_content) != len(alias_pf_content) or alias_changed_or_expired):
-                # if the alias is changed, expired or the one in memory has a different number of items, load table
-                if len(alias_content) == 0:
-                    if len(alias_pf_content) > 0:
-                        # flush when target is empty
-                        PF.flush(alias_name)
-                else:
-                    # replace table contents with collected alias
-                    error_output = PF.replace(alias_name, alias_filename)
-                    if error_output.find('pfctl: ') > -1:
-                        error_message = "Error loading alias [%s]: %s {current_size: %d, new_size: %d}" % (
-                            alias_name,
-                            error_output.replace('pfctl: ', ''),
-                            len(alias_pf_content),
-                            len(alias_content),
-                        )
-                        result['status'] = 'error'
-                        if 'messages' not in result:
-                            result['messages'] = list()
-                        if error_output not in result['messages']:
-                            result['messages'].append(error_message)
-                            syslog.syslog(syslog.LOG_NOTICE, error_message)
+            error_output = None
+            if len(alias_content) == 0:
+                if len(alias_pf_content) > 0:
+                    # flush when target is empty
+                    PF.flush(alias_name)
+            elif len(to_delete) + len(to_add) == 0:
+                # table is up to date
+                pass
+            elif to_update is None and len(alias_pf_content) > 0 and len(to_delete) + len(to_add) < len(alias_content):
+                # existing table, sending the differences is cheaper than replacing all content.
+                # add before delete, addresses moving between (overlapping) entries stay matched in between
+                error_output = PF.add(alias_name, to_add) if len(to_add) > 0 else ''
+                if len(to_delete) > 0:
+                    error_output = '\n'.join([error_output, PF.delete(alias_name, to_delete)]).strip()
+            else:
+                # replace table contents with collected alias
+                error_output = PF.replace(alias_name, alias_filename)
+            if error_output and error_output.find('pfctl: ') > -1:
+                error_message = "Error loading alias [%s]: %s {current_size: %d, new_size: %d}" % (
+                    alias_name,
+                    error_output.replace('pfctl: ', ''),
+                    len(alias_pf_content),
+                    len(alias_content),
+                )
+                result['status'] = 'error'
+                if 'messages' not in result:
+                    result['messages'] = list()
+                if error_output not in result['messages']:
+                    result['messages'].append(error_message)
+                    syslog.syslog(syslog.LOG_NOTICE, error_message)
 
     # cleanup removed aliases when reloading all
     if to_update is None:
@@ -29,10 +29,12 @@
     fetch detailed data from provider for specified timeserie
 """
 import time
+import calendar
 import datetime
 import pytz
 import os
 import sys
+import ujson
 sys.path.insert(0, "/usr/local/opnsense/site-python")
 import lib.aggregates
 import params
@@ -41,7 +43,10 @@ import params
 app_params = {'start_time': '0',
               'end_time': '1461251783',
               'resolution': '300',
-              'provider': 'FlowSourceAddrTotals'
+              'provider': 'FlowSourceAddrTotals',
+              'format': 'csv',
+              'cursor': '',
+              'limit': ''
               }
 params.update_params(app_params)
 
@@ -53,7 +58,11 @@ if app_params['start_time'].isdigit():
         end_time = int(app_params['end_time'])
         if app_params['resolution'].isdigit():
             resolution = int(app_params['resolution'])
-            valid_params = True
+            valid_params = app_params['format'] in ('csv', 'ndjson')
+            if app_params['cursor'] != '' and not app_params['cursor'].isdigit():
+                valid_params = False
+            if app_params['limit'] != '' and not app_params['limit'].isdigit():
+                valid_params = False
 
 if valid_params:
     # calculate time offset between localtime and utc
@@ -67,7 +76,25 @@ if valid_params:
                 obj = agg_class(resolution)
                 rownum=0
                 column_names = dict()
-                for record in obj.get_data(start_time, end_time):
+                # pagination, continue at cursor (timestamp), stop at the first timestamp after [limit] rows
+                first_time = max(start_time, int(app_params['cursor'])) if app_params['cursor'] else start_time
+                limit = int(app_params['limit']) if app_params['limit'] else None
+                prev_time = None
+                for record in obj.get_data(first_time, end_time):
+                    record_time = calendar.timegm(record['start_time'].timetuple())
+                    if limit is not None and rownum >= limit and record_time != prev_time:
+                        if app_params['format'] == 'ndjson':
+                            print(ujson.dumps({'next_cursor': record_time}))
+                        break
+                    prev_time = record_time
+                    if app_params['format'] == 'ndjson':
+                        # timestamps as seconds since epoch
+                        for item in record:
+                            if type(record[item]) == datetime.datetime:
+                                record[item] = calendar.timegm(record[item].timetuple())
+                        print(ujson.dumps(record))
+                        rownum += 1
+                        continue
                     if rownum == 0:
                         column_names = list(record.keys())
                         # dump heading
@@ -99,3 +126,6 @@ else:
     print ('  start_time : start time (seconds since epoch)')
     print ('  end_time : end timestamp (seconds since epoch)')
     print ('  provider : data provider classname')
+    print ('  format : csv (default) or ndjson')
+    print ('  cursor : continue at timestamp (pagination, ndjson ends with next_cursor when truncated)')
+    print ('  limit : maximum number of rows (rows sharing the last timestamp are included)')
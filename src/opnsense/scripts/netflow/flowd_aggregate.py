@@ -33,12 +33,11 @@ import sys
 import fcntl
 import signal
 import glob
-import copy
 import syslog
 import traceback
 import argparse
 from lib import load_config
-from lib.parse import parse_flow
+from lib.parse import parse_flow, parse_flow_batches
 from lib.aggregate import AggMetadata
 import lib.aggregates
 
@@ -64,22 +63,23 @@ def aggregate_flowd(config, do_vacuum=False):
 
     # parse flow data and stream to registered consumers
     prev_recv = metadata.last_sync()
+    # logs are read newest first, the sync timestamp should reflect the newest record processed
+    max_recv = prev_recv
     commit_record_count = 0
-    for flow_record in parse_flow(prev_recv, config.flowd_source):
+    for flow_record in parse_flow(prev_recv, config.flowd_source, bulk=True):
         if flow_record is None or (prev_recv != flow_record['recv'] and commit_record_count > 100000):
             # commit data on receive timestamp change or last record
             for stream_agg_object in stream_agg_objects:
                 stream_agg_object.commit()
                 commit_record_count = 0
-            metadata.update_sync_time(prev_recv)
+            metadata.update_sync_time(max_recv)
         if flow_record is not None:
             # send to aggregator
             for stream_agg_object in stream_agg_objects:
-                # class add() may change the flow contents for processing, its better to isolate
-                # parameters here.
-                stream_agg_object.add(copy.copy(flow_record))
+                stream_agg_object.add(flow_record)
             commit_record_count += 1
             prev_recv = flow_record['recv']
+            max_recv = max(max_recv, prev_recv)
 
     # expire old data
     for stream_agg_object in stream_agg_objects:
@@ -88,6 +88,119 @@ def aggregate_flowd(config, do_vacuum=False):
     del metadata
 
 
+def aggregate_flowd_parallel(config, do_vacuum=False):
+    """ aggregate collected flowd data, distribute batches over config.aggregate_workers processes
+    :param config: script configuration
+    :param do_vacuum: vacuum database after cleanup
+    :return: None
+    """
+    from lib.workers import AggregatorPool
+    # init metadata (progress maintenance)
+    metadata = AggMetadata(config.database_dir)
+
+    agg_specs = list()
+    for agg_class in lib.aggregates.get_aggregators():
+        for resolution in agg_class.resolutions():
+            agg_specs.append((agg_class, resolution))
+
+    pool = AggregatorPool(config.database_dir, agg_specs, config.aggregate_workers)
+    try:
+        commit_record_count = 0
+        # logs are read newest first, the sync timestamp should reflect the newest record processed
+        max_recv = metadata.last_sync()
+        for batch in parse_flow_batches(max_recv, config.flowd_source):
+            pool.add(batch)
+            commit_record_count += len(batch)
+            max_recv = max(max_recv, max(batch.recv))
+            if commit_record_count > 100000:
+                # batches end on receive timestamp changes, safe to commit here
+                pool.commit()
+                metadata.update_sync_time(max_recv)
+                commit_record_count = 0
+        pool.commit()
+        if commit_record_count > 0:
+            metadata.update_sync_time(max_recv)
+        # expire old data
+        pool.close(do_vacuum)
+    except:
+        pool.terminate()
+        raise
+    del metadata
+
+
+def aggregate_flowd_follow(config, is_running):
+    """ follow flowd log appends and aggregate new records as they arrive, commits at least every
+        config.follow_commit_interval seconds. The read position (inode, offset) is kept in metadata.
+        Derived (rollup) resolutions and the columnar copy are refreshed on cleanup (every 120 seconds).
+    :param config: script configuration
+    :param is_running: callable, returns False when the process should stop
+    :return: None
+    """
+    from lib.follow import FlowdFollower
+    from lib.workers import AggregatorPool, LocalAggregators
+    metadata = AggMetadata(config.database_dir)
+    if metadata.read_position() is None:
+        # catch up with the (rotated) logs the classic way first and persist the position in the current log,
+        # records appended while catching up are skipped by the follower using the receive timestamp
+        try:
+            stat = os.stat(config.flowd_source)
+        except OSError:
+            stat = None
+        aggregate_flowd(config)
+        if stat is not None:
+            metadata.update_read_position(stat.st_ino, stat.st_size)
+
+    agg_specs = list()
+    for agg_class in lib.aggregates.get_aggregators():
+        for resolution in agg_class.resolutions():
+            agg_specs.append((agg_class, resolution))
+    if config.aggregate_workers > 1:
+        aggregators = AggregatorPool(config.database_dir, agg_specs, config.aggregate_workers)
+    else:
+        aggregators = LocalAggregators(config.database_dir, agg_specs)
+
+    follower = FlowdFollower(config.flowd_source, metadata.read_position(), metadata.last_sync())
+    vacuum_interval = (60*60*8) # 8 hour vacuum cycle
+    cleanup_interval = 120
+    vacuum_countdown = time.time() + vacuum_interval
+    cleanup_countdown = time.time() + cleanup_interval
+    try:
+        while True:
+            last_commit = time.time()
+            last_recv = None
+            for batch in follower.batches():
+                aggregators.add(batch)
+                last_recv = batch.recv[-1]
+                if time.time() - last_commit > config.follow_commit_interval or not is_running():
+                    break
+            if last_recv is not None:
+                aggregators.commit()
+                metadata.update_read_position(*follower.position)
+                metadata.update_sync_time(last_recv)
+            if not is_running():
+                break
+            if time.time() - last_commit > config.follow_commit_interval:
+                # more data pending, continue reading
+                continue
+            if cleanup_countdown < time.time():
+                do_vacuum = vacuum_countdown < time.time()
+                aggregators.cleanup(do_vacuum)
+                cleanup_countdown = time.time() + cleanup_interval
+                if do_vacuum:
+                    vacuum_countdown = time.time() + vacuum_interval
+                    syslog.syslog(syslog.LOG_NOTICE, 'vacuum done')
+            # rotate if needed, the remainder of the rotated file is read on the next pass
+            check_rotate(config.flowd_source)
+            if config.single_pass:
+                break
+            follower.wait(1)
+        aggregators.close()
+    except:
+        aggregators.terminate()
+        raise
+    del metadata
+
+
 def check_rotate(filename):
     """ Checks if flowd log needs to be rotated, if so perform rotate.
         We keep [MAX_LOGS] number of logs containing approx. [MAX_FILE_SIZE_MB] data, the flowd data probably contains
@@ -143,6 +256,15 @@ class Main(object):
         syslog.syslog(syslog.LOG_NOTICE, 'startup, check database.')
         check_and_repair('%s/*.sqlite' % self.config.database_dir)
 
+        if self.config.follow:
+            syslog.syslog(syslog.LOG_NOTICE, 'start following flowd')
+            try:
+                aggregate_flowd_follow(self.config, lambda: self.running)
+            except:
+                syslog.syslog(syslog.LOG_ERR, 'flowd aggregate died with message %s' % (traceback.format_exc().replace('\n', ' ')))
+                raise
+            return
+
         vacuum_interval = (60*60*8) # 8 hour vacuum cycle
         vacuum_countdown = None
         syslog.syslog(syslog.LOG_NOTICE, 'start watching flowd')
@@ -157,7 +279,10 @@ class Main(object):
 
             # run aggregate
             try:
-                aggregate_flowd(self.config, do_vacuum)
+                if self.config.aggregate_workers > 1:
+                    aggregate_flowd_parallel(self.config, do_vacuum)
+                else:
+                    aggregate_flowd(self.config, do_vacuum)
                 if do_vacuum:
                     syslog.syslog(syslog.LOG_NOTICE, 'vacuum done')
             except:
@@ -196,11 +321,18 @@ if __name__ == '__main__':
     parser.add_argument('--console', dest='console', help='run in console', action='store_true')
     parser.add_argument('--profile', dest='profile', help='enable profiler', action='store_true')
     parser.add_argument('--repair', dest='repair', help='init repair', action='store_true')
+    parser.add_argument('--workers', help='number of aggregator processes', type=int, default=None)
+    parser.add_argument('--follow', dest='follow', help='follow flowd log appends', action='store_true')
     cmd_args = parser.parse_args()
 
     Main.set_config(
         load_config(cmd_args.config)
     )
+    if cmd_args.workers is not None:
+        Main.config.aggregate_workers = cmd_args.workers
+    if cmd_args.follow:
+        Main.config.follow = True
+    lib.aggregates.BaseFlowAggregator.storage_backend = Main.config.storage_backend
     from sqlite3_helper import check_and_repair
 
     if cmd_args.console:
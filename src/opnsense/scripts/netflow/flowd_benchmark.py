@@ -0,0 +1,259 @@
+#!/usr/local/bin/python3
+"""
+    Copyright (c) 2024 Ad Schellevis <ad@opnsense.org>
+    All rights reserved.
+
+    Redistribution and use in source and binary forms, with or without
+    modification, are permitted provided that the following conditions are met:
+
+    1. Redistributions of source code must retain the above copyright notice,
+     this list of conditions and the following disclaimer.
+
+    2. Redistributions in binary form must reproduce the above copyright
+     notice, this list of conditions and the following disclaimer in the
+     documentation and/or other materials provided with the distribution.
+
+    THIS SOFTWARE IS PROVIDED ``AS IS'' AND ANY EXPRESS OR IMPLIED WARRANTIES,
+    INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY
+    AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+    AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY,
+    OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+    SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+    INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+    CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+    ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+    POSSIBILITY OF SUCH DAMAGE.
+
+
+    --------------------------------------------------------------------------------------
+    benchmark the netflow pipeline, synthesizes a flowd log and replays it through the parser and all
+    aggregators into a temporary database directory.
+    reports records/sec and time per stage, sqlite row changes and commits per aggregator and peak memory usage.
+"""
+import argparse
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import ujson
+from lib import Config
+from lib.flowparser import FlowParser
+from lib.parse import Interfaces, parse_flow
+from lib.synthetic import FlowSynthesizer
+import lib.aggregates
+from lib.aggregates import get_aggregators
+
+
+def peak_rss():
+    """
+    :return: peak resident set size (KB) of this process and of its (finished) children
+    """
+    result = []
+    for who in [resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN]:
+        maxrss = resource.getrusage(who).ru_maxrss
+        # reported in bytes on macOS, KB on FreeBSD and Linux
+        result.append(int(maxrss / 1024) if sys.platform == 'darwin' else maxrss)
+    return result
+
+
+def stage_result(records, seconds, **kwargs):
+    """
+    :param records: number of records processed
+    :param seconds: elapsed time
+    :return: dict
+    """
+    result = {'seconds': round(seconds, 3), 'records_per_sec': int(records / seconds) if seconds > 0 else 0}
+    result.update(kwargs)
+    return result
+
+
+def bench_parser(flowd_source, records):
+    """ decode the flowd log into column batches (FlowParser.iter_batches)
+    :param flowd_source: flowd log filename
+    :param records: number of records in the log
+    :return: dict
+    """
+    start = time.time()
+    batches = 0
+    for batch in FlowParser(flowd_source).iter_batches():
+        batches += 1
+    return stage_result(records, time.time() - start, batches=batches)
+
+
+def bench_parse_flow(flowd_source, records):
+    """ parse flowd log into flow records, including the interface mapping (lib.parse.parse_flow)
+    :param flowd_source: flowd log filename
+    :param records: number of records in the log
+    :return: dict
+    """
+    start = time.time()
+    for flow_record in parse_flow(0, flowd_source, bulk=True):
+        pass
+    return stage_result(records, time.time() - start)
+
+
+def timed_aggregators(registry):
+    """ wrap the aggregator classes to collect timings per instance, nested calls (commit() from cleanup())
+        are accounted for in the outer call
+    :param registry: dict to register instances => timings in
+    :return: list of aggregator classes
+    """
+    def timed(method_name):
+        def wrapper(self, *args, **kwargs):
+            outer = not self._timing_active
+            self._timing_active = True
+            start = time.time()
+            try:
+                return getattr(super(type(self), self), method_name)(*args, **kwargs)
+            finally:
+                if outer:
+                    self._timing_active = False
+                    registry[self][method_name] += time.time() - start
+                    if method_name == 'commit':
+                        registry[self]['commits'] += 1
+        return wrapper
+
+    def init(self, *args, **kwargs):
+        super(type(self), self).__init__(*args, **kwargs)
+        self._timing_active = False
+        registry[self] = {'add': 0.0, 'commit': 0.0, 'cleanup': 0.0, 'commits': 0}
+
+    result = list()
+    for agg_class in get_aggregators():
+        result.append(type(agg_class.__name__, (agg_class, ), {
+            '__init__': init, 'add': timed('add'), 'commit': timed('commit'), 'cleanup': timed('cleanup')
+        }))
+    return result
+
+
+def bench_aggregate(flowd_source, database_dir, records):
+    """ replay the flowd log through all aggregators using flowd_aggregate.aggregate_flowd(), the aggregator
+        classes are wrapped to collect timings per stage and aggregator.
+    :param flowd_source: flowd log filename
+    :param database_dir: (empty) database directory
+    :param records: number of records in the log
+    :return: dict
+    """
+    from flowd_aggregate import aggregate_flowd
+    timings = dict()
+    lib.aggregates.get_aggregators = lambda: timed_aggregators(timings)
+    try:
+        start = time.time()
+        aggregate_flowd(Config(flowd_source=flowd_source, database_dir=database_dir))
+        total_time = time.time() - start
+    finally:
+        lib.aggregates.get_aggregators = get_aggregators
+
+    result = {'aggregators': dict()}
+    for stream_agg_object in timings:
+        target = stream_agg_object.target_filename % stream_agg_object.resolution
+        filename = '%s/%s' % (database_dir, target)
+        result['aggregators'][target] = {
+            'add': round(timings[stream_agg_object]['add'], 3),
+            'commit': round(timings[stream_agg_object]['commit'], 3),
+            'cleanup': round(timings[stream_agg_object]['cleanup'], 3),
+            'commits': timings[stream_agg_object]['commits'],
+            'changes': stream_agg_object._db_connection.total_changes,
+            'size': os.path.getsize(filename) if os.path.isfile(filename) else 0
+        }
+    aggregator_time = sum([sum(x[y] for y in ['add', 'commit', 'cleanup']) for x in timings.values()])
+    result.update(stage_result(records, total_time, parse=round(total_time - aggregator_time, 3)))
+    return result
+
+
+def bench_parallel(flowd_source, database_dir, records, workers):
+    """ replay the flowd log using flowd_aggregate.aggregate_flowd_parallel()
+    :param flowd_source: flowd log filename
+    :param database_dir: (empty) database directory
+    :param records: number of records in the log
+    :param workers: number of aggregator processes
+    :return: dict
+    """
+    from flowd_aggregate import aggregate_flowd_parallel
+    start = time.time()
+    aggregate_flowd_parallel(Config(flowd_source=flowd_source, database_dir=database_dir, aggregate_workers=workers))
+    return stage_result(records, time.time() - start, workers=workers)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--records', help='number of flow records', type=int, default=100000)
+    parser.add_argument('--hosts', help='number of distinct host addresses', type=int, default=1000)
+    parser.add_argument('--ports', help='number of distinct destination ports', type=int, default=100)
+    parser.add_argument('--interfaces', help='number of interfaces', type=int, default=4)
+    parser.add_argument('--ipv6', help='fraction of ipv6 hosts', type=float, default=0.2)
+    parser.add_argument('--duration', help='seconds of traffic to simulate', type=int, default=3600)
+    parser.add_argument(
+        '--variants', help='record field variants to use (comma separated)',
+        default=','.join(sorted(FlowSynthesizer.variants))
+    )
+    parser.add_argument('--seed', help='random seed', type=int, default=None)
+    parser.add_argument('--workers', help='also replay using parallel aggregator processes', type=int, default=0)
+    parser.add_argument('--flowd_source', help='replay existing flowd log instead of synthesizing one', default=None)
+    parser.add_argument('--keep', help='keep temporary directory', action='store_true')
+    parser.add_argument('--json', help='output as json', action='store_true')
+    cmd_args = parser.parse_args()
+
+    if cmd_args.flowd_source is None:
+        # synthesized interface indexes, don't depend on the local interfaces (ifinfo)
+        Interfaces.static_map = {str(x): 'if%d' % x for x in range(1, cmd_args.interfaces + 1)}
+    elif not os.path.isfile('/usr/local/sbin/ifinfo'):
+        # replaying off-box, report interface indexes
+        Interfaces.static_map = dict()
+
+    work_dir = tempfile.mkdtemp(prefix='flowd_benchmark.')
+    report = {'stages': dict()}
+    try:
+        if cmd_args.flowd_source is None:
+            flowd_source = '%s/flowd.log' % work_dir
+            variants = [x.strip() for x in cmd_args.variants.split(',') if x.strip() in FlowSynthesizer.variants]
+            synthesizer = FlowSynthesizer(
+                hosts=cmd_args.hosts, ports=cmd_args.ports, interfaces=cmd_args.interfaces,
+                ipv6_ratio=cmd_args.ipv6, variants=variants, seed=cmd_args.seed
+            )
+            start = time.time()
+            synthesizer.write(flowd_source, cmd_args.records, int(time.time()) - cmd_args.duration, cmd_args.duration)
+            report['stages']['synthesize'] = stage_result(cmd_args.records, time.time() - start)
+            records = cmd_args.records
+        else:
+            # replay a copy, rotated files (<flowd_source>.000001, ...) would be read by parse_flow() as well
+            flowd_source = '%s/flowd.log' % work_dir
+            shutil.copyfile(cmd_args.flowd_source, flowd_source)
+            records = sum([1 for x in FlowParser(flowd_source)])
+        report['records'] = records
+        report['log_size'] = os.path.getsize(flowd_source)
+
+        report['stages']['parser'] = bench_parser(flowd_source, records)
+        report['stages']['parse_flow'] = bench_parse_flow(flowd_source, records)
+        report['stages']['aggregate'] = bench_aggregate(flowd_source, '%s/netflow' % work_dir, records)
+        if cmd_args.workers > 0:
+            report['stages']['parallel'] = bench_parallel(
+                flowd_source, '%s/netflow_parallel' % work_dir, records, cmd_args.workers
+            )
+        report['peak_rss_kb'], report['peak_rss_children_kb'] = peak_rss()
+    finally:
+        if cmd_args.keep:
+            report['work_dir'] = work_dir
+        else:
+            shutil.rmtree(work_dir)
+
+    if cmd_args.json:
+        print(ujson.dumps(report))
+    else:
+        print('records         : %d (%d bytes)' % (report['records'], report['log_size']))
+        for stage, stage_data in report['stages'].items():
+            print('%-16s: %8.3fs %10d rec/s' % (stage, stage_data['seconds'], stage_data['records_per_sec']))
+        aggregate = report['stages']['aggregate']
+        print('  parse         : %8.3fs' % aggregate['parse'])
+        print('  %-30s %9s %9s %9s %8s %10s %12s' % ('aggregator', 'add', 'commit', 'cleanup', 'commits',
+                                                   'changes', 'size'))
+        for target, stats in sorted(aggregate['aggregators'].items()):
+            print('  %-30s %8.3fs %8.3fs %8.3fs %8d %10d %12d' % (
+                target, stats['add'], stats['commit'], stats['cleanup'], stats['commits'], stats['changes'],
+                stats['size']
+            ))
+        print('peak rss        : %d KB (children %d KB)' % (report['peak_rss_kb'], report['peak_rss_children_kb']))
+        if 'work_dir' in report:
+            print('work dir        : %s' % report['work_dir'])
@@ -5,6 +5,7 @@ if [ "$1" == "all" ]; then
     /usr/local/etc/rc.d/flowd_aggregate stop
     /usr/local/etc/rc.d/flowd stop
     rm  /var/netflow/*.sqlite
+    rm -rf /var/netflow/columnar
     rm /var/log/flowd.log*
     /usr/local/etc/rc.d/flowd start
     /usr/local/etc/rc.d/flowd_aggregate start
@@ -29,6 +29,8 @@
     fetch timeseries from data provider
 """
 import os
+import sys
+import csv
 import time
 import calendar
 import ujson
@@ -37,6 +39,87 @@ import argparse
 from lib import load_config
 import lib.aggregates
 
+
+def record_key(record, key_fields):
+    """ construct dimension key from record
+    :param record: data record
+    :param key_fields: list of key fields
+    :return: str
+    """
+    result = []
+    for key_field in key_fields:
+        if key_field in record and record[key_field] is not None:
+            result.append('%s' % record[key_field])
+        else:
+            result.append('')
+    return ','.join(result)
+
+
+def timeserie_slices(obj, start_time, end_time, resolution, key_fields, dimension_keys, cursor=None):
+    """ stream time slices ordered by time, missing timeslices and dimension keys are filled with zeros
+    :param obj: aggregator object
+    :param start_time: start timestamp
+    :param end_time: end timestamp
+    :param resolution: sample resolution
+    :param key_fields: list of key fields
+    :param dimension_keys: set of dimension keys to report for every timeslice
+    :param cursor: timestamp to continue from (pagination)
+    :return: iterator returning tuples (timestamp, dict dimension key => values)
+    """
+    first_time = max(start_time, cursor) if cursor is not None else start_time
+    # next slice (from start_time) to generate when no data is found
+    fill_time = start_time + max(-(-(first_time - start_time) // resolution), 0) * resolution
+    now = time.time()
+    empty_slice = {'octets': 0, 'packets': 0, 'resolution': resolution}
+    # stable output order
+    fill_keys = sorted(dimension_keys)
+
+    def make_slice(slice_time, data):
+        for dimension_key in fill_keys:
+            if dimension_key not in data:
+                data[dimension_key] = dict(empty_slice)
+        return slice_time, data
+
+    current_time = None
+    current_data = dict()
+    records = obj.get_timeserie_data(first_time, end_time, key_fields) if obj is not None else []
+    for record in records:
+        start_time_stamp = calendar.timegm(record['start_time'].timetuple())
+        if start_time_stamp != current_time:
+            if current_time is not None:
+                yield make_slice(current_time, current_data)
+            while fill_time < start_time_stamp and fill_time < now:
+                yield make_slice(fill_time, dict())
+                fill_time += resolution
+            if fill_time == start_time_stamp:
+                fill_time += resolution
+            current_time = start_time_stamp
+            current_data = dict()
+        current_data[record_key(record, key_fields)] = {
+            'octets': record['octets'],
+            'packets': record['packets'],
+            'resolution': resolution
+        }
+    if current_time is not None:
+        yield make_slice(current_time, current_data)
+    while fill_time < now:
+        yield make_slice(fill_time, dict())
+        fill_time += resolution
+
+
+def paginate(slices, limit=None):
+    """ limit the number of slices
+    :param slices: iterator returning tuples (timestamp, data)
+    :param limit: maximum number of slices, None for all
+    :return: iterator returning tuples (timestamp, data), the last item contains (next cursor, None) when truncated
+    """
+    for seq, item in enumerate(slices):
+        if limit is not None and seq >= limit:
+            yield item[0], None
+            break
+        yield item
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--config', '--config', help='configuration yaml', default=None)
@@ -46,67 +129,78 @@ if __name__ == '__main__':
     parser.add_argument('--end_time', type=int, required=True)
     parser.add_argument('--key_fields', required=True)
     parser.add_argument('--sample', default='')
+    parser.add_argument('--format', choices=['json', 'ndjson', 'csv'], default='json',
+                        help='output format, ndjson and csv emit a record per timeslice and key')
+    parser.add_argument('--cursor', type=int, default=None, help='timeslice to start from (pagination)')
+    parser.add_argument('--limit', type=int, default=None, help='maximum number of timeslices')
     cmd_args = parser.parse_args()
     configuration = load_config(cmd_args.config)
+    lib.aggregates.BaseFlowAggregator.storage_backend = configuration.storage_backend
+    key_fields = cmd_args.key_fields.split(',')
 
-    timeseries = dict()
     if cmd_args.sample == '':
         # fetch all measurements from selected data provider
-        dimension_keys = list()
+        obj = None
+        dimension_keys = set()
         for agg_class in lib.aggregates.get_aggregators():
             if cmd_args.provider == agg_class.__name__:
                 obj = agg_class(cmd_args.resolution, database_dir=configuration.database_dir)
-                for record in obj.get_timeserie_data(cmd_args.start_time, cmd_args.end_time,
-                                                     cmd_args.key_fields.split(',')):
-                    record_key = []
-                    for key_field in cmd_args.key_fields.split(','):
-                        if key_field in record and record[key_field] is not None:
-                            record_key.append(record[key_field])
-                        else:
-                            record_key.append('')
-                    record_key = ','.join(record_key)
-                    start_time_stamp = calendar.timegm(record['start_time'].timetuple())
-                    if start_time_stamp not in timeseries:
-                        timeseries[start_time_stamp] = dict()
-                    timeseries[start_time_stamp][record_key] = {'octets': record['octets'],
-                                                                'packets': record['packets'],
-                                                                'resolution': cmd_args.resolution}
-                    if record_key not in dimension_keys:
-                        dimension_keys.append(record_key)
+                for record in obj.get_distinct_data(cmd_args.start_time, cmd_args.end_time, key_fields):
+                    dimension_keys.add(record_key(record, key_fields))
 
         # When there's no data found, collect keys from the running configuration to render empty results
         if len(dimension_keys) == 0 and os.path.isfile('/usr/local/etc/netflow.conf'):
             tmp = open('/usr/local/etc/netflow.conf').read()
             if tmp.find('netflow_interfaces="') > -1:
                 for intf in tmp.split('netflow_interfaces="')[-1].split('"')[0].split():
-                    dimension_keys.append('%s,in' % intf)
-                    dimension_keys.append('%s,out' % intf)
+                    dimension_keys.add('%s,in' % intf)
+                    dimension_keys.add('%s,out' % intf)
 
         # make sure all timeslices for every dimension key exist (resample collected data)
-        start_time = cmd_args.start_time
-        while start_time < time.time():
-            if start_time not in timeseries:
-                timeseries[start_time] = dict()
-            for dimension_key in dimension_keys:
-                if dimension_key not in timeseries[start_time]:
-                    timeseries[start_time][dimension_key] = {
-                        'octets': 0,
-                        'packets': 0,
+        slices = timeserie_slices(
+            obj, cmd_args.start_time, cmd_args.end_time, cmd_args.resolution, key_fields, dimension_keys,
+            cmd_args.cursor
+        )
+    else:
+        # generate sample data for given keys, continue at the first timeslice from the cursor when provided
+        def sample_slices():
+            start_time = cmd_args.start_time
+            if cmd_args.cursor is not None and cmd_args.cursor > start_time:
+                start_time += -(-(cmd_args.cursor - start_time) // cmd_args.resolution) * cmd_args.resolution
+            while start_time < time.time():
+                data = dict()
+                for key in cmd_args.sample.split('~'):
+                    data[key] = {
+                        'octets': (random.random() * 10000000),
+                        'packets': (random.random() * 10000000),
                         'resolution': cmd_args.resolution
                     }
-            start_time += cmd_args.resolution
+                yield start_time, data
+                start_time += cmd_args.resolution
+        slices = sample_slices()
+
+    if cmd_args.format == 'json':
+        # single object, timestamp => dimension key => values
+        sys.stdout.write('{')
+        for seq, (start_time, data) in enumerate(paginate(slices, cmd_args.limit)):
+            if data is not None:
+                sys.stdout.write('%s"%d":%s' % (',' if seq > 0 else '', start_time, ujson.dumps(data)))
+        sys.stdout.write('}\n')
+    elif cmd_args.format == 'ndjson':
+        # a line per timeslice and key, ends with {"next_cursor": <timestamp>} when more data is available
+        for start_time, data in paginate(slices, cmd_args.limit):
+            if data is None:
+                sys.stdout.write('%s\n' % ujson.dumps({'next_cursor': start_time}))
+            else:
+                for key in data:
+                    sys.stdout.write('%s\n' % ujson.dumps(dict({'timestamp': start_time, 'key': key}, **data[key])))
     else:
-        # generate sample data for given keys
-        timeseries = dict()
-        start_time = cmd_args.start_time
-        while start_time < time.time():
-            timeseries[start_time] = dict()
-            for key in cmd_args.sample.split('~'):
-                timeseries[start_time][key] = {
-                    'octets': (random.random() * 10000000),
-                    'packets': (random.random() * 10000000),
-                    'resolution': cmd_args.resolution
-                }
-            start_time += cmd_args.resolution
-
-    print (ujson.dumps(timeseries))
+        # csv, the next cursor is the last timestamp + resolution
+        writer = csv.writer(sys.stdout)
+        writer.writerow(['timestamp', 'key', 'octets', 'packets', 'resolution'])
+        for start_time, data in paginate(slices, cmd_args.limit):
+            if data is not None:
+                for key in data:
+                    writer.writerow(
+                        [start_time, key, data[key]['octets'], data[key]['packets'], data[key]['resolution']]
+                    )
@@ -45,8 +45,12 @@ if __name__ == '__main__':
     parser.add_argument('--value_field', required=True)
     parser.add_argument('--filter', default='')
     parser.add_argument('--max_hits', type=int, required=True)
+    parser.add_argument(
+        '--approximate', help='use the top sketch for closed buckets, results are approximate', action='store_true'
+    )
     cmd_args = parser.parse_args()
     configuration = load_config(cmd_args.config)
+    lib.aggregates.BaseFlowAggregator.storage_backend = configuration.storage_backend
 
     result = dict()
     for agg_class in lib.aggregates.get_aggregators():
@@ -70,6 +74,7 @@ if __name__ == '__main__':
                 fields=cmd_args.key_fields.split(','),
                 value_field=cmd_args.value_field,
                 data_filters=cmd_args.filter,
-                max_hits=cmd_args.max_hits
+                max_hits=cmd_args.max_hits,
+                exact=not cmd_args.approximate
             )
     print (ujson.dumps(result))
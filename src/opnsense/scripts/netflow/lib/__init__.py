@@ -51,6 +51,10 @@ class Config(object):
     flowd_source = '/var/log/flowd.log'
     database_dir = '/var/netflow'
     single_pass = False
+    aggregate_workers = 1
+    follow = False
+    follow_commit_interval = 10
+    storage_backend = 'sqlite'
 
     def __init__(self, **kwargs):
         for key in kwargs:
@@ -111,3 +111,57 @@ class AggMetadata(object):
         else:
             self._db_cursor.execute('select max(mtime) from sync_timestamp')
             return self._db_cursor.fetchall()[0][0]
+
+    def update_read_position(self, inode, offset):
+        """ update the read position within the flowd log file (follow mode)
+        :param inode: inode of the file being read
+        :param offset: byte offset after the last processed record
+        """
+        if 'read_position' not in self._tables:
+            self._db_cursor.execute('create table read_position(inode integer, offset integer)')
+            self._db_cursor.execute('insert into read_position(inode, offset) values(0, 0)')
+            self._db_connection.commit()
+            self._update_known_tables()
+        self._db_cursor.execute(
+            'update read_position set inode = :inode, offset = :offset', {'inode': inode, 'offset': offset}
+        )
+        self._db_connection.commit()
+
+    def read_position(self):
+        """ last known read position within the flowd log file
+        :return: tuple (inode, offset) or None when unknown
+        """
+        if 'read_position' not in self._tables:
+            return None
+        self._db_cursor.execute('select inode, offset from read_position')
+        record = self._db_cursor.fetchone()
+        return (record[0], record[1]) if record is not None and record[0] != 0 else None
+
+    def update_rollup_watermark(self, target, timestamp):
+        """ update rollup watermark, buckets before this timestamp are closed
+        :param target: target (aggregate filename)
+        :param timestamp: seconds since epoch
+        """
+        if 'rollup_watermark' not in self._tables:
+            # aggregators may run in parallel, table might be created by another process
+            self._db_cursor.execute(
+                'create table if not exists rollup_watermark(target varchar(255) primary key, mtime integer)'
+            )
+            self._db_connection.commit()
+            self._update_known_tables()
+        self._db_cursor.execute(
+            'insert or replace into rollup_watermark(target, mtime) values(:target, :mtime)',
+            {'target': target, 'mtime': timestamp}
+        )
+        self._db_connection.commit()
+
+    def rollup_watermark(self, target):
+        """ rollup watermark for target
+        :param target: target (aggregate filename)
+        :return: seconds since epoch, 0 when unknown
+        """
+        if 'rollup_watermark' not in self._tables:
+            return 0
+        self._db_cursor.execute('select mtime from rollup_watermark where target = :target', {'target': target})
+        record = self._db_cursor.fetchone()
+        return record[0] if record is not None else 0
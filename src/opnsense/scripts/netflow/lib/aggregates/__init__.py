@@ -32,7 +32,7 @@ import glob
 import syslog
 import datetime
 import sqlite3
-from lib.aggregate import convert_timestamp
+from lib.aggregate import convert_timestamp, AggMetadata
 sqlite3.register_converter('timestamp', convert_timestamp)
 
 
@@ -41,6 +41,14 @@ class BaseFlowAggregator(object):
     target_filename = None
     # list of fields to use in this aggregate
     agg_fields = None
+    # maximum number of pre-aggregated (mtime, agg_fields) entries kept in memory before flushing to the database
+    max_buffer_size = 50000
+    # seconds (data time) after which a rolled up bucket is considered closed and won't be recalculated
+    rollup_grace = 3600
+    # storage used to answer queries, sqlite or duckdb (day partitioned columnar copy, see lib/columnar.py)
+    storage_backend = 'sqlite'
+    # number of heaviest entries (per value field) kept for every closed bucket to answer top queries, None disables
+    top_sketch_size = 1000
 
     @classmethod
     def resolutions(cls):
@@ -49,6 +57,15 @@ class BaseFlowAggregator(object):
         """
         return list()
 
+    @classmethod
+    def rollup_source(cls, resolution):
+        """ coarser resolutions are derived from the largest finer resolution which fits exactly
+        :param resolution: sample resolution
+        :return: source resolution or None when collected from flow data
+        """
+        candidates = [x for x in cls.resolutions() if x < resolution and resolution % x == 0]
+        return max(candidates) if len(candidates) > 0 else None
+
     @classmethod
     def history_per_resolution(cls):
         """ history to keep in seconds per sample resolution
@@ -70,18 +87,28 @@ class BaseFlowAggregator(object):
         """
         self.database_dir = database_dir
         self.resolution = resolution
+        # derived resolutions only receive data using rollup()
+        self.rollup_from = self.rollup_source(resolution)
+        self._columnar = None
+        if self.storage_backend == 'duckdb' and self.target_filename is not None:
+            from lib.columnar import ColumnarStorage
+            self._columnar = ColumnarStorage(
+                database_dir, (self.target_filename % resolution).split('.')[0], self.agg_fields, resolution
+            )
         # target table name, data_<resolution in seconds>
         self._db_connection = None
         self._update_cur = None
         self._known_targets = list()
-        # construct update and insert sql statements
-        tmp = 'update timeserie set  last_seen = :flow_end, '
-        tmp += 'octets = octets + :octets_consumed, packets = packets + :packets_consumed '
-        tmp += 'where mtime = :mtime and %s '
-        self._update_stmt = tmp % (' and '.join(['%s = :%s' % (x, x) for x in self.agg_fields]))
+        # pre-aggregated data, (start_time, agg field values) => [octets, packets, last_seen]
+        self._buffer = dict()
+        # construct upsert sql statement
         tmp = 'insert into timeserie (mtime, last_seen, octets, packets, %s) '
-        tmp += 'values (:mtime, :flow_end, :octets_consumed, :packets_consumed, %s)'
-        self._insert_stmt = tmp % (','.join(self.agg_fields), ','.join([':%s' % x for x in self.agg_fields]))
+        tmp += 'values (?, ?, ?, ?, %s) '
+        tmp += 'on conflict (mtime, %s) do update set last_seen = max(last_seen, excluded.last_seen), '
+        tmp += 'octets = octets + excluded.octets, packets = packets + excluded.packets'
+        self._upsert_stmt = tmp % (
+            ','.join(self.agg_fields), ','.join(['?' for x in self.agg_fields]), ','.join(self.agg_fields)
+        )
         # open database
         self._open_db()
         self._fetch_known_targets()
@@ -152,47 +179,213 @@ class BaseFlowAggregator(object):
             # open update/insert cursor
             self._update_cur = self._db_connection.cursor()
 
+    def flush(self):
+        """ write pre-aggregated data to the database
+        :return: None
+        """
+        if self._buffer and self.is_db_open():
+            # make sure target exists
+            if 'timeserie' not in self._known_targets:
+                self._create_target_table()
+            self._update_cur.executemany(
+                self._upsert_stmt,
+                [
+                    (datetime.datetime.utcfromtimestamp(key[0]), value[2], value[0], value[1]) + key[1]
+                    for key, value in self._buffer.items()
+                ]
+            )
+        self._buffer = dict()
+
     def commit(self):
         """ commit data
         :return: None
         """
         if self._db_connection is not None:
+            self.flush()
             self._db_connection.commit()
 
-    def add(self, flow):
-        """ calculate timeslices per flow depending on sample resolution
+    def add(self, flow, agg_values=None):
+        """ calculate timeslices per flow depending on sample resolution, data is accumulated in memory until
+            commit() or the buffer limit is reached.
         :param flow: flow data (from parse.py)
+        :param agg_values: values for agg_fields, extracted from flow when not provided
         :return: None
         """
-        # make sure target exists
-        if 'timeserie' not in self._known_targets:
-            self._create_target_table()
-
-        # push record(s) depending on resolution
-        start_time = int(flow['flow_start'] / self.resolution) * self.resolution
-        while start_time <= flow['flow_end']:
-            consume_start_time = max(flow['flow_start'], start_time)
-            consume_end_time = min(start_time + self.resolution, flow['flow_end'])
-            if flow['duration_ms'] != 0:
-                consume_perc = (consume_end_time - consume_start_time) / float(flow['duration_ms'] / 1000.0)
+        if self.rollup_from is not None:
+            return
+        if agg_values is None:
+            agg_values = tuple(flow[x] for x in self.agg_fields)
+        flow_start = flow['flow_start']
+        flow_end = flow['flow_end']
+        duration = flow['duration_ms'] / 1000.0
+
+        # accumulate record(s) depending on resolution
+        start_time = int(flow_start / self.resolution) * self.resolution
+        while start_time <= flow_end:
+            consume_start_time = max(flow_start, start_time)
+            consume_end_time = min(start_time + self.resolution, flow_end)
+            if duration != 0:
+                consume_perc = (consume_end_time - consume_start_time) / duration
             else:
                 consume_perc = 1
-            if self.is_db_open():
-                # upsert data
-                flow['octets_consumed'] = consume_perc * flow['octets']
-                flow['packets_consumed'] = consume_perc * flow['packets']
-                flow['mtime'] = datetime.datetime.utcfromtimestamp(start_time)
-                self._update_cur.execute(self._update_stmt, flow)
-                if self._update_cur.rowcount == 0:
-                    self._update_cur.execute(self._insert_stmt, flow)
+            key = (start_time, agg_values)
+            if key in self._buffer:
+                item = self._buffer[key]
+                item[0] += consume_perc * flow['octets']
+                item[1] += consume_perc * flow['packets']
+                if flow_end > item[2]:
+                    item[2] = flow_end
+            else:
+                self._buffer[key] = [consume_perc * flow['octets'], consume_perc * flow['packets'], flow_end]
             # next start time
             start_time += self.resolution
 
+        if len(self._buffer) > self.max_buffer_size:
+            self.flush()
+
+    def rollup(self):
+        """ derive this resolution from the (finer) source resolution by summing its buckets.
+            Buckets before the watermark (kept in AggMetadata) are closed, newer ones are recalculated on every call
+            to include late arrivals. The source keeps its data until it's past the watermark (see cleanup()).
+        :return: None
+        """
+        if self.rollup_from is None or not self.is_db_open():
+            return
+        source_filename = ("%s/%s" % (self.database_dir, self.target_filename)) % self.rollup_from
+        if not os.path.isfile(source_filename):
+            return
+        target = self.target_filename % self.resolution
+        self.commit()
+        cur = self._db_connection.cursor()
+        cur.execute('attach database :filename as rollup_source', {'filename': source_filename})
+        try:
+            cur.execute("select name from rollup_source.sqlite_master where name = 'timeserie'")
+            if len(cur.fetchall()) == 0:
+                return
+            cur.execute(
+                "select cast(strftime('%s', min(mtime)) as integer), cast(strftime('%s', max(mtime)) as integer) "
+                "from rollup_source.timeserie"
+            )
+            first_timestamp, last_timestamp = cur.fetchone()
+            if first_timestamp is None:
+                return
+            metadata = AggMetadata(self.database_dir)
+            stored_watermark = watermark = metadata.rollup_watermark(target)
+            if 'timeserie' not in self._known_targets:
+                self._create_target_table()
+                watermark = int(first_timestamp / self.resolution) * self.resolution
+            elif watermark == 0:
+                # existing data collected from flows, start at the first bucket fully covered by the source
+                watermark = -(-first_timestamp // self.resolution) * self.resolution
+            query_params = {'watermark': self._parse_timestamp(watermark), 'resolution': self.resolution}
+            cur.execute('delete from timeserie where mtime >= :watermark', query_params)
+            sql_text = 'insert into timeserie (mtime, last_seen, %(fields)s, octets, packets) \n'
+            sql_text += "select datetime(cast(strftime('%%s', mtime) as integer) / :resolution * :resolution, "
+            sql_text += "'unixepoch'), max(last_seen), %(fields)s, sum(octets), sum(packets) \n"
+            sql_text += 'from rollup_source.timeserie \n'
+            sql_text += 'where mtime >= :watermark \n'
+            sql_text += 'group by 1, %(fields)s'
+            cur.execute(sql_text % {'fields': ','.join(self.agg_fields)}, query_params)
+            self._db_connection.commit()
+            closed = int((last_timestamp - self.rollup_grace) / self.resolution) * self.resolution
+            if max(closed, watermark) != stored_watermark:
+                metadata.update_rollup_watermark(target, max(closed, watermark))
+            del metadata
+        finally:
+            self._db_connection.rollback()
+            cur.execute('detach database rollup_source')
+            cur.close()
+
+    def update_top_sketch(self):
+        """ maintain the heavy hitter summary of closed buckets (older than rollup_grace), used by get_top_data().
+            For every bucket with more than top_sketch_size entries, the top_sketch_size heaviest entries by octets
+            and by packets are copied into top_sketch, top_sketch_bucket registers all summarized buckets including
+            the traffic not represented in the sketch (rest_octets, rest_packets).
+            Smaller buckets are only registered, queries read them from timeserie.
+        :return: None
+        """
+        if not self.top_sketch_size or not self.is_db_open() or 'timeserie' not in self._known_targets:
+            return
+        self.commit()
+        cur = self._db_connection.cursor()
+        if 'top_sketch' not in self._known_targets:
+            sql_text = list()
+            sql_text.append('create table top_sketch ( ')
+            sql_text.append('   mtime timestamp')
+            sql_text.append(',  last_seen timestamp')
+            for agg_field in self.agg_fields:
+                sql_text.append(', %s varchar(255)' % agg_field)
+            sql_text.append(',  octets numeric')
+            sql_text.append(',  packets numeric')
+            sql_text.append(',  primary key(mtime, %s)' % ','.join(self.agg_fields))
+            sql_text.append(');')
+            sql_text.append('create table top_sketch_bucket ( ')
+            sql_text.append('   mtime timestamp primary key')
+            sql_text.append(',  records integer')
+            sql_text.append(',  truncated integer')
+            sql_text.append(',  rest_octets numeric')
+            sql_text.append(',  rest_packets numeric')
+            sql_text.append(');')
+            cur.executescript('\n'.join(sql_text))
+            self._fetch_known_targets()
+
+        cur.execute("select cast(strftime('%s', max(mtime)) as integer) from top_sketch_bucket")
+        watermark = cur.fetchone()[0]
+        cur.execute(
+            "select cast(strftime('%s', min(mtime)) as integer), cast(strftime('%s', max(mtime)) as integer) "
+            "from timeserie"
+        )
+        first_timestamp, last_timestamp = cur.fetchone()
+        if first_timestamp is None:
+            cur.close()
+            return
+        watermark = first_timestamp if watermark is None else watermark + self.resolution
+        closed = int((last_timestamp - self.rollup_grace) / self.resolution) * self.resolution
+        if closed <= watermark:
+            cur.close()
+            return
+        query_params = {
+            'watermark': self._parse_timestamp(watermark),
+            'closed': self._parse_timestamp(closed),
+            'sketch_size': self.top_sketch_size
+        }
+        sql_text = 'insert into top_sketch (mtime, last_seen, %(fields)s, octets, packets) \n'
+        sql_text += 'select mtime, last_seen, %(fields)s, octets, packets \n'
+        sql_text += 'from ( \n'
+        sql_text += '   select *, count(*) over (partition by mtime) as records, \n'
+        sql_text += '          row_number() over (partition by mtime order by octets desc) as rank_octets, \n'
+        sql_text += '          row_number() over (partition by mtime order by packets desc) as rank_packets \n'
+        sql_text += '   from timeserie \n'
+        sql_text += '   where mtime >= :watermark and mtime < :closed \n'
+        sql_text += ') \n'
+        sql_text += 'where records > :sketch_size and (rank_octets <= :sketch_size or rank_packets <= :sketch_size)'
+        cur.execute(sql_text % {'fields': ','.join(self.agg_fields)}, query_params)
+        sql_text = 'insert into top_sketch_bucket (mtime, records, truncated, rest_octets, rest_packets) \n'
+        sql_text += 'select t.mtime, t.records, s.mtime is not null, \n'
+        sql_text += '       t.octets - coalesce(s.octets, t.octets), t.packets - coalesce(s.packets, t.packets) \n'
+        sql_text += 'from ( \n'
+        sql_text += '   select mtime, count(*) as records, sum(octets) as octets, sum(packets) as packets \n'
+        sql_text += '   from timeserie \n'
+        sql_text += '   where mtime >= :watermark and mtime < :closed \n'
+        sql_text += '   group by mtime \n'
+        sql_text += ') t \n'
+        sql_text += 'left join ( \n'
+        sql_text += '   select mtime, sum(octets) as octets, sum(packets) as packets \n'
+        sql_text += '   from top_sketch \n'
+        sql_text += '   where mtime >= :watermark and mtime < :closed \n'
+        sql_text += '   group by mtime \n'
+        sql_text += ') s on s.mtime = t.mtime'
+        cur.execute(sql_text, query_params)
+        self._db_connection.commit()
+        cur.close()
+
     def cleanup(self, do_vacuum=False):
-        """ cleanup timeserie table
+        """ rollup (derived resolutions), update top sketch and cleanup timeserie table
         :param do_vacuum: vacuum database
         :return: None
         """
+        self.rollup()
+        self.update_top_sketch()
         if self.is_db_open() and 'timeserie' in self._known_targets \
                 and self.resolution in self.history_per_resolution():
             self._update_cur.execute('select max(mtime) as "[timestamp]" from timeserie')
@@ -204,13 +397,34 @@ class BaseFlowAggregator(object):
                     # if data recorded seems to be in the future, use current timestamp for cleanup
                     # (prevent current data being removed)
                     expire_timestamp = datetime.datetime.now() - datetime.timedelta(seconds=expire)
+                # keep data which is not rolled up into derived resolutions yet
+                metadata = None
+                for resolution in self.resolutions():
+                    if self.rollup_source(resolution) == self.resolution:
+                        metadata = AggMetadata(self.database_dir) if metadata is None else metadata
+                        watermark = metadata.rollup_watermark(self.target_filename % resolution)
+                        expire_timestamp = min(expire_timestamp, self._parse_timestamp(watermark))
+                del metadata
 
                 self._update_cur.execute('delete from timeserie where mtime < :expire', {'expire': expire_timestamp})
+                if 'top_sketch' in self._known_targets:
+                    for table_name in ['top_sketch', 'top_sketch_bucket']:
+                        self._update_cur.execute(
+                            'delete from %s where mtime < :expire' % table_name, {'expire': expire_timestamp}
+                        )
                 self.commit()
                 if do_vacuum:
                     # vacuum database if requested
                     syslog.syslog(syslog.LOG_NOTICE, 'vacuum %s' % (self.target_filename % self.resolution))
                     self._update_cur.execute('vacuum')
+        if self._columnar is not None and self.is_db_open() and 'timeserie' in self._known_targets:
+            self._columnar.sync(self._db_connection, self.rollup_grace)
+
+    def _use_columnar(self):
+        """
+        :return: bool, queries should be answered by the columnar storage
+        """
+        return self._columnar is not None and self._columnar.has_data()
 
     @staticmethod
     def _parse_timestamp(timestamp):
@@ -238,14 +452,47 @@ class BaseFlowAggregator(object):
 
         return select_fields
 
+    def get_distinct_data(self, start_time, end_time, fields):
+        """ fetch distinct combinations of the selected fields within the provided timeframe
+        :param start_time: start timestamp
+        :param end_time: end timestamp
+        :param fields: fields to retrieve
+        :return: iterator returning dict records ([fields])
+        """
+        select_fields = self._valid_fields(fields)
+        if len(select_fields) == 0:
+            return
+        elif self._use_columnar():
+            yield from self._columnar.get_distinct_data(
+                self._parse_timestamp(start_time), self._parse_timestamp(end_time), select_fields
+            )
+        elif self.is_db_open() and 'timeserie' in self._known_targets:
+            sql_select = 'select distinct %s\n' % ','.join(select_fields)
+            sql_select += 'from timeserie \n'
+            sql_select += 'where mtime >= :start_time and mtime < :end_time\n'
+            cur = self._db_connection.cursor()
+            cur.execute(sql_select, {'start_time': self._parse_timestamp(start_time),
+                                     'end_time': self._parse_timestamp(end_time)})
+            for record in cur:
+                yield dict(zip(select_fields, record))
+            cur.close()
+
     def get_timeserie_data(self, start_time, end_time, fields):
-        """ fetch data from aggregation source, groups by mtime and selected fields
+        """ fetch data from aggregation source, groups by mtime and selected fields, ordered by mtime
         :param start_time: start timestamp
         :param end_time: end timestamp
         :param fields: fields to retrieve
         :return: iterator returning dict records (start_time, end_time, [fields], octets, packets)
         """
-        if self.is_db_open() and 'timeserie' in self._known_targets:
+        if self._use_columnar():
+            select_fields = self._valid_fields(fields)
+            yield from self._columnar.get_timeserie_data(
+                self._parse_timestamp(start_time),
+                self._parse_timestamp(end_time),
+                select_fields if len(select_fields) > 0 else ['null'],
+                self.resolution
+            )
+        elif self.is_db_open() and 'timeserie' in self._known_targets:
             # validate field list (can only select fields in self.agg_fields)
             select_fields = self._valid_fields(fields)
             if len(select_fields) == 0:
@@ -256,6 +503,7 @@ class BaseFlowAggregator(object):
             sql_select += 'from timeserie \n'
             sql_select += 'where mtime >= :start_time and mtime < :end_time\n'
             sql_select += 'group by mtime, %s\n' % ','.join(select_fields)
+            sql_select += 'order by mtime'
 
             # execute select query
             cur = self._db_connection.cursor()
@@ -263,7 +511,7 @@ class BaseFlowAggregator(object):
                                      'end_time': self._parse_timestamp(end_time)})
             #
             field_names = ([x[0] for x in cur.description])
-            for record in cur.fetchall():
+            for record in cur:
                 result_record = dict()
                 for field_indx in range(len(field_names)):
                     if len(record) > field_indx:
@@ -279,16 +527,20 @@ class BaseFlowAggregator(object):
             # close cursor
             cur.close()
 
-    def get_top_data(self, start_time, end_time, fields, value_field, data_filters=None, max_hits=100):
+    def get_top_data(self, start_time, end_time, fields, value_field, data_filters=None, max_hits=100, exact=True):
         """ Retrieve top (usage) from this aggregation.
             Fetch data from aggregation source, groups by selected fields, sorts by value_field descending
             use data_filter to filter before grouping.
+            When exact is disabled, closed buckets are read from the top sketch (see update_top_sketch()) when
+            available, entries outside the per bucket sketch are only accounted for in (other) when no filters are
+            used. Results from the sketch are approximate and flagged as such (approximate=True).
         :param start_time: start timestamp
         :param end_time: end timestamp
         :param fields: fields to retrieve
         :param value_field: field to sum
         :param data_filters: filter data, use as field=value
         :param max_hits: maximum number of results, rest is summed into (other)
+        :param exact: calculate the result from all collected data, disable to use the (faster) top sketch
         :return: iterator returning dict records (start_time, end_time, [fields], octets, packets)
         """
         result = list()
@@ -312,51 +564,117 @@ class BaseFlowAggregator(object):
                     if tmp in self.agg_fields and data_filter.find('=') > -1:
                         filter_fields.append(tmp)
                         query_params[tmp] = '='.join(data_filter.split('=')[1:])
+            sql_filter = ''.join([' and %s = :%s \n' % (x, x) for x in filter_fields])
+            use_sketch = not exact and value_field in ('octets', 'packets') and 'top_sketch' in self._known_targets
 
-            if len(select_fields) > 0:
+            if len(select_fields) > 0 and use_sketch:
+                cur = self._db_connection.cursor()
+                cur.execute(
+                    "select cast(strftime('%%s', max(mtime)) as integer), \n"
+                    "       coalesce(sum(case when mtime >= :start_time and mtime < :end_time \n"
+                    "                         then rest_%s end), 0) \n"
+                    "from top_sketch_bucket" % value_field,
+                    query_params
+                )
+                sketch_end, rest_total = cur.fetchone()
+                query_params['sketch_end'] = self._parse_timestamp(
+                    sketch_end + self.resolution if sketch_end is not None else 0
+                )
+                # truncated buckets from the sketch, small ones and the open (recent) buckets from timeserie
+                sql_select = 'select %s' % ','.join(select_fields)
+                sql_select += ', %s as total, max(last_seen) last_seen \n' % value_sql
+                sql_select += 'from ( \n'
+                sql_select += '   select * from top_sketch \n'
+                sql_select += '   where mtime >= :start_time and mtime < :end_time and mtime < :sketch_end \n'
+                sql_select += sql_filter
+                sql_select += '   union all \n'
+                sql_select += '   select t.* from top_sketch_bucket b \n'
+                sql_select += '   inner join timeserie t on t.mtime = b.mtime \n'
+                sql_select += '   where b.mtime >= :start_time and b.mtime < :end_time and b.truncated = 0 \n'
+                sql_select += ''.join([' and t.%s = :%s \n' % (x, x) for x in filter_fields])
+                sql_select += '   union all \n'
+                sql_select += '   select * from timeserie \n'
+                sql_select += '   where mtime >= :start_time and mtime < :end_time and mtime >= :sketch_end \n'
+                sql_select += sql_filter
+                sql_select += ') \n'
+                sql_select += 'group by %s\n' % ','.join(select_fields)
+                sql_select += 'order by %s desc ' % value_sql
+                cur.execute(sql_select, query_params)
+                result = self._top_records(cur, max_hits)
+                cur.close()
+                if len(filter_fields) == 0 and rest_total > 0:
+                    # traffic of truncated buckets not represented in the sketch
+                    if len(result) <= max_hits:
+                        result.append(dict([(x, "") for x in select_fields] + [('last_seen', ""), ('total', 0)]))
+                    result[-1]['total'] += rest_total
+                for record in result:
+                    record['approximate'] = True
+            elif len(select_fields) > 0 and self._use_columnar():
+                result = self._columnar.get_top_data(
+                    query_params['start_time'],
+                    query_params['end_time'],
+                    select_fields,
+                    value_field,
+                    dict([(x, query_params[x]) for x in filter_fields]),
+                    max_hits
+                )
+            elif len(select_fields) > 0:
                 # construct sql query to filter and select data
                 sql_select = 'select %s' % ','.join(select_fields)
                 sql_select += ', %s as total, max(last_seen) last_seen \n' % value_sql
                 sql_select += 'from timeserie \n'
                 sql_select += 'where mtime >= :start_time and mtime < :end_time\n'
-                for filter_field in filter_fields:
-                    sql_select += ' and %s = :%s \n' % (filter_field, filter_field)
+                sql_select += sql_filter
                 sql_select += 'group by %s\n' % ','.join(select_fields)
                 sql_select += 'order by %s desc ' % value_sql
 
                 # execute select query
                 cur = self._db_connection.cursor()
                 cur.execute(sql_select, query_params)
-
-                # fetch all data, to a max of [max_hits] rows.
-                field_names = ([x[0] for x in cur.description])
-                for record in cur.fetchall():
-                    result_record = dict()
-                    for field_indx in range(len(field_names)):
-                        if len(record) > field_indx:
-                            result_record[field_names[field_indx]] = record[field_indx]
-                    if len(result) < max_hits:
-                        result.append(result_record)
-                    else:
-                        if len(result) == max_hits:
-                            # generate row for "rest of data"
-                            result.append({'total': 0})
-                            for key in result_record:
-                                if key not in result[-1]:
-                                    result[-1][key] = ""
-                        result[-1]['total'] += result_record['total']
+                result = self._top_records(cur, max_hits)
                 # close cursor
                 cur.close()
 
         return result
 
+    @staticmethod
+    def _top_records(cur, max_hits):
+        """ fetch ordered (top) results from cursor, to a max of [max_hits] rows, rest is summed into (other)
+        :param cur: executed cursor
+        :param max_hits: maximum number of results
+        :return: list of dict records
+        """
+        result = list()
+        field_names = ([x[0] for x in cur.description])
+        for record in cur.fetchall():
+            result_record = dict()
+            for field_indx in range(len(field_names)):
+                if len(record) > field_indx:
+                    result_record[field_names[field_indx]] = record[field_indx]
+            if len(result) < max_hits:
+                result.append(result_record)
+            else:
+                if len(result) == max_hits:
+                    # generate row for "rest of data"
+                    result.append({'total': 0})
+                    for key in result_record:
+                        if key not in result[-1]:
+                            result[-1][key] = ""
+                result[-1]['total'] += result_record['total']
+        return result
+
     def get_data(self, start_time, end_time):
-        """ get detail data
+        """ get detail data, ordered by mtime
         :param start_time: start timestamp
         :param end_time: end timestamp
         :return: iterator
         """
-        if self.is_db_open() and 'timeserie' in self._known_targets:
+        if self._use_columnar():
+            yield from self._columnar.get_data(
+                self._parse_timestamp((int(start_time/self.resolution))*self.resolution),
+                self._parse_timestamp(end_time)
+            )
+        elif self.is_db_open() and 'timeserie' in self._known_targets:
             query_params = dict()
             query_params['start_time'] = self._parse_timestamp((int(start_time/self.resolution))*self.resolution)
             query_params['end_time'] = self._parse_timestamp(end_time)
@@ -364,6 +682,7 @@ class BaseFlowAggregator(object):
             sql_select += '%s, octets, packets, last_seen as "last_seen [timestamp]"  \n' % ','.join(self.agg_fields)
             sql_select += 'from timeserie \n'
             sql_select += 'where mtime >= :start_time and mtime < :end_time\n'
+            sql_select += 'order by mtime'
             cur = self._db_connection.cursor()
             cur.execute(sql_select, query_params)
 
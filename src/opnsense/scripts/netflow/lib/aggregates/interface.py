@@ -67,9 +67,5 @@ class FlowInterfaceTotals(BaseFlowAggregator):
         :param flow: netflow data
         :return: None
         """
-        flow['if'] = flow['if_in']
-        flow['direction'] = 'in'
-        super(FlowInterfaceTotals, self).add(flow)
-        flow['if'] = flow['if_out']
-        flow['direction'] = 'out'
-        super(FlowInterfaceTotals, self).add(flow)
+        super(FlowInterfaceTotals, self).add(flow, (flow['if_in'], 'in'))
+        super(FlowInterfaceTotals, self).add(flow, (flow['if_out'], 'out'))
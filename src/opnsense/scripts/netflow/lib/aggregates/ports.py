@@ -64,8 +64,6 @@ class FlowDstPortTotals(BaseFlowAggregator):
 
     def add(self, flow):
         # most likely service (destination) port
-        flow['dst_port'] = min(flow['dst_port'], flow['src_port'])
-        flow['if'] = flow['if_in']
-        super(FlowDstPortTotals, self).add(flow)
-        flow['if'] = flow['if_out']
-        super(FlowDstPortTotals, self).add(flow)
+        dst_port = min(flow['dst_port'], flow['src_port'])
+        super(FlowDstPortTotals, self).add(flow, (flow['if_in'], flow['protocol'], dst_port))
+        super(FlowDstPortTotals, self).add(flow, (flow['if_out'], flow['protocol'], dst_port))
@@ -64,13 +64,8 @@ class FlowSourceAddrTotals(BaseFlowAggregator):
 
     def add(self, flow):
         # most likely service (destination) port
-        flow['if'] = flow['if_in']
-        flow['direction'] = 'in'
-        super(FlowSourceAddrTotals, self).add(flow)
-        flow['src_addr'] = flow['dst_addr']
-        flow['if'] = flow['if_out']
-        flow['direction'] = 'out'
-        super(FlowSourceAddrTotals, self).add(flow)
+        super(FlowSourceAddrTotals, self).add(flow, (flow['if_in'], flow['src_addr'], 'in'))
+        super(FlowSourceAddrTotals, self).add(flow, (flow['if_out'], flow['dst_addr'], 'out'))
 
 
 class FlowSourceAddrDetails(BaseFlowAggregator):
@@ -104,14 +99,11 @@ class FlowSourceAddrDetails(BaseFlowAggregator):
 
     def add(self, flow):
         # most likely service (destination) port
-        flow['service_port'] = min(flow['dst_port'], flow['src_port'])
-        flow['if'] = flow['if_in']
-        flow['direction'] = 'in'
-        super(FlowSourceAddrDetails, self).add(flow)
+        service_port = min(flow['dst_port'], flow['src_port'])
+        super(FlowSourceAddrDetails, self).add(
+            flow, (flow['if_in'], 'in', flow['src_addr'], flow['dst_addr'], service_port, flow['protocol'])
+        )
         # swap source and destination addresses for outgoing traffic
-        src_addr = flow['dst_addr']
-        flow['dst_addr'] = flow['src_addr']
-        flow['src_addr'] = src_addr
-        flow['if'] = flow['if_out']
-        flow['direction'] = 'out'
-        super(FlowSourceAddrDetails, self).add(flow)
+        super(FlowSourceAddrDetails, self).add(
+            flow, (flow['if_out'], 'out', flow['dst_addr'], flow['src_addr'], service_port, flow['protocol'])
+        )
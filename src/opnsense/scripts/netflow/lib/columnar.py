@@ -0,0 +1,374 @@
+"""
+    Copyright (c) 2024 Ad Schellevis <ad@opnsense.org>
+    All rights reserved.
+
+    Redistribution and use in source and binary forms, with or without
+    modification, are permitted provided that the following conditions are met:
+
+    1. Redistributions of source code must retain the above copyright notice,
+     this list of conditions and the following disclaimer.
+
+    2. Redistributions in binary form must reproduce the above copyright
+     notice, this list of conditions and the following disclaimer in the
+     documentation and/or other materials provided with the distribution.
+
+    THIS SOFTWARE IS PROVIDED ``AS IS'' AND ANY EXPRESS OR IMPLIED WARRANTIES,
+    INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY
+    AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+    AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY,
+    OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+    SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+    INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+    CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+    ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+    POSSIBILITY OF SUCH DAMAGE.
+
+    --------------------------------------------------------------------------------------
+    --------------------------------------------------------------------------------------
+    columnar copy of aggregated flow data, stored as day partitioned parquet files (integer epoch timestamps)
+    and queried using duckdb.
+"""
+import calendar
+import csv
+import datetime
+import glob
+import os
+import duckdb
+
+
+class ColumnarStorage(object):
+    """ mirror of a timeserie table (sqlite), parquet files per day in <database_dir>/columnar/<target>/.
+        Buckets closed before the grace period are final, sync() appends them as segments (<day>.<watermark>.parquet)
+        which are merged into a single file per day (<day>.parquet) once the day is complete. Rows which may still
+        receive updates are kept in open.parquet, rewritten on every sync().
+        Queries only scan the partitions within the requested range.
+    """
+    seconds_per_partition = 86400
+
+    def __init__(self, database_dir, target, agg_fields, resolution):
+        """
+        :param database_dir: database directory
+        :param target: target name (aggregate filename without extension)
+        :param agg_fields: aggregate fields
+        :param resolution: sample resolution of the timeserie table
+        """
+        self._path = '%s/columnar/%s' % (database_dir, target)
+        self._resolution = resolution
+        self._agg_fields = agg_fields
+        self._columns = [('mtime', 'BIGINT'), ('last_seen', 'DOUBLE')]
+        self._columns += [(x, 'VARCHAR') for x in agg_fields]
+        self._columns += [('octets', 'DOUBLE'), ('packets', 'DOUBLE')]
+
+    @staticmethod
+    def _quote(field):
+        return '"%s"' % field.replace('"', '""')
+
+    @staticmethod
+    def _literal(value):
+        """ string literal, for statements not supporting parameters (file names in copy)
+        """
+        return "'%s'" % value.replace("'", "''")
+
+    @staticmethod
+    def _epoch(timestamp):
+        """
+        :param timestamp: datetime.datetime (utc)
+        :return: seconds since epoch
+        """
+        return calendar.timegm(timestamp.timetuple())
+
+    def partitions(self):
+        """
+        :return: dict day number => list of tuples (parquet filename, watermark or None for a complete day)
+        """
+        result = dict()
+        for filename in glob.glob('%s/*.parquet' % self._path):
+            parts = os.path.basename(filename).split('.')
+            if parts[0].isdigit() and len(parts) == 2:
+                result.setdefault(int(parts[0]), []).append((filename, None))
+            elif parts[0].isdigit() and len(parts) == 3 and parts[1].isdigit():
+                result.setdefault(int(parts[0]), []).append((filename, int(parts[1])))
+        return result
+
+    def _open_filename(self):
+        return '%s/open.parquet' % self._path
+
+    def has_data(self):
+        return len(self.partitions()) > 0 or os.path.isfile(self._open_filename())
+
+    def _files(self, start_time, end_time):
+        """ partitions containing data between start_time and end_time
+        :param start_time: start timestamp (seconds since epoch)
+        :param end_time: end timestamp (seconds since epoch)
+        :return: list of filenames
+        """
+        first = int(start_time // self.seconds_per_partition)
+        last = int(end_time // self.seconds_per_partition)
+        result = list()
+        for day, files in sorted(self.partitions().items()):
+            if first <= day <= last:
+                result += [x[0] for x in files]
+        if os.path.isfile(self._open_filename()):
+            result.append(self._open_filename())
+        return result
+
+    def _watermark(self, partitions):
+        """
+        :param partitions: result of partitions()
+        :return: timestamp up to where (final) rows are stored in partitions, None when empty
+        """
+        result = None
+        for day, files in partitions.items():
+            for filename, watermark in files:
+                watermark = (day + 1) * self.seconds_per_partition if watermark is None else watermark
+                result = watermark if result is None else max(result, watermark)
+        return result
+
+    def _write(self, connection, filename, start_time, end_time=None):
+        """ write rows between start_time and end_time from the sqlite timeserie table into a parquet file,
+            removes the file when there are none.
+        :param connection: sqlite3 connection containing the timeserie table
+        :param filename: target filename
+        :param start_time: start timestamp (seconds since epoch)
+        :param end_time: end timestamp (seconds since epoch), None for all
+        :return: number of rows written
+        """
+        csv_filename = '%s/.%s.csv' % (self._path, os.path.basename(filename))
+        cur = connection.cursor()
+        # expressions to prevent timestamp conversions (detect_types)
+        sql_select = "select cast(strftime('%s', mtime) as integer), cast(last_seen as real), "
+        sql_select += '%s, octets, packets ' % ','.join(self._agg_fields)
+        sql_select += 'from timeserie where mtime >= :start_time '
+        params = {'start_time': datetime.datetime.utcfromtimestamp(start_time)}
+        if end_time is not None:
+            sql_select += 'and mtime < :end_time'
+            params['end_time'] = datetime.datetime.utcfromtimestamp(end_time)
+        cur.execute(sql_select, params)
+        row_count = 0
+        # no bulk interface between sqlite and duckdb available, transfer rows using a csv file
+        with open(csv_filename, 'w', newline='') as csv_h:
+            writer = csv.writer(csv_h, quoting=csv.QUOTE_ALL)
+            while True:
+                rows = cur.fetchmany(10000)
+                if len(rows) == 0:
+                    break
+                row_count += len(rows)
+                writer.writerows([['\\N' if value is None else value for value in row] for row in rows])
+        cur.close()
+        try:
+            if row_count == 0:
+                if os.path.isfile(filename):
+                    os.remove(filename)
+                return 0
+            columns = ', '.join(["%s: '%s'" % (self._literal(name), ctype) for name, ctype in self._columns])
+            db = duckdb.connect()
+            db.execute(
+                "copy (select * from read_csv(%s, header=false, delim=',', quote='\"', escape='\"', "
+                "nullstr='\\N', columns={%s}) order by mtime) to %s (format parquet)" % (
+                    self._literal(csv_filename), columns, self._literal('%s.tmp' % filename)
+                )
+            )
+            db.close()
+            os.replace('%s.tmp' % filename, filename)
+        finally:
+            os.remove(csv_filename)
+        return row_count
+
+    def _merge(self, day, files):
+        """ merge segments of a complete day into a single partition
+        :param day: day number
+        :param files: list of filenames
+        :return: None
+        """
+        filename = '%s/%010d.parquet' % (self._path, day)
+        db = duckdb.connect()
+        db.execute("copy (select * from read_parquet([%s]) order by mtime) to %s (format parquet)" % (
+            ','.join([self._literal(x) for x in files]), self._literal('%s.tmp' % filename)
+        ))
+        db.close()
+        os.replace('%s.tmp' % filename, filename)
+        for segment in files:
+            if segment != filename:
+                os.remove(segment)
+
+    def _remove(self, files):
+        for filename in files:
+            if os.path.isfile(filename):
+                os.remove(filename)
+
+    def sync(self, connection, grace=0):
+        """ synchronize partitions with the sqlite timeserie table. Appends rows of buckets closed [grace] seconds
+            before the last timestamp in sqlite which are newer than the stored data (watermark), rewrites the open
+            rows and removes partitions no longer in sqlite.
+        :param connection: sqlite3 connection containing the timeserie table
+        :param grace: number of seconds (before the last timestamp in sqlite) which may still receive updates
+        :return: None
+        """
+        cur = connection.cursor()
+        cur.execute(
+            "select cast(strftime('%s', min(mtime)) as integer), cast(strftime('%s', max(mtime)) as integer) "
+            "from timeserie"
+        )
+        first_timestamp, last_timestamp = cur.fetchone()
+        cur.close()
+        partitions = self.partitions()
+        watermark = self._watermark(partitions)
+        if first_timestamp is None or (watermark is not None and watermark > last_timestamp + 1):
+            # empty or replaced, start over
+            self._remove([x[0] for files in partitions.values() for x in files] + [self._open_filename()])
+            partitions = dict()
+            watermark = None
+            if first_timestamp is None:
+                return
+        os.makedirs(self._path, exist_ok=True)
+        # only buckets which are fully closed are final, equal to rollup()
+        closed = int((last_timestamp - grace) / self._resolution) * self._resolution
+        start_time = first_timestamp if watermark is None else max(watermark, first_timestamp)
+        # append final rows, one segment per day named after the timestamp up to where the rows are included
+        while start_time < closed:
+            day = start_time // self.seconds_per_partition
+            end_time = min(closed, (day + 1) * self.seconds_per_partition)
+            filename = '%s/%010d.%010d.parquet' % (self._path, day, end_time)
+            if self._write(connection, filename, start_time, end_time) > 0:
+                partitions.setdefault(day, []).append((filename, end_time))
+            start_time = end_time
+        self._write(connection, self._open_filename(), max(start_time, closed))
+        # merge complete days, drop partitions expired from sqlite
+        first_day = first_timestamp // self.seconds_per_partition
+        for day, files in partitions.items():
+            if day < first_day:
+                self._remove([x[0] for x in files])
+            elif (day + 1) * self.seconds_per_partition <= closed and len(files) > 1:
+                self._merge(day, [x[0] for x in files])
+
+    def _query(self, files, sql_text, params):
+        """ execute query on partitions, the table is referred to as "timeserie"
+        :return: iterator returning tuple (field names, record), records are fetched in chunks
+        """
+        db = duckdb.connect()
+        try:
+            db.execute("SET TimeZone='UTC'")
+            db.execute(
+                'create temporary view timeserie as select * from read_parquet([%s])' %
+                ','.join([self._literal(x) for x in files])
+            )
+            cur = db.execute(sql_text, params)
+            field_names = [x[0] for x in cur.description]
+            while True:
+                records = cur.fetchmany(10000)
+                if len(records) == 0:
+                    break
+                for record in records:
+                    yield field_names, record
+        finally:
+            db.close()
+
+    def get_distinct_data(self, start_time, end_time, fields):
+        """ distinct combinations of fields
+        :param start_time: start timestamp (datetime.datetime)
+        :param end_time: end timestamp (datetime.datetime)
+        :param fields: validated fields
+        :return: iterator returning dict records ([fields])
+        """
+        start_time, end_time = self._epoch(start_time), self._epoch(end_time)
+        files = self._files(start_time, end_time)
+        if len(files) > 0:
+            sql_text = 'select distinct %s from timeserie \n' % ','.join([self._quote(x) for x in fields])
+            sql_text += 'where mtime >= $start_time and mtime < $end_time'
+            for field_names, record in self._query(files, sql_text, {'start_time': start_time, 'end_time': end_time}):
+                yield dict(zip(field_names, record))
+
+    def get_timeserie_data(self, start_time, end_time, fields, resolution):
+        """ group by mtime and selected fields
+        :param start_time: start timestamp (datetime.datetime)
+        :param end_time: end timestamp (datetime.datetime)
+        :param fields: validated fields, 'null' for none
+        :param resolution: sample resolution
+        :return: iterator returning dict records (start_time, end_time, [fields], octets, packets)
+        """
+        start_time, end_time = self._epoch(start_time), self._epoch(end_time)
+        files = self._files(start_time, end_time)
+        if len(files) == 0:
+            return
+        select_fields = ['null as "null"' if x == 'null' else self._quote(x) for x in fields]
+        sql_text = 'select mtime as start_time, %s, ' % ','.join(select_fields)
+        sql_text += 'sum(octets) as octets, sum(packets) as packets\n'
+        sql_text += 'from timeserie \n'
+        sql_text += 'where mtime >= $start_time and mtime < $end_time\n'
+        sql_text += 'group by all\n'
+        sql_text += 'order by 1'
+        for field_names, record in self._query(files, sql_text, {'start_time': start_time, 'end_time': end_time}):
+            result_record = dict(zip(field_names, record))
+            result_record['start_time'] = datetime.datetime.utcfromtimestamp(result_record['start_time'])
+            result_record['end_time'] = result_record['start_time'] + datetime.timedelta(seconds=resolution)
+            yield result_record
+
+    def get_top_data(self, start_time, end_time, fields, value_field, filters, max_hits):
+        """ group by selected fields, sort by value_field descending, rows after [max_hits] are summed into
+            a single row (see BaseFlowAggregator.get_top_data())
+        :param start_time: start timestamp (datetime.datetime)
+        :param end_time: end timestamp (datetime.datetime)
+        :param fields: validated fields to retrieve
+        :param value_field: field to sum
+        :param filters: dict field => value
+        :param max_hits: maximum number of results
+        :return: list
+        """
+        start_time, end_time = self._epoch(start_time), self._epoch(end_time)
+        files = self._files(start_time, end_time)
+        if len(files) == 0:
+            return list()
+        value_sql = 'sum(%s)' % value_field if value_field in ('octets', 'packets') else '0'
+        params = {'start_time': start_time, 'end_time': end_time, 'max_hits': max_hits}
+        sql_where = 'where mtime >= $start_time and mtime < $end_time\n'
+        for idx, filter_field in enumerate(filters):
+            sql_where += ' and %s = $filter_%d \n' % (self._quote(filter_field), idx)
+            params['filter_%d' % idx] = filters[filter_field]
+        select_fields = ','.join([self._quote(x) for x in fields])
+        sql_text = 'with grouped as (\n'
+        sql_text += '  select %s, %s as total, max(last_seen) last_seen \n' % (select_fields, value_sql)
+        sql_text += '  from timeserie \n'
+        sql_text += sql_where
+        sql_text += '  group by %s\n' % select_fields
+        sql_text += '), ranked as (select *, row_number() over (order by total desc) as rownum from grouped)\n'
+        sql_text += 'select %s, total, last_seen, rownum from ranked where rownum <= $max_hits \n' % select_fields
+        sql_text += 'union all \n'
+        sql_text += 'select %s, sum(total), null, $max_hits + 1 from ranked where rownum > $max_hits \n' % ','.join(
+            ['null' for x in fields]
+        )
+        sql_text += 'having count(*) > 0 \n'
+        sql_text += 'order by rownum'
+        result = list()
+        for field_names, record in self._query(files, sql_text, params):
+            result_record = dict(zip(field_names[:-1], record[:-1]))
+            if record[-1] > max_hits:
+                # "rest of data"
+                result_record = {'total': result_record['total']}
+                for key in field_names[:-1]:
+                    if key not in result_record:
+                        result_record[key] = ""
+            result.append(result_record)
+        return result
+
+    def get_data(self, start_time, end_time):
+        """ detail data
+        :param start_time: start timestamp (datetime.datetime)
+        :param end_time: end timestamp (datetime.datetime)
+        :return: iterator
+        """
+        start_time, end_time = self._epoch(start_time), self._epoch(end_time)
+        files = self._files(start_time, end_time)
+        if len(files) == 0:
+            return
+        sql_text = 'select mtime as start_time, %s, octets, packets, last_seen \n' % ','.join(
+            [self._quote(x) for x in self._agg_fields]
+        )
+        sql_text += 'from timeserie \n'
+        sql_text += 'where mtime >= $start_time and mtime < $end_time\n'
+        sql_text += 'order by mtime'
+        for field_names, record in self._query(files, sql_text, {'start_time': start_time, 'end_time': end_time}):
+            result_record = dict(zip(field_names, record))
+            result_record['start_time'] = datetime.datetime.utcfromtimestamp(result_record['start_time'])
+            if result_record['last_seen'] is not None:
+                result_record['last_seen'] = datetime.datetime.utcfromtimestamp(result_record['last_seen'])
+            yield result_record
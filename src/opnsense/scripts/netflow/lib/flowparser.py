@@ -26,11 +26,124 @@
     --------------------------------------------------------------------------------------
     flowd log parser
 """
+import mmap
 import struct
 import syslog
+from array import array
 from socket import inet_ntop, AF_INET, AF_INET6, ntohl
 
 
+class FlowBatch:
+    """ batch of decoded flow records stored in columns, addresses are kept in their binary form and formatted
+        on request (using a cache shared between batches of the same parser).
+    """
+    # array type columns (name, typecode)
+    columns = [
+        ('recv', 'L'), ('flow_start', 'd'), ('flow_end', 'd'), ('duration_ms', 'q'), ('octets', 'Q'),
+        ('packets', 'Q'), ('src_port', 'H'), ('dst_port', 'H'), ('protocol', 'B'), ('if_ndx_in', 'q'),
+        ('if_ndx_out', 'q')
+    ]
+
+    def __init__(self, address_cache):
+        self._address_cache = address_cache
+        self.recv = array('L')
+        self.flow_start = array('d')
+        self.flow_end = array('d')
+        self.duration_ms = array('q')
+        self.octets = array('Q')
+        self.packets = array('Q')
+        self.src_port = array('H')
+        self.dst_port = array('H')
+        self.protocol = array('B')
+        self.if_ndx_in = array('q')
+        self.if_ndx_out = array('q')
+        self.src_addr = list()
+        self.dst_addr = list()
+
+    def __len__(self):
+        return len(self.recv)
+
+    def select_received_after(self, recv_stamp):
+        """ select records received after recv_stamp
+        :param recv_stamp: receive timestamp
+        :return: FlowBatch
+        """
+        result = FlowBatch(self._address_cache)
+        for idx in range(len(self.recv)):
+            if self.recv[idx] > recv_stamp:
+                for column, typecode in self.columns:
+                    getattr(result, column).append(getattr(self, column)[idx])
+                result.src_addr.append(self.src_addr[idx])
+                result.dst_addr.append(self.dst_addr[idx])
+        return result
+
+    def to_bytes(self):
+        """ serialize batch
+        :return: tuple (list of part sizes, bytes)
+        """
+        parts = [getattr(self, column).tobytes() for column, typecode in self.columns]
+        parts.append(array('B', [len(x) for x in self.src_addr + self.dst_addr]).tobytes())
+        parts.append(b''.join(self.src_addr))
+        parts.append(b''.join(self.dst_addr))
+        return [len(x) for x in parts], b''.join(parts)
+
+    @classmethod
+    def from_bytes(cls, sizes, data, address_cache):
+        """ deserialize batch (data is copied)
+        :param sizes: list of part sizes
+        :param data: bytes like object
+        :param address_cache: dict to cache formatted addresses in
+        :return: FlowBatch
+        """
+        result = cls(address_cache)
+        offset = 0
+        for (column, typecode), size in zip(cls.columns, sizes):
+            getattr(result, column).frombytes(bytes(data[offset:offset + size]))
+            offset += size
+        address_lengths = bytes(data[offset:offset + sizes[-3]])
+        offset += sizes[-3]
+        # source addresses are followed by destination addresses
+        for idx, length in enumerate(address_lengths):
+            target = result.src_addr if idx < len(result.recv) else result.dst_addr
+            target.append(bytes(data[offset:offset + length]))
+            offset += length
+        return result
+
+    def address(self, raw_address):
+        """ format binary address
+        :param raw_address: 4 or 16 bytes address
+        :return: str
+        """
+        if raw_address not in self._address_cache:
+            if len(self._address_cache) > 65536:
+                self._address_cache.clear()
+            family = AF_INET if len(raw_address) == 4 else AF_INET6
+            self._address_cache[raw_address] = inet_ntop(family, raw_address)
+        return self._address_cache[raw_address]
+
+    def records(self):
+        """ iterate records in this batch as dictionaries, containing the fields used for aggregation
+        :return: iterator
+        """
+        for idx in range(len(self.recv)):
+            yield {
+                'recv': self.recv[idx],
+                'recv_sec': self.recv[idx],
+                'flow_start': self.flow_start[idx],
+                'flow_end': self.flow_end[idx],
+                'duration_ms': self.duration_ms[idx],
+                'octets': self.octets[idx],
+                'packets': self.packets[idx],
+                'src_port': self.src_port[idx],
+                'dst_port': self.dst_port[idx],
+                'protocol': self.protocol[idx],
+                'if_ndx_in': self.if_ndx_in[idx],
+                'if_ndx_out': self.if_ndx_out[idx],
+                'src_addr': self.address(self.src_addr[idx]),
+                'dst_addr': self.address(self.dst_addr[idx])
+            }
+
+
 class FlowParser:
     # fields in order of appearance, use bitmask compare
     field_definition_order = [
@@ -78,11 +191,24 @@ class FlowParser:
         'flow_engine_info': 'HHII'
     }
 
+    # fields (big endian or byte sized) used in bulk decoding mode, others are skipped as raw data
+    bulk_fields = [
+        'recv_time', 'proto_flags_tos', 'src_addr4', 'src_addr6', 'dst_addr4', 'dst_addr6', 'srcdst_port',
+        'packets', 'octets', 'if_indices', 'agent_info', 'flow_times'
+    ]
+
     def __init__(self, filename, recv_stamp=None):
         self._filename = filename
         self._recv_stamp = recv_stamp
+        # read position of the last iter_batches() call
+        self.offset = 0
         # cache formatter vs byte length
         self._fmt_cache = dict()
+        # compiled record layouts per field bitmask
+        self._layouts = dict()
+        self._bulk_layouts = dict()
+        # formatted addresses, shared between batches
+        self._address_cache = dict()
         # pre-calculate powers of 2
         self._pow = dict()
         for idx in range(len(self.field_definition_order)):
@@ -97,36 +223,156 @@ class FlowParser:
                     self._fmt_cache[fmt] += fmts[key]
         return self._fmt_cache[fmt]
 
+    def _layout(self, data_fields):
+        """ compile record layout for field bitmask
+        :param data_fields: field bitmask, provided by header
+        :return: list of tuples (fieldname, offset, size, struct.Struct or None for raw data)
+        """
+        if data_fields not in self._layouts:
+            layout = list()
+            offset = 0
+            for idx in range(len(self.field_definition_order)):
+                if self._pow[idx] & data_fields:
+                    fieldname = self.field_definition_order[idx]
+                    if type(self.field_definition[fieldname]) is int:
+                        fsize = self.field_definition[fieldname]
+                        layout.append((fieldname, offset, fsize, None))
+                    else:
+                        fsize = self.calculate_size(self.field_definition[fieldname])
+                        layout.append((fieldname, offset, fsize, struct.Struct(self.field_definition[fieldname])))
+                    offset += fsize
+            self._layouts[data_fields] = layout
+        return self._layouts[data_fields]
+
+    def _bulk_layout(self, data_fields):
+        """ compile a single struct.Struct to decode all fields of a record with the provided bitmask at once
+        :param data_fields: field bitmask, provided by header
+        :return: tuple (struct.Struct, dict fieldname => first index in unpacked tuple) or None when records
+                 using this layout can't be used for aggregation
+        """
+        if data_fields not in self._bulk_layouts:
+            fmt = '>'
+            positions = dict()
+            value_idx = 0
+            for fieldname, offset, fsize, fstruct in self._layout(data_fields):
+                if fieldname in self.bulk_fields:
+                    positions[fieldname] = value_idx
+                    if fstruct is None:
+                        fmt += '%ds' % fsize
+                        value_idx += 1
+                    else:
+                        fmt += fstruct.format.lstrip('>')
+                        value_idx += len(fstruct.unpack(bytes(fsize)))
+                else:
+                    fmt += '%dx' % fsize
+            required = [
+                'recv_time' in positions, 'agent_info' in positions, 'packets' in positions, 'octets' in positions,
+                'src_addr4' in positions or 'src_addr6' in positions,
+                'dst_addr4' in positions or 'dst_addr6' in positions
+            ]
+            self._bulk_layouts[data_fields] = (struct.Struct(fmt), positions) if all(required) else None
+        return self._bulk_layouts[data_fields]
+
     def _parse_binary(self, raw_data, data_fields):
         """ parse binary record
         :param raw_data: binary data record
         :param data_fields: field bitmask, provided by header
         :return: dict
         """
-        raw_data_idx = 0
         raw_record = dict()
-        for idx in range(len(self.field_definition_order)):
-            if self._pow[idx] & data_fields:
-                fieldname = self.field_definition_order[idx]
-                if fieldname in self.field_definition:
-                    if type(self.field_definition[fieldname]) is int:
-                        fsize = self.field_definition[fieldname]
-                        raw_record[fieldname] = raw_data[raw_data_idx:raw_data_idx + fsize]
-                    else:
-                        fsize = self.calculate_size(self.field_definition[fieldname])
-                        try:
-                            content = struct.unpack(
-                                self.field_definition[fieldname],
-                                raw_data[raw_data_idx:raw_data_idx + fsize]
-                            )
-                            raw_record[fieldname] = content[0] if len(content) == 1 else content
-                        except struct.error as e:
-                            # the flowd record doesn't appear to be as expected, log for now.
-                            syslog.syslog(syslog.LOG_NOTICE, "flowparser failed to unpack %s (%s)" % (fieldname, e))
-                    raw_data_idx += fsize
+        for fieldname, offset, fsize, fstruct in self._layout(data_fields):
+            if fstruct is None:
+                raw_record[fieldname] = raw_data[offset:offset + fsize]
+            else:
+                try:
+                    content = fstruct.unpack_from(raw_data, offset)
+                    raw_record[fieldname] = content[0] if len(content) == 1 else content
+                except struct.error as e:
+                    # the flowd record doesn't appear to be as expected, log for now.
+                    syslog.syslog(syslog.LOG_NOTICE, "flowparser failed to unpack %s (%s)" % (fieldname, e))
 
         return raw_record
 
+    def iter_batches(self, batch_size=10000, offset=0):
+        """ iterate flowd log file in batches of column oriented records (see FlowBatch), only contains the
+            fields needed for aggregation. Records received within the same second are kept in the same batch.
+            When a batch is yielded, self.offset points to the first byte after the records handed out so far,
+            which can be used to resume reading later on.
+        :param batch_size: number of records per batch (exceeded when the receive timestamp doesn't change)
+        :param offset: byte offset to start reading from, should point to the start of a record
+        :return: iterator
+        """
+        self.offset = offset
+        with open(self._filename, 'rb') as flowh:
+            try:
+                buffer = mmap.mmap(flowh.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                # empty file
+                return
+            header_struct = struct.Struct('BBHI')
+            batch = FlowBatch(self._address_cache)
+            pos = offset
+            consumed = offset
+            buffer_size = len(buffer)
+            while pos + 8 <= buffer_size:
+                header = header_struct.unpack_from(buffer, pos)
+                record_start = pos + 8
+                pos = record_start + header[1] * 4
+                if pos > buffer_size:
+                    # incomplete record (still being written)
+                    break
+                record_offset = consumed
+                consumed = pos
+                layout = self._bulk_layout(ntohl(header[3]))
+                if layout is None or layout[0].size > header[1] * 4:
+                    continue
+                values = layout[0].unpack_from(buffer, record_start)
+                fields = layout[1]
+                recv_sec = values[fields['recv_time']]
+                if self._recv_stamp is not None and recv_sec < self._recv_stamp:
+                    continue
+                if len(batch) >= batch_size and batch.recv[-1] != recv_sec:
+                    # only split batches on receive timestamp changes
+                    self.offset = record_offset
+                    yield batch
+                    batch = FlowBatch(self._address_cache)
+                sys_uptime_ms = values[fields['agent_info']]
+                if 'flow_times' in fields:
+                    flow_start = values[fields['flow_times']]
+                    flow_finish = values[fields['flow_times'] + 1]
+                else:
+                    flow_start = flow_finish = sys_uptime_ms
+                flow_end = recv_sec - (sys_uptime_ms - flow_finish) / 1000.0
+                duration_ms = flow_finish - flow_start
+                batch.recv.append(recv_sec)
+                batch.flow_end.append(flow_end)
+                batch.duration_ms.append(duration_ms)
+                batch.flow_start.append(flow_end - duration_ms / 1000.0)
+                batch.octets.append(values[fields['octets']])
+                batch.packets.append(values[fields['packets']])
+                if 'srcdst_port' in fields:
+                    batch.src_port.append(values[fields['srcdst_port']])
+                    batch.dst_port.append(values[fields['srcdst_port'] + 1])
+                else:
+                    batch.src_port.append(0)
+                    batch.dst_port.append(0)
+                if 'proto_flags_tos' in fields:
+                    batch.protocol.append(values[fields['proto_flags_tos'] + 1])
+                else:
+                    batch.protocol.append(0)
+                if 'if_indices' in fields:
+                    batch.if_ndx_in.append(values[fields['if_indices']])
+                    batch.if_ndx_out.append(values[fields['if_indices'] + 1])
+                else:
+                    batch.if_ndx_in.append(-1)
+                    batch.if_ndx_out.append(-1)
+                batch.src_addr.append(values[fields['src_addr6' if 'src_addr6' in fields else 'src_addr4']])
+                batch.dst_addr.append(values[fields['dst_addr6' if 'dst_addr6' in fields else 'dst_addr4']])
+            buffer.close()
+            self.offset = consumed
+            if len(batch) > 0:
+                yield batch
+
     def __iter__(self):
         """ iterate flowd log file
         :return:
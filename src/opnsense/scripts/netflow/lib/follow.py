@@ -0,0 +1,142 @@
+"""
+    Copyright (c) 2024 Ad Schellevis <ad@opnsense.org>
+    All rights reserved.
+
+    Redistribution and use in source and binary forms, with or without
+    modification, are permitted provided that the following conditions are met:
+
+    1. Redistributions of source code must retain the above copyright notice,
+     this list of conditions and the following disclaimer.
+
+    2. Redistributions in binary form must reproduce the above copyright
+     notice, this list of conditions and the following disclaimer in the
+     documentation and/or other materials provided with the distribution.
+
+    THIS SOFTWARE IS PROVIDED ``AS IS'' AND ANY EXPRESS OR IMPLIED WARRANTIES,
+    INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY
+    AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+    AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY,
+    OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+    SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+    INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+    CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+    ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+    POSSIBILITY OF SUCH DAMAGE.
+
+    --------------------------------------------------------------------------------------
+    --------------------------------------------------------------------------------------
+    follow flowd log appends, keeps track of the read position (inode, offset) so only new records are parsed
+"""
+import glob
+import os
+import select
+import time
+from lib.flowparser import FlowParser
+
+
+class FlowdFollower(object):
+    """ read new records from the flowd log as they are appended, handles rotation (see check_rotate) by finishing
+        the rotated file (located by inode) before moving to the new one.
+    """
+    def __init__(self, flowd_source, position=None, recv_stamp=0, batch_size=10000):
+        """
+        :param flowd_source: flowd logfile
+        :param position: tuple (inode, offset) of the last processed record or None when unknown
+        :param recv_stamp: last processed receive timestamp, records up to this timestamp are skipped on the first
+                           read (position unknown or records processed after the position was stored)
+        :param batch_size: (approx.) number of records per batch
+        """
+        self._flowd_source = flowd_source
+        self._batch_size = batch_size
+        self._recv_stamp = recv_stamp if recv_stamp else None
+        self._inode, self._offset = position if position is not None else (None, 0)
+
+    @property
+    def position(self):
+        """
+        :return: tuple (inode, offset) after the last batch handed out
+        """
+        return self._inode, self._offset
+
+    def _find_inode(self, inode):
+        """ locate (rotated) flowd log by inode
+        :param inode: inode number
+        :return: filename or None when not found
+        """
+        for filename in glob.glob('%s*' % self._flowd_source):
+            try:
+                if os.stat(filename).st_ino == inode:
+                    return filename
+            except OSError:
+                pass
+        return None
+
+    def _read(self, filename):
+        """ read batches from filename, starting at the current offset
+        :param filename: flowd logfile
+        :return: iterator FlowBatch
+        """
+        parser = FlowParser(filename, self._recv_stamp)
+        for batch in parser.iter_batches(self._batch_size, self._offset):
+            self._offset = parser.offset
+            if self._recv_stamp is not None and min(batch.recv) <= self._recv_stamp:
+                batch = batch.select_received_after(self._recv_stamp)
+            if len(batch) > 0:
+                yield batch
+        self._offset = parser.offset
+        # position known from here on
+        self._recv_stamp = None
+
+    def batches(self):
+        """ iterate batches appended since the last call, the position is updated before a batch is handed out
+            so it can be persisted after processing. Iteration may be stopped at any time.
+        :return: iterator FlowBatch
+        """
+        try:
+            stat = os.stat(self._flowd_source)
+        except OSError:
+            # no log (yet)
+            return
+        if self._inode is not None and stat.st_ino != self._inode:
+            # rotated, finish reading the previous file when it still exists
+            filename = self._find_inode(self._inode)
+            if filename is not None:
+                yield from self._read(filename)
+            else:
+                # records not read from the rotated file are lost
+                self._recv_stamp = None
+            self._inode, self._offset = stat.st_ino, 0
+        elif self._inode is None:
+            self._inode, self._offset = stat.st_ino, 0
+        elif stat.st_size < self._offset:
+            # truncated
+            self._offset = 0
+        if stat.st_size > self._offset:
+            yield from self._read(self._flowd_source)
+
+    def wait(self, timeout):
+        """ wait for flowd to write to the log, falls back to sleeping when kqueue is not available
+        :param timeout: maximum number of seconds to wait
+        :return: None
+        """
+        if hasattr(select, 'kqueue'):
+            try:
+                fd = os.open(self._flowd_source, os.O_RDONLY)
+            except OSError:
+                time.sleep(timeout)
+                return
+            kq = select.kqueue()
+            try:
+                if os.fstat(fd).st_size == self._offset and os.fstat(fd).st_ino == self._inode:
+                    kq.control([select.kevent(
+                        fd,
+                        filter=select.KQ_FILTER_VNODE,
+                        flags=select.KQ_EV_ADD | select.KQ_EV_CLEAR,
+                        fflags=select.KQ_NOTE_WRITE | select.KQ_NOTE_EXTEND | select.KQ_NOTE_RENAME |
+                               select.KQ_NOTE_DELETE
+                    )], 1, timeout)
+            finally:
+                kq.close()
+                os.close(fd)
+        else:
+            time.sleep(timeout)
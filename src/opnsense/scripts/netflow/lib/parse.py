@@ -37,10 +37,16 @@ from lib.flowparser import FlowParser
 class Interfaces(object):
     """ mapper for local interface index to interface name (1 -> em0 for example)
     """
+    # fixed index to name mapping used instead of ifinfo when set (replaying logs off-box, tests)
+    static_map = None
+
     def __init__(self):
         """ construct local interface mapping
         """
         self._if_index = dict()
+        if self.static_map is not None:
+            self._if_index.update(self.static_map)
+            return
         sp = subprocess.run(['/usr/local/sbin/ifinfo'], capture_output=True, text=True)
         interfaces = re.findall(r"Interface ([^ ]+)", sp.stdout)
 
@@ -58,13 +64,45 @@ class Interfaces(object):
             return "%s" % if_index
 
 
-def parse_flow(recv_stamp, flowd_source='/var/log/flowd.log'):
+def parse_flow_batches(recv_stamp, flowd_source='/var/log/flowd.log'):
+    """ parse flowd logs and yield column oriented batches (see FlowBatch) received after recv_stamp
+    :param recv_stamp: last receive timestamp (recv)
+    :param flowd_source: flowd logfile
+    :return: iterator FlowBatch
+    """
+    parse_done = False
+    for filename in sorted(glob.glob('%s*' % flowd_source)):
+        if parse_done:
+            # log file contains older data (recv_stamp), break
+            break
+        for batch in FlowParser(filename, recv_stamp).iter_batches():
+            if min(batch.recv) <= recv_stamp:
+                # do not parse next flow archive (oldest reached)
+                parse_done = True
+                batch = batch.select_received_after(recv_stamp)
+            if len(batch) > 0:
+                yield batch
+
+
+def parse_flow(recv_stamp, flowd_source='/var/log/flowd.log', bulk=False):
     """ parse flowd logs and yield records (dict type)
     :param recv_stamp: last receive timestamp (recv)
     :param flowd_source: flowd logfile
+    :param bulk: use bulk decoding, records only contain the fields needed for aggregation
     :return: iterator flow details
     """
     interfaces = Interfaces()
+    if bulk:
+        for batch in parse_flow_batches(recv_stamp, flowd_source):
+            for flow_record in batch.records():
+                # map interface indexes to actual interface names
+                flow_record['if_in'] = interfaces.if_device(flow_record['if_ndx_in'])
+                flow_record['if_out'] = interfaces.if_device(flow_record['if_ndx_out'])
+                yield flow_record
+        # send None to mark last record
+        yield None
+        return
+
     parse_done = False
     for filename in sorted(glob.glob('%s*' % flowd_source)):
         if parse_done:
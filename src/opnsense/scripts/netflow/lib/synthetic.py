@@ -0,0 +1,149 @@
+"""
+    Copyright (c) 2024 Ad Schellevis <ad@opnsense.org>
+    All rights reserved.
+
+    Redistribution and use in source and binary forms, with or without
+    modification, are permitted provided that the following conditions are met:
+
+    1. Redistributions of source code must retain the above copyright notice,
+     this list of conditions and the following disclaimer.
+
+    2. Redistributions in binary form must reproduce the above copyright
+     notice, this list of conditions and the following disclaimer in the
+     documentation and/or other materials provided with the distribution.
+
+    THIS SOFTWARE IS PROVIDED ``AS IS'' AND ANY EXPRESS OR IMPLIED WARRANTIES,
+    INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY
+    AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+    AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY,
+    OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+    SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+    INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+    CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+    ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+    POSSIBILITY OF SUCH DAMAGE.
+
+
+    --------------------------------------------------------------------------------------
+    write synthetic flowd log files (binary, as read by lib.flowparser) for benchmarking and testing
+"""
+import random
+import struct
+from socket import htonl
+from lib.flowparser import FlowParser
+
+
+class FlowSynthesizer:
+    """ generate flowd records with a configurable number of distinct hosts, ports and interfaces
+    """
+    # field bitmask variants, records are evenly distributed over the selected variants
+    variants = {
+        # all fields flowd logs by default
+        'full': [
+            'tag', 'recv_time', 'proto_flags_tos', 'agent_addr', 'src_addr', 'dst_addr', 'gateway_addr',
+            'srcdst_port', 'packets', 'octets', 'if_indices', 'agent_info', 'flow_times', 'as_info',
+            'flow_engine_info'
+        ],
+        # fields used for aggregation only
+        'aggregate': [
+            'recv_time', 'proto_flags_tos', 'src_addr', 'dst_addr', 'srcdst_port', 'packets', 'octets',
+            'if_indices', 'agent_info', 'flow_times'
+        ],
+        # minimal usable record, no ports, protocol, interfaces or flow times
+        'minimal': ['recv_time', 'src_addr', 'dst_addr', 'packets', 'octets', 'agent_info']
+    }
+
+    def __init__(self, hosts=1000, ports=100, interfaces=4, ipv6_ratio=0.2, variants=None, seed=None):
+        """ construct synthesizer
+        :param hosts: number of distinct host addresses
+        :param ports: number of distinct (destination) ports
+        :param interfaces: number of interface indexes
+        :param ipv6_ratio: fraction of the hosts using an ipv6 address
+        :param variants: list of field variants to use (see variants), all when None
+        :param seed: random seed
+        """
+        self._random = random.Random(seed)
+        self._hosts = list()
+        for idx in range(max(hosts, 1)):
+            if self._random.random() < ipv6_ratio:
+                self._hosts.append(b'\x20\x01\x0d\xb8' + self._random.getrandbits(96).to_bytes(12, 'big'))
+            else:
+                self._hosts.append(bytes([10]) + self._random.getrandbits(24).to_bytes(3, 'big'))
+        self._ports = [self._random.randint(1, 65535) for idx in range(max(ports, 1))]
+        self._interfaces = max(interfaces, 1)
+        self._masks = list()
+        for variant in (variants if variants else sorted(self.variants)):
+            self._masks.append(self.variants[variant])
+
+    @staticmethod
+    def _field_mask(fields, ipv6):
+        """
+        :param fields: list of field names, address fields without family suffix
+        :param ipv6: use ipv6 addresses
+        :return: field bitmask
+        """
+        result = 0
+        for field in fields:
+            if field.endswith('_addr'):
+                field = '%s%d' % (field, 6 if ipv6 else 4)
+            result |= 1 << FlowParser.field_definition_order.index(field)
+        return result
+
+    def records(self, count, start_time, duration):
+        """ generate binary flowd records, receive times are spread evenly over [start_time, start_time + duration]
+        :param count: number of records
+        :param start_time: first receive timestamp
+        :param duration: number of seconds to spread records over
+        :return: iterator bytes (header + record)
+        """
+        header = struct.Struct('BBHI')
+        # netflow agent uptime (ms) at start_time
+        boot_uptime = 3600000
+        for idx in range(count):
+            recv_time = start_time + (idx * duration) // max(count, 1)
+            src_addr = self._random.choice(self._hosts)
+            dst_addr = self._random.choice(self._hosts)
+            if len(src_addr) != len(dst_addr):
+                dst_addr = src_addr
+            ipv6 = len(src_addr) == 16
+            fields = self._masks[idx % len(self._masks)]
+            sys_uptime = boot_uptime + (recv_time - start_time) * 1000
+            flow_finish = sys_uptime - self._random.randint(0, 30000)
+            flow_start = flow_finish - self._random.randint(0, 300000)
+            packets = self._random.randint(1, 1000)
+            values = {
+                'tag': struct.pack('I', 0),
+                'recv_time': struct.pack('>II', recv_time, self._random.randint(0, 999999)),
+                'proto_flags_tos': struct.pack('BBBB', 0x18, self._random.choice([6, 17, 1]), 0, 0),
+                'agent_addr': bytes(16 if ipv6 else 4),
+                'src_addr': src_addr,
+                'dst_addr': dst_addr,
+                'gateway_addr': bytes(16 if ipv6 else 4),
+                'srcdst_port': struct.pack(
+                    '>HH', self._random.randint(1024, 65535), self._random.choice(self._ports)
+                ),
+                'packets': struct.pack('>Q', packets),
+                'octets': struct.pack('>Q', packets * self._random.randint(40, 1500)),
+                'if_indices': struct.pack(
+                    '>II', self._random.randint(1, self._interfaces), self._random.randint(1, self._interfaces)
+                ),
+                'agent_info': struct.pack('>IIIHH', sys_uptime, recv_time, 0, 9, 0),
+                'flow_times': struct.pack('>II', max(flow_start, 0), max(flow_finish, 0)),
+                'as_info': struct.pack('IIBBH', 0, 0, 0, 0, 0),
+                'flow_engine_info': struct.pack('HHII', 0, 0, 0, 0)
+            }
+            data = b''.join([values[x] for x in fields])
+            yield header.pack(3, len(data) // 4, 0, htonl(self._field_mask(fields, ipv6))) + data
+
+    def write(self, filename, count, start_time, duration):
+        """ write flowd log file
+        :param filename: target filename
+        :param count: number of records
+        :param start_time: first receive timestamp
+        :param duration: number of seconds to spread records over
+        :return: number of bytes written
+        """
+        with open(filename, 'wb') as f_out:
+            for record in self.records(count, start_time, duration):
+                f_out.write(record)
+            return f_out.tell()
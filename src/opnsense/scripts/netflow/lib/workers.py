@@ -0,0 +1,248 @@
+"""
+    Copyright (c) 2024 Ad Schellevis <ad@opnsense.org>
+    All rights reserved.
+
+    Redistribution and use in source and binary forms, with or without
+    modification, are permitted provided that the following conditions are met:
+
+    1. Redistributions of source code must retain the above copyright notice,
+     this list of conditions and the following disclaimer.
+
+    2. Redistributions in binary form must reproduce the above copyright
+     notice, this list of conditions and the following disclaimer in the
+     documentation and/or other materials provided with the distribution.
+
+    THIS SOFTWARE IS PROVIDED ``AS IS'' AND ANY EXPRESS OR IMPLIED WARRANTIES,
+    INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY
+    AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+    AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY,
+    OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+    SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+    INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+    CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+    ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+    POSSIBILITY OF SUCH DAMAGE.
+
+    --------------------------------------------------------------------------------------
+    distribute parsed flow batches over aggregator worker processes using shared memory
+"""
+import collections
+import multiprocessing
+import queue
+from multiprocessing import shared_memory, resource_tracker
+from lib.flowparser import FlowBatch
+from lib.parse import Interfaces
+
+
+def _worker_main(database_dir, agg_specs, commands, acks, worker_id):
+    """ worker process, feed received batches into its aggregators
+    :param database_dir: database directory
+    :param agg_specs: list of (aggregator class, resolution) tuples
+    :param commands: command queue
+    :param acks: queue to acknowledge processed commands on
+    :param worker_id: sequence of this worker
+    :return: None
+    """
+    aggregators = [agg_class(resolution, database_dir) for agg_class, resolution in agg_specs]
+    interfaces = Interfaces()
+    address_cache = dict()
+    while True:
+        command = commands.get()
+        if command[0] == 'batch':
+            shm = shared_memory.SharedMemory(name=command[1])
+            try:
+                batch = FlowBatch.from_bytes(command[2], shm.buf, address_cache)
+            finally:
+                shm.close()
+            for flow_record in batch.records():
+                flow_record['if_in'] = interfaces.if_device(flow_record['if_ndx_in'])
+                flow_record['if_out'] = interfaces.if_device(flow_record['if_ndx_out'])
+                for aggregator in aggregators:
+                    aggregator.add(flow_record)
+        elif command[0] == 'commit':
+            for aggregator in aggregators:
+                aggregator.commit()
+        elif command[0] == 'cleanup':
+            for aggregator in aggregators:
+                aggregator.commit()
+                aggregator.cleanup(command[1])
+        elif command[0] == 'stop':
+            for aggregator in aggregators:
+                aggregator.commit()
+                aggregator.cleanup(command[1])
+            acks.put(worker_id)
+            break
+        acks.put(worker_id)
+
+
+class AggregatorPool(object):
+    """ fan out flow batches to worker processes, each owning a subset of the aggregators (sqlite files).
+        All resolutions of an aggregator class are kept in the same worker, so rollups (derived resolutions)
+        are calculated in order. Batches are serialized once into a shared memory segment, which is released
+        after all workers acknowledged processing.
+    """
+    def __init__(self, database_dir, agg_specs, workers, max_pending=4):
+        """
+        :param database_dir: database directory
+        :param agg_specs: list of (aggregator class, resolution) tuples
+        :param workers: number of worker processes
+        :param max_pending: maximum number of batches not yet processed by all workers
+        """
+        self._max_pending = max_pending
+        self._pending = collections.deque()
+        self._sequence = 0
+        # share the resource tracker with the workers, shared memory segments are owned by this process
+        resource_tracker.ensure_running()
+        ctx = multiprocessing.get_context('fork')
+        self._acks = ctx.Queue()
+        self._queues = list()
+        self._processes = list()
+        agg_groups = collections.OrderedDict()
+        for agg_spec in agg_specs:
+            agg_groups.setdefault(agg_spec[0], list()).append(agg_spec)
+        agg_groups = list(agg_groups.values())
+        workers = max(1, min(workers, len(agg_groups)))
+        self._acked = [0] * workers
+        self._sent = [0] * workers
+        for worker_id in range(workers):
+            commands = ctx.Queue()
+            process = ctx.Process(
+                target=_worker_main,
+                args=(database_dir, sum(agg_groups[worker_id::workers], []), commands, self._acks, worker_id),
+                daemon=True
+            )
+            process.start()
+            self._queues.append(commands)
+            self._processes.append(process)
+
+    def _send(self, command):
+        for worker_id, commands in enumerate(self._queues):
+            commands.put(command)
+            self._sent[worker_id] += 1
+
+    def _get_ack(self, timeout):
+        """ register a single acknowledgement
+        :param timeout: seconds to wait
+        :return: bool, False when none was received
+        """
+        try:
+            self._acked[self._acks.get(timeout=timeout)] += 1
+            return True
+        except queue.Empty:
+            return False
+
+    def _wait_ack(self):
+        """ wait for a single acknowledgement, raise when a worker died
+        """
+        while not self._get_ack(1):
+            for worker_id, process in enumerate(self._processes):
+                # workers exit after acknowledging stop, only failures or unacknowledged commands are fatal
+                if not process.is_alive() and (process.exitcode != 0 or self._sent[worker_id] > self._acked[worker_id]):
+                    # an acknowledgement sent right before exit might still be in transit
+                    if not self._get_ack(1):
+                        raise RuntimeError('aggregator worker %d exited with %s' % (process.pid, process.exitcode))
+                    break
+            else:
+                continue
+            break
+        # release shared memory processed by all workers
+        while self._pending and min(self._acked) >= self._pending[0][0]:
+            shm = self._pending.popleft()[1]
+            shm.close()
+            shm.unlink()
+
+    def _drain(self):
+        """ wait until all workers processed all commands
+        """
+        while self._acked != self._sent:
+            self._wait_ack()
+
+    def add(self, batch):
+        """ send batch to all workers
+        :param batch: FlowBatch
+        :return: None
+        """
+        while len(self._pending) >= self._max_pending:
+            self._wait_ack()
+        sizes, payload = batch.to_bytes()
+        shm = shared_memory.SharedMemory(create=True, size=max(len(payload), 1))
+        shm.buf[:len(payload)] = payload
+        self._send(('batch', shm.name, sizes))
+        # all workers have processed this batch when every worker acknowledged up to this command
+        self._pending.append((self._sent[0], shm))
+
+    def commit(self):
+        """ commit all aggregators, returns when data is persisted
+        :return: None
+        """
+        self._send(('commit', ))
+        self._drain()
+
+    def cleanup(self, do_vacuum=False):
+        """ commit and expire old data, workers keep running
+        :param do_vacuum: vacuum databases after cleanup
+        :return: None
+        """
+        self._send(('cleanup', do_vacuum))
+        self._drain()
+
+    def close(self, do_vacuum=False):
+        """ commit, cleanup and stop workers
+        :param do_vacuum: vacuum databases after cleanup
+        :return: None
+        """
+        self._send(('stop', do_vacuum))
+        self._drain()
+        for process in self._processes:
+            process.join()
+
+    def terminate(self):
+        """ stop workers without committing pending data, release shared memory
+        :return: None
+        """
+        for process in self._processes:
+            if process.is_alive():
+                process.kill()
+        while self._pending:
+            shm = self._pending.popleft()[1]
+            shm.close()
+            shm.unlink()
+
+
+class LocalAggregators(object):
+    """ in process counterpart of AggregatorPool, feeds batches into aggregators directly
+    """
+    def __init__(self, database_dir, agg_specs):
+        """
+        :param database_dir: database directory
+        :param agg_specs: list of (aggregator class, resolution) tuples
+        """
+        self._aggregators = [agg_class(resolution, database_dir) for agg_class, resolution in agg_specs]
+        self._interfaces = Interfaces()
+
+    def add(self, batch):
+        """ aggregate batch
+        :param batch: FlowBatch
+        :return: None
+        """
+        for flow_record in batch.records():
+            flow_record['if_in'] = self._interfaces.if_device(flow_record['if_ndx_in'])
+            flow_record['if_out'] = self._interfaces.if_device(flow_record['if_ndx_out'])
+            for aggregator in self._aggregators:
+                aggregator.add(flow_record)
+
+    def commit(self):
+        for aggregator in self._aggregators:
+            aggregator.commit()
+
+    def cleanup(self, do_vacuum=False):
+        for aggregator in self._aggregators:
+            aggregator.commit()
+            aggregator.cleanup(do_vacuum)
+
+    def close(self, do_vacuum=False):
+        self.cleanup(do_vacuum)
+        self._aggregators = list()
+
+    def terminate(self):
+        self._aggregators = list()
@@ -0,0 +1 @@
+from .pipeline_tests import *
@@ -0,0 +1,134 @@
+import unittest
+import sys
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+import datetime
+sys.path.insert(0, "%s/.." % os.path.dirname(os.path.abspath(__file__)))
+from lib import Config
+from lib.flowparser import FlowParser
+from lib.parse import Interfaces
+from lib.synthetic import FlowSynthesizer
+from lib.aggregates import BaseFlowAggregator
+from lib.aggregates.source import FlowSourceAddrTotals
+from lib.aggregates.interface import FlowInterfaceTotals
+from lib.columnar import ColumnarStorage
+from flowd_aggregate import aggregate_flowd, aggregate_flowd_parallel, aggregate_flowd_follow
+
+
+class TestPipeline(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.flowd_source = '%s/flowd.log' % self.work_dir
+        Interfaces.static_map = {'1': 'if1', '2': 'if2', '3': 'if3', '4': 'if4'}
+        FlowSynthesizer(seed=1).write(self.flowd_source, 5000, int(time.time()) - 3600, 3600)
+        self.packets = sum([x['packets'] for x in FlowParser(self.flowd_source)])
+
+    def tearDown(self):
+        Interfaces.static_map = None
+        shutil.rmtree(self.work_dir)
+
+    def interface_packets(self, database_dir, resolution=30):
+        filename = '%s/interface_%06d.sqlite' % (database_dir, resolution)
+        with sqlite3.connect(filename) as conn:
+            return conn.execute("select sum(packets) from timeserie where direction = 'in'").fetchone()[0]
+
+    def test_replay_synthetic(self):
+        database_dir = '%s/netflow' % self.work_dir
+        aggregate_flowd(Config(flowd_source=self.flowd_source, database_dir=database_dir))
+        self.assertAlmostEqual(self.interface_packets(database_dir), self.packets, delta=1, msg='packets lost or counted twice')
+        # replaying again should not add data already processed
+        aggregate_flowd(Config(flowd_source=self.flowd_source, database_dir=database_dir))
+        self.assertAlmostEqual(self.interface_packets(database_dir), self.packets, delta=1, msg='records aggregated twice')
+
+    def test_replay_parallel(self):
+        # a day of data, workers finish their cleanup at different moments when stopped
+        FlowSynthesizer(seed=1).write(self.flowd_source, 30000, int(time.time()) - 86400, 86400)
+        self.packets = sum([x['packets'] for x in FlowParser(self.flowd_source)])
+        database_dir = '%s/netflow' % self.work_dir
+        aggregate_flowd_parallel(Config(flowd_source=self.flowd_source, database_dir=database_dir, aggregate_workers=3))
+        self.assertAlmostEqual(self.interface_packets(database_dir), self.packets, delta=1, msg='packets lost')
+        self.assertAlmostEqual(self.interface_packets(database_dir, 300), self.packets, delta=1, msg='rollup')
+
+    def test_follow_rotated(self):
+        # rotated (older) log and the current one, followed by appends to the current log
+        now = int(time.time())
+        FlowSynthesizer(seed=1).write('%s.000001' % self.flowd_source, 5000, now - 7200, 3600)
+        FlowSynthesizer(seed=2).write(self.flowd_source, 4000, now - 3000, 1200)
+        database_dir = '%s/netflow' % self.work_dir
+        config = Config(flowd_source=self.flowd_source, database_dir=database_dir, single_pass=True)
+        aggregate_flowd_follow(config, lambda: True)
+        FlowSynthesizer(seed=3).write('%s/append.log' % self.work_dir, 2000, now - 1200, 600)
+        with open(self.flowd_source, 'ab') as f_out, open('%s/append.log' % self.work_dir, 'rb') as f_in:
+            f_out.write(f_in.read())
+        aggregate_flowd_follow(config, lambda: True)
+        packets = sum([x['packets'] for x in FlowParser(self.flowd_source)])
+        packets += sum([x['packets'] for x in FlowParser('%s.000001' % self.flowd_source)])
+        self.assertAlmostEqual(self.interface_packets(database_dir), packets, delta=1, msg='packets lost or counted twice')
+
+    def test_top_data(self):
+        # closed buckets exceeding the (small) sketch size are truncated, exact results don't use the sketch
+        top_sketch_size = BaseFlowAggregator.top_sketch_size
+        BaseFlowAggregator.top_sketch_size = 5
+        try:
+            database_dir = '%s/netflow' % self.work_dir
+            aggregate_flowd(Config(flowd_source=self.flowd_source, database_dir=database_dir))
+        finally:
+            BaseFlowAggregator.top_sketch_size = top_sketch_size
+        now = int(time.time())
+        aggregator = FlowSourceAddrTotals(3600, database_dir)
+        exact = aggregator.get_top_data(now - 7200, now, ['src_addr'], 'packets', 'direction=in', max_hits=10)
+        approximate = aggregator.get_top_data(
+            now - 7200, now, ['src_addr'], 'packets', 'direction=in', max_hits=10, exact=False
+        )
+        self.assertAlmostEqual(sum([x['total'] for x in exact]), self.packets, delta=1, msg='exact top incomplete')
+        self.assertFalse(any('approximate' in x for x in exact))
+        self.assertTrue(all(x.get('approximate') for x in approximate))
+
+    def test_columnar(self):
+        # two days of history followed by an append, the columnar copy should match sqlite
+        now = int(time.time())
+        FlowSynthesizer(seed=1).write(self.flowd_source, 20000, now - 172800, 172800 - 7200)
+        database_dir = '%s/netflow' % self.work_dir
+        BaseFlowAggregator.storage_backend = 'duckdb'
+        try:
+            aggregate_flowd(Config(flowd_source=self.flowd_source, database_dir=database_dir))
+            FlowSynthesizer(seed=2).write('%s/append.log' % self.work_dir, 2000, now - 7200, 7000)
+            with open(self.flowd_source, 'ab') as f_out, open('%s/append.log' % self.work_dir, 'rb') as f_in:
+                f_out.write(f_in.read())
+            aggregate_flowd(Config(flowd_source=self.flowd_source, database_dir=database_dir))
+            aggregator = FlowInterfaceTotals(300, database_dir)
+            self.assertTrue(aggregator._columnar.has_data(), 'columnar copy missing')
+            with sqlite3.connect('%s/interface_000300.sqlite' % database_dir) as conn:
+                first, packets = conn.execute(
+                    "select cast(strftime('%s', min(mtime)) as integer), sum(packets) from timeserie"
+                ).fetchone()
+            columnar_packets = sum([x['packets'] for x in aggregator.get_data(first, now + 300)])
+        finally:
+            BaseFlowAggregator.storage_backend = 'sqlite'
+        self.assertAlmostEqual(columnar_packets, packets, delta=1, msg='columnar copy differs')
+
+    def test_columnar_closed(self):
+        # yesterday's daily bucket isn't closed until today is past the grace period, updates should be synced
+        today = int(time.time() // 86400) * 86400
+        conn = sqlite3.connect('%s/test.sqlite' % self.work_dir)
+        conn.execute('create table timeserie (mtime timestamp, last_seen timestamp, if varchar, octets, packets)')
+
+        def store(mtime, packets):
+            mtime = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(mtime))
+            conn.execute('delete from timeserie where mtime = ?', (mtime, ))
+            conn.execute('insert into timeserie values (?, ?, ?, ?, ?)', (mtime, None, 'em0', packets * 100, packets))
+
+        storage = ColumnarStorage(self.work_dir, 'test', ['if'], 86400)
+        store(today - 86400, 10)
+        store(today, 1)
+        storage.sync(conn, 3600)
+        store(today - 86400, 20)
+        storage.sync(conn, 3600)
+        packets = [x['packets'] for x in storage.get_data(
+            datetime.datetime.utcfromtimestamp(today - 86400), datetime.datetime.utcfromtimestamp(today)
+        )]
+        conn.close()
+        self.assertEqual(packets, [20], 'update of an open bucket not synced')
@@ -101,6 +101,8 @@ def main(cnf, single_threaded=False):
         config_path='%s/conf' % program_path,
         config_environment=config_environment,
         action_defaults=action_defaults,
+        max_workers=cnf.getint('main', 'max_workers', fallback=64),
+        max_queue=cnf.getint('main', 'max_queue', fallback=256)
     )
     proc_handler.single_threaded = single_threaded
     proc_handler.run()
@@ -34,6 +34,8 @@
 import argparse
 import socket
 import os.path
+import struct
+import threading
 import traceback
 import sys
 import syslog
@@ -44,6 +46,7 @@ from modules import syslog_error, syslog_notice
 __author__ = 'Ad Schellevis'
 
 configd_socket_name = '/var/run/configd.socket'
+configd_framed_magic = b'\x00cfd\x01'
 
 def exec_config_cmd(exec_command):
     """ execute command using configd socket
@@ -77,10 +80,74 @@ def exec_config_cmd(exec_command):
         sock.close()
 
 
+def exec_config_cmds(exec_commands):
+    """ execute multiple commands over a single configd connection using the framed protocol,
+        requests are pipelined (sent from a separate thread) while responses are read in order.
+    :param exec_commands: list of command strings
+    :return: generator of (command, response) tuples, response is None on failure
+    """
+    try:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(configd_socket_name)
+    except socket.error:
+        syslog_error('unable to connect to configd socket (@%s)'%configd_socket_name)
+        print('unable to connect to configd socket (@%s)'%configd_socket_name, file=sys.stderr)
+        for exec_command in exec_commands:
+            yield exec_command, None
+        return
+
+    def send_requests():
+        try:
+            sock.sendall(configd_framed_magic)
+            for exec_command in exec_commands:
+                payload = exec_command.encode()
+                sock.sendall(struct.pack('!I', len(payload)) + payload)
+        except OSError:
+            pass
+
+    def recv_exact(size):
+        data = b''
+        while len(data) < size:
+            chunk = sock.recv(size - len(data))
+            if not chunk:
+                raise EOFError('connection closed')
+            data += chunk
+        return data
+
+    sender = threading.Thread(target=send_requests, daemon=True)
+    sender.start()
+    idx = 0
+    try:
+        while idx < len(exec_commands):
+            response = []
+            while True:
+                chunk_size = struct.unpack('!I', recv_exact(4))[0]
+                if chunk_size == 0:
+                    break
+                response.append(recv_exact(chunk_size))
+            yield exec_commands[idx], b''.join(response).decode(errors='replace')
+            idx += 1
+    except KeyboardInterrupt:
+        # intentional
+        pass
+    except:
+        syslog_error('error in configd communication \n%s'%traceback.format_exc())
+        print ('error in configd communication, see syslog for details', file=sys.stderr)
+        for exec_command in exec_commands[idx:]:
+            yield exec_command, None
+    finally:
+        sock.close()
+
+
 parser = argparse.ArgumentParser()
 parser.add_argument("-e", help="use as event handler, execute command on receiving input", action="store_true")
 parser.add_argument("-d", help="detach the execution of the command and return immediately", action="store_true")
 parser.add_argument("-q", help="run quietly by muting standard output", action="store_true")
+parser.add_argument(
+    "-b",
+    help="batch mode, execute commands read from stdin (one per line) over a single connection",
+    action="store_true"
+)
 parser.add_argument("-w", help="wait specified amount of seconds for socket to become available", type=int, default=0)
 parser.add_argument(
     "-t",
@@ -140,6 +207,18 @@ if args.e:
                 cmd_outp = (' '.join(exec_config_cmd(exec_command=exec_command))).strip()
                 syslog_notice("event @ %.2f exec: %s response: %s" % (last_message_stamp, exec_command, cmd_outp))
             stashed_lines = list()
+elif args.b:
+    # batch mode, pipeline all commands over one connection
+    exec_commands = [line.strip() for line in sys.stdin if line.strip()]
+    if args.d:
+        exec_commands = ['&' + exec_command for exec_command in exec_commands]
+    exit_code = 0
+    for exec_command, response in exec_config_cmds(exec_commands):
+        if response is None:
+            exit_code = -1
+        elif not args.q:
+            print(response.rstrip())
+    sys.exit(exit_code)
 else:
     # normal execution mode
     for exec_command in exec_commands:
@@ -46,6 +46,10 @@ class BaseAction:
             self.cache_ttl = int(action_parameters['cache_ttl'])
         else:
             self.cache_ttl = None
+        if action_parameters.get('cache_stale', '').isdigit():
+            self.cache_stale = int(action_parameters['cache_stale'])
+        else:
+            self.cache_stale = 0
         self.allowed_groups = set()
         for item in action_parameters.get('allowed_groups', '').split(','):
             if item:
@@ -35,6 +35,9 @@ class Action(BaseAction):
         super().__init__(config_environment, action_parameters)
         self.root_dir = action_parameters.get('root_dir', None)
         self.config = action_parameters.get('config', None)
+        self.incremental = action_parameters.get('incremental', '0').strip() == '1'
+        self.workers = int(action_parameters.get('workers', '1'))
+        self.bytecode_cache = action_parameters.get('bytecode_cache', None)
 
     def execute(self, parameters, message_uuid, *args, **kwargs):
         super().execute(parameters, message_uuid, *args, **kwargs)
@@ -47,10 +50,19 @@ class Action(BaseAction):
 
             if self.command == 'template.reload':
                 # generate template
-                tmpl = template.Template(self.root_dir)
+                tmpl = template.Template(
+                    self.root_dir,
+                    incremental=self.incremental,
+                    workers=self.workers,
+                    bytecode_cache_dir=self.bytecode_cache
+                )
                 conf = config.Config(self.config)
                 tmpl.set_config(conf.get())
                 filenames = tmpl.generate(act_parameters)
+                syslog_debug('[%s] template %s rendered %d skipped %d unchanged %d' % (
+                    message_uuid, act_parameters, tmpl.stats['rendered'], tmpl.stats['skipped'],
+                    tmpl.stats['unchanged']
+                ))
 
                 del conf
                 del tmpl
@@ -101,6 +113,11 @@ class Action(BaseAction):
                         result.append('%s [ %s ]' % (action, actions[action]['description']))
 
                     return '\n'.join(result)
+            elif self.command == 'configd.stats':
+                # runtime statistics (worker pool, caches)
+                from ..processhandler import ActionHandler
+                import json
+                return json.dumps(ActionHandler().get_stats())
 
             return 'ERR'
         except Exception as inline_exception:
@@ -0,0 +1,143 @@
+"""
+    Copyright (c) 2024 Ad Schellevis <ad@opnsense.org>
+    All rights reserved.
+
+    Redistribution and use in source and binary forms, with or without
+    modification, are permitted provided that the following conditions are met:
+
+    1. Redistributions of source code must retain the above copyright notice,
+     this list of conditions and the following disclaimer.
+
+    2. Redistributions in binary form must reproduce the above copyright
+     notice, this list of conditions and the following disclaimer in the
+     documentation and/or other materials provided with the distribution.
+
+    THIS SOFTWARE IS PROVIDED ``AS IS'' AND ANY EXPRESS OR IMPLIED WARRANTIES,
+    INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY
+    AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+    AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY,
+    OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+    SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+    INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+    CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+    ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+    POSSIBILITY OF SUCH DAMAGE.
+
+    --------------------------------------------------------------------------------------
+    package : configd
+    function: in memory result cache for (cacheable) actions
+"""
+import collections
+import threading
+import time
+from . import singleton
+
+
+class _Flight(object):
+    """ single pending execution, concurrent requests for the same key wait on its event
+    """
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.exception = None
+
+
+@singleton
+class ResultCache(object):
+    """ LRU cache bounded by the total size of its payloads.
+        Concurrent requests for the same key are coalesced into a single execution (single-flight), when a
+        stale period is requested expired results are returned while a background thread refreshes the entry.
+    """
+
+    def __init__(self, max_bytes=32 * 1024 * 1024, max_entries=1024):
+        """
+        :param max_bytes: maximum number of bytes (characters) kept in the cache
+        :param max_entries: maximum number of entries kept in the cache
+        """
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self._entries = collections.OrderedDict()
+        self._flights = {}
+        self._size = 0
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'stale_hits': 0, 'coalesced': 0, 'evictions': 0, 'errors': 0}
+
+    def _store(self, key, value, ttl):
+        """ store result, evict least recently used entries when exceeding the budget (lock should be held)
+        """
+        if key in self._entries:
+            self._size -= self._entries.pop(key)['size']
+        size = len(value) if value is not None else 0
+        if size > self.max_bytes:
+            return
+        self._entries[key] = {'value': value, 'expire': time.time() + ttl, 'size': size}
+        self._size += size
+        while self._size > self.max_bytes or len(self._entries) > self.max_entries:
+            _, entry = self._entries.popitem(last=False)
+            self._size -= entry['size']
+            self._stats['evictions'] += 1
+
+    def _execute(self, key, ttl, func, flight):
+        """ execute func for key and release waiters
+        """
+        try:
+            flight.result = func()
+        except Exception as e:
+            flight.exception = e
+        with self._lock:
+            if flight.exception is None:
+                self._store(key, flight.result, ttl)
+            else:
+                self._stats['errors'] += 1
+            del self._flights[key]
+        flight.event.set()
+
+    def get(self, key, ttl, func, stale=0):
+        """ fetch cached result or execute func() to calculate it
+        :param key: cache key
+        :param ttl: time to live of a new result in seconds
+        :param func: callable without arguments returning the result to cache, exceptions are not cached
+        :param stale: number of seconds an expired result may be served while refreshing in the background
+        :return: result
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry['expire'] >= now:
+                self._entries.move_to_end(key)
+                self._stats['hits'] += 1
+                return entry['value']
+            flight = self._flights.get(key)
+            if entry is not None and entry['expire'] + stale >= now:
+                self._entries.move_to_end(key)
+                self._stats['stale_hits'] += 1
+                if flight is None:
+                    flight = self._flights[key] = _Flight()
+                    threading.Thread(target=self._execute, args=(key, ttl, func, flight), daemon=True).start()
+                return entry['value']
+            if flight is None:
+                owner = True
+                flight = self._flights[key] = _Flight()
+                self._stats['misses'] += 1
+            else:
+                owner = False
+                self._stats['coalesced'] += 1
+
+        if owner:
+            self._execute(key, ttl, func, flight)
+        else:
+            flight.event.wait()
+        if flight.exception is not None:
+            raise flight.exception
+        return flight.result
+
+    def stats(self):
+        """ collect cache statistics
+        :return: dict
+        """
+        with self._lock:
+            result = dict(self._stats)
+            result['entries'] = len(self._entries)
+            result['bytes'] = self._size
+            result['max_bytes'] = self.max_bytes
+        return result
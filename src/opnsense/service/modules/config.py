@@ -29,75 +29,97 @@
     function: config handler
 """
 import os
-import stat
 import collections
-import copy
+import pickle
+import threading
 import xml.etree.cElementTree as ElementTree
 
 __author__ = 'Ad Schellevis'
 
 
 class Config(object):
+    # parsed configurations shared between instances, filename => ((inode, mtime, size), pickled config data)
+    _snapshots = dict()
+    _snapshots_lock = threading.Lock()
+
     def __init__(self, filename):
         self._config_data = {}
         self._filename = filename
-        self._file_mod = 0
+        self._file_mod = None
         self._load()
 
     def _load(self):
-        """ load config ( if timestamp is changed ), stores all found uuids into an item __uuid__ at the config root
+        """ load config ( if inode, timestamp or size is changed ), stores all found uuids into an item __uuid__
+        at the config root.
+        The xml is parsed once per process, the result is kept serialized so every Config object can cheaply
+        unpickle its own copy, which its consumers may alter.
 
         :return:
         """
-        mod_time = os.stat(self._filename)[stat.ST_MTIME]
-        if self._file_mod != mod_time:
-            xml_node = ElementTree.parse(self._filename)
-            root = xml_node.getroot()
-            # initialize uuid containers, holds references to all uuid tagged items and names in the xml
-            self.__uuid_data = {}
-            self.__uuid_tags = {}
-            self._config_data = self._traverse(root)
-            self._config_data['__uuid__'] = self.__uuid_data
-            self._config_data['__uuid_tags__'] = self.__uuid_tags
-            self._file_mod = mod_time
+        st = os.stat(self._filename)
+        file_mod = (st.st_ino, st.st_mtime_ns, st.st_size)
+        if self._file_mod != file_mod:
+            with self._snapshots_lock:
+                snapshot = self._snapshots.get(self._filename)
+                if snapshot is None or snapshot[0] != file_mod:
+                    snapshot = (file_mod, pickle.dumps(self._parse(self._filename), pickle.HIGHEST_PROTOCOL))
+                    self._snapshots[self._filename] = snapshot
+            self._config_data = pickle.loads(snapshot[1])
+            self._file_mod = file_mod
 
         return self._config_data
 
-    def _traverse(self, xml_node):
-        """ traverse xml node and return ordered dictionary structure
-        :param xml_node: ElementTree node
+    @staticmethod
+    def _parse(filename):
+        """ parse xml file into an ordered dictionary structure in a single pass, elements are released after use.
+            Nodes with children are converted to dictionaries (including their attributes prefixed with @),
+            leaf nodes to their text, repeating tags are collected in lists.
+        :param filename: xml filename
         :return: collections.OrderedDict
         """
-        this_item = collections.OrderedDict()
-        if len(list(xml_node)) > 0:
-            for item in list(xml_node):
-                item_content = self._traverse(item)
+        uuid_data = {}
+        uuid_tags = {}
+        # child containers of the open elements, created when the first child closes
+        stack = [None]
+        for event, xml_node in ElementTree.iterparse(filename, events=('start', 'end')):
+            if event == 'start':
+                stack.append(None)
+                continue
+            item_content = stack.pop()
+            if item_content is None:
+                # last node, use text
+                item_content = xml_node.text
+            else:
                 # for dictionary type items, add tag attributes
-                if type(item_content) == collections.OrderedDict:
-                    for attr_key in item.attrib:
-                        item_content["@%s" % attr_key] = item.attrib[attr_key]
-                # store uuid's
-                if 'uuid' in item.attrib:
-                    self.__uuid_data[item.attrib['uuid']] = item_content
-                    self.__uuid_tags[item.attrib['uuid']] = item.tag
-                # add (list) items to this result
-                if item.tag in this_item:
-                    if type(this_item[item.tag]) != list:
-                        tmp_item = copy.deepcopy(this_item[item.tag])
-                        this_item[item.tag] = []
-                        this_item[item.tag].append(tmp_item)
-
-                    if item_content is not None:
-                        # skip empty fields
-                        this_item[item.tag].append(item_content)
-                elif item_content is not None:
-                    # create a new named item
-                    this_item[item.tag] = item_content
-        else:
-            # last node, return text
-            return xml_node.text
-
-        return this_item
+                for attr_key in xml_node.attrib:
+                    item_content["@%s" % attr_key] = xml_node.attrib[attr_key]
+            # store uuid's
+            if 'uuid' in xml_node.attrib:
+                uuid_data[xml_node.attrib['uuid']] = item_content
+                uuid_tags[xml_node.attrib['uuid']] = xml_node.tag
+            xml_node.clear()
+
+            this_item = stack[-1]
+            if this_item is None:
+                this_item = stack[-1] = collections.OrderedDict()
+            # add (list) items to parent
+            if xml_node.tag in this_item:
+                if type(this_item[xml_node.tag]) != list:
+                    this_item[xml_node.tag] = [this_item[xml_node.tag]]
+                if item_content is not None:
+                    # skip empty fields
+                    this_item[xml_node.tag].append(item_content)
+            elif item_content is not None:
+                # create a new named item
+                this_item[xml_node.tag] = item_content
+
+        # unpack root element
+        result = list(stack[0].values())[0] if stack[0] else None
+        if type(result) != collections.OrderedDict:
+            result = collections.OrderedDict()
+        result['__uuid__'] = uuid_data
+        result['__uuid_tags__'] = uuid_tags
+        return result
 
     def get(self):
         """ get active config data, load from disc if file in memory is different
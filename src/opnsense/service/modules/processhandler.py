@@ -32,8 +32,12 @@ import copy
 import configparser
 import glob
 import os
+import queue
+import select
+import selectors
 import shlex
 import socket
+import struct
 import traceback
 import threading
 import time
@@ -41,6 +45,7 @@ import uuid
 from .session import get_session_context
 from .actions import ActionFactory
 from .actions.base import BaseAction
+from .cache import ResultCache
 from . import syslog_error, syslog_info, syslog_notice, syslog_auth_info, syslog_auth_error, singleton
 
 
@@ -56,12 +61,15 @@ class Handler(object):
                     <- send back result string
     """
 
-    def __init__(self, socket_filename, config_path, config_environment=None, action_defaults=None):
+    def __init__(self, socket_filename, config_path, config_environment=None, action_defaults=None,
+                 max_workers=64, max_queue=256):
         """ Constructor
         :param socket_filename: filename of unix domain socket to use
         :param config_path: location of action configuration files
         :param config_environment: env to use in shell commands
         :param action_defaults: default properties for action objects
+        :param max_workers: maximum number of concurrent worker threads, 0 spawns a thread per connection
+        :param max_queue: maximum number of connections waiting for a worker before accept() blocks
         """
         if config_environment is None:
             config_environment = {}
@@ -71,6 +79,8 @@ class Handler(object):
         self.config_path = config_path
         self.config_environment = config_environment
         self.action_defaults = action_defaults
+        self.max_workers = max_workers
+        self.max_queue = max_queue
         self.single_threaded = False
 
     def run(self):
@@ -86,6 +96,8 @@ class Handler(object):
                     config_environment=self.config_environment,
                     action_defaults=self.action_defaults
                 )
+                if not self.single_threaded and self.max_workers > 0 and act_handler.worker_pool is None:
+                    act_handler.worker_pool = WorkerPool(max_workers=self.max_workers, max_queue=self.max_queue)
                 try:
                     os.unlink(self.socket_filename)
                 except OSError:
@@ -109,6 +121,9 @@ class Handler(object):
                     if self.single_threaded:
                         # run single threaded
                         cmd_thread.run()
+                    elif act_handler.worker_pool is not None:
+                        # hand over to a pooled worker, blocks when the queue is full
+                        act_handler.worker_pool.submit(cmd_thread)
                     else:
                         # run threaded
                         cmd_thread.start()
@@ -132,9 +147,194 @@ class Handler(object):
                 time.sleep(1)
 
 
+class WorkerPool(object):
+    """ Bounded pool of worker threads to execute HandlerClient requests.
+        Workers are started on demand up to max_workers, pending connections are queued up to max_queue after
+        which submit() blocks the listener (the socket backlog takes over from there).
+        Idle (framed) connections are parked, a single thread waits for their next request and resubmits them,
+        so persistent clients only occupy a worker while executing.
+    """
+
+    def __init__(self, max_workers, max_queue=0):
+        """
+        :param max_workers: maximum number of worker threads
+        :param max_queue: maximum number of queued clients (0 for unlimited)
+        """
+        self.max_workers = max_workers
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._lock = threading.Lock()
+        self._workers = []
+        self._active = 0
+        self._parking = []
+        self._idle_thread = None
+        self._wakeup = None
+        self._stats = {
+            'submitted': 0,
+            'processed': 0,
+            'queue_full': 0,
+            'max_queue_depth': 0,
+            'max_active': 0,
+            'total_wait_time': 0.0,
+            'max_wait_time': 0.0,
+            'idle': 0,
+            'idle_timeout': 0
+        }
+
+    def submit(self, client):
+        """ queue client for execution
+        :param client: HandlerClient object
+        :return: None
+        """
+        with self._lock:
+            self._stats['submitted'] += 1
+            if self._queue.full():
+                self._stats['queue_full'] += 1
+            if self._active + self._queue.qsize() >= len(self._workers) and len(self._workers) < self.max_workers:
+                worker = threading.Thread(target=self._worker, daemon=True)
+                self._workers.append(worker)
+                worker.start()
+        self._queue.put((time.time(), client))
+        with self._lock:
+            self._stats['max_queue_depth'] = max(self._stats['max_queue_depth'], self._queue.qsize())
+
+    def _worker(self):
+        """ worker thread, execute queued clients
+        :return: None
+        """
+        while True:
+            queued_at, client = self._queue.get()
+            wait_time = time.time() - queued_at
+            with self._lock:
+                self._active += 1
+                self._stats['max_active'] = max(self._stats['max_active'], self._active)
+                self._stats['total_wait_time'] += wait_time
+                self._stats['max_wait_time'] = max(self._stats['max_wait_time'], wait_time)
+            # noinspection PyBroadException
+            try:
+                client.run()
+            except Exception:
+                syslog_error('worker died on %s' % traceback.format_exc())
+            finally:
+                with self._lock:
+                    self._active -= 1
+                    self._stats['processed'] += 1
+                self._queue.task_done()
+
+    def park(self, client, timeout):
+        """ wait for the next request of an idle client outside of the pool
+        :param client: HandlerClient object, resubmitted when data arrives
+        :param timeout: seconds after which the connection is closed
+        :return: None
+        """
+        with self._lock:
+            self._parking.append((client, time.time() + timeout))
+            if self._idle_thread is None:
+                self._wakeup = os.pipe()
+                self._idle_thread = threading.Thread(target=self._idle_worker, daemon=True)
+                self._idle_thread.start()
+        os.write(self._wakeup[1], b'\x00')
+
+    def _idle_worker(self):
+        """ idle thread, resubmit parked clients with data available, close the ones timed out
+        :return: None
+        """
+        selector = selectors.DefaultSelector()
+        selector.register(self._wakeup[0], selectors.EVENT_READ)
+        deadlines = {}
+        while True:
+            timeout = max(min(deadlines.values()) - time.time(), 0) if deadlines else None
+            for key, mask in selector.select(timeout):
+                if key.fileobj == self._wakeup[0]:
+                    os.read(self._wakeup[0], 4096)
+                else:
+                    selector.unregister(key.fileobj)
+                    del deadlines[key.data]
+                    self.submit(key.data)
+            with self._lock:
+                parking = self._parking
+                self._parking = []
+            for client, deadline in parking:
+                try:
+                    selector.register(client.connection, selectors.EVENT_READ, client)
+                    deadlines[client] = deadline
+                except (ValueError, OSError):
+                    # client left
+                    client.close()
+            now = time.time()
+            for client in [x for x in deadlines if deadlines[x] <= now]:
+                selector.unregister(client.connection)
+                del deadlines[client]
+                client.close()
+                with self._lock:
+                    self._stats['idle_timeout'] += 1
+            with self._lock:
+                self._stats['idle'] = len(deadlines)
+
+    def stats(self):
+        """ collect pool statistics
+        :return: dict
+        """
+        with self._lock:
+            result = dict(self._stats)
+            result['workers'] = len(self._workers)
+            result['max_workers'] = self.max_workers
+            result['active'] = self._active
+            result['queued'] = self._queue.qsize()
+            if result['processed'] > 0:
+                result['avg_wait_time'] = result['total_wait_time'] / result['processed']
+            else:
+                result['avg_wait_time'] = 0.0
+        return result
+
+
+class FramedConnection(object):
+    """ Connection wrapper for the framed protocol, every send() is emitted as a length prefixed chunk so
+        streaming actions can write to the client without knowing about framing.
+    """
+
+    def __init__(self, connection):
+        """
+        :param connection: socket connection object
+        """
+        self._connection = connection
+
+    def send(self, data):
+        """ send data as single chunk, empty data is ignored as a zero length chunk marks the end of a response
+        :param data: bytes or str
+        :return: number of bytes sent
+        """
+        if type(data) is not bytes:
+            data = str(data).encode()
+        if len(data) > 0:
+            self._connection.sendall(struct.pack('!I', len(data)) + data)
+        return len(data)
+
+    def sendall(self, data):
+        self.send(data)
+
+    def end(self):
+        """ send end of response marker (zero length chunk)
+        :return: None
+        """
+        self._connection.sendall(struct.pack('!I', 0))
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+
 class HandlerClient(threading.Thread):
     """ Handle commands via specified socket connection
+
+        Two protocols are supported:
+            legacy: a single command (max 4k) terminated by closing the connection after a response ending
+                    with three \\0 characters
+            framed: the client starts with FRAMED_MAGIC, after which any number of requests may be pipelined.
+                    A request is a 4 byte (network order) length followed by the command, responses are sent
+                    in order as a sequence of length prefixed chunks terminated by a zero length chunk.
     """
+    FRAMED_MAGIC = b'\x00cfd\x01'
+    max_request_size = 16 * 1024 * 1024
+    idle_timeout = 60
 
     def __init__(self, connection, client_address, action_handler):
         """
@@ -149,20 +349,77 @@ class HandlerClient(threading.Thread):
         self.action_handler = action_handler
         self.message_uuid = uuid.uuid4()
         self.session = get_session_context(connection)
+        self._buffer = b''
+        self._framed = False
+
+    def _recv_exact(self, size, timeout=None):
+        """ read exactly size bytes from the connection (using the already received buffer first)
+        :param size: number of bytes to read
+        :param timeout: maximum number of seconds to wait for the first data to arrive
+        :return: bytes or None when the connection was closed or timed out
+        """
+        while len(self._buffer) < size:
+            if timeout is not None and len(self._buffer) == 0:
+                if not select.select([self.connection], [], [], timeout)[0]:
+                    return None
+            data = self.connection.recv(max(65536, size - len(self._buffer)))
+            if not data:
+                return None
+            self._buffer += data
+        result = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        return result
 
     def run(self):
-        """ handle single action ( read data, execute command, send response )
+        """ handle client connection, detect protocol by inspecting the first message
+
+        :return: None
+        """
+        if self._framed:
+            # resumed (pooled) framed connection
+            self.run_framed()
+            return
+        try:
+            data = self.connection.recv(4096)
+            if data.startswith(b'\x00'):
+                # the magic may arrive in parts
+                while len(data) < len(self.FRAMED_MAGIC) and self.FRAMED_MAGIC.startswith(data):
+                    chunk = self.connection.recv(4096)
+                    if not chunk:
+                        break
+                    data += chunk
+                if data.startswith(self.FRAMED_MAGIC):
+                    self._buffer = data[len(self.FRAMED_MAGIC):]
+                    self._framed = True
+                    self.run_framed()
+                    return
+        except OSError:
+            data = b''
+        self.run_legacy(data)
+
+    def close(self):
+        """ close client connection
+        :return: None
+        """
+        try:
+            self.connection.shutdown(socket.SHUT_RDWR)
+            self.connection.close()
+        except OSError:
+            # ignore shutdown errors when listener disconnected
+            pass
+
+    def run_legacy(self, data):
+        """ handle single action ( execute command, send response )
 
+        :param data: received command, maximum data length is 4k... longer messages are truncated
         :return: None
         """
         result = ''
         exec_in_background = False
         # noinspection PyBroadException
         try:
-            # receive command, maximum data length is 4k... longer messages will be truncated
-            data = self.connection.recv(4096).decode()
             # map command to action
-            data_parts = shlex.split(data)
+            data_parts = shlex.split(data.decode())
             if len(data_parts) == 0 or len(data_parts[0]) == 0:
                 # no data found
                 self.connection.sendall('no data\n'.encode())
@@ -216,6 +473,77 @@ class HandlerClient(threading.Thread):
                     # ignore shutdown errors when listener disconnected
                     pass
 
+    def run_framed(self):
+        """ handle pipelined actions until the client closes the connection.
+            When executed by the worker pool, the connection is parked when idle to release the worker.
+
+        :return: None
+        """
+        framed_connection = FramedConnection(self.connection)
+        worker_pool = self.action_handler.worker_pool
+        parked = False
+        # noinspection PyBroadException
+        try:
+            while True:
+                if worker_pool is not None and len(self._buffer) == 0 and \
+                        not select.select([self.connection], [], [], 0)[0]:
+                    # idle, wait for the next request outside of the pool
+                    parked = True
+                    worker_pool.park(self, self.idle_timeout)
+                    break
+                header = self._recv_exact(4, timeout=self.idle_timeout)
+                if header is None:
+                    break
+                request_size = struct.unpack('!I', header)[0]
+                if request_size > self.max_request_size:
+                    framed_connection.send('request too large\n')
+                    framed_connection.end()
+                    break
+                data = self._recv_exact(request_size)
+                if data is None:
+                    break
+                message_uuid = uuid.uuid4()
+                data_parts = shlex.split(data.decode())
+                if len(data_parts) == 0 or len(data_parts[0]) == 0:
+                    framed_connection.send('no data\n')
+                elif data_parts[0][0] == "&":
+                    # background execution, respond with the message uuid and execute the action in its own thread
+                    data_parts[0] = data_parts[0][1:]
+                    framed_connection.send('%s\n' % message_uuid)
+                    threading.Thread(
+                        target=self._execute_background, args=(data_parts, message_uuid), daemon=True
+                    ).start()
+                else:
+                    result = self.action_handler.execute(data_parts, message_uuid, framed_connection, self.session)
+                    # ignore when result is None, in which case the content was streamed via the pipe
+                    if result is not None:
+                        framed_connection.send(result)
+                framed_connection.end()
+        except (SystemExit, BrokenPipeError, ConnectionResetError):
+            # ignore system exit or "client left" related errors
+            pass
+        except Exception:
+            print(traceback.format_exc())
+            syslog_notice('unable to sendback response for %s, message was %s' % (
+                self.message_uuid, traceback.format_exc()
+            ))
+        finally:
+            if not parked:
+                self.close()
+
+    def _execute_background(self, data_parts, message_uuid):
+        """ execute background (&) action of a framed request
+        :param data_parts: command parts
+        :param message_uuid: message uuid returned to the client
+        :return: None
+        """
+        # noinspection PyBroadException
+        try:
+            result = self.action_handler.execute(data_parts, message_uuid, None, self.session)
+            syslog_info("message %s [%s] returned %s " % (message_uuid, ' '.join(data_parts), str(result)[:100]))
+        except Exception:
+            syslog_error('background action %s failed on %s' % (message_uuid, traceback.format_exc()))
+
 
 @singleton
 class ActionHandler(object):
@@ -234,6 +562,7 @@ class ActionHandler(object):
         self.config_environment = config_environment if config_environment else {}
         self.action_defaults = action_defaults if action_defaults else {}
         self.action_map = {}
+        self.worker_pool = None
         self.load_config()
 
     def load_config(self):
@@ -310,6 +639,16 @@ class ActionHandler(object):
 
         return result
 
+    def get_stats(self):
+        """ collect runtime statistics
+        :return: dict
+        """
+        result = {}
+        if self.worker_pool is not None:
+            result['workers'] = self.worker_pool.stats()
+        result['cache'] = ResultCache().stats()
+        return result
+
     def find_action(self, action):
         """ find action object
 
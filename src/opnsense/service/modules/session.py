@@ -33,6 +33,41 @@ import struct
 import socket
 import pwd
 import grp
+import threading
+import time
+
+# credential lookups are cached per uid/gid, names are refreshed after credential_cache_ttl seconds
+credential_cache_ttl = 60
+_credential_cache = {}
+_credential_lock = threading.Lock()
+
+
+def _cached_lookup(kind, key, lookup):
+    """ resolve a uid/gid to its name using a short lived cache
+    :param kind: cache domain (user, group)
+    :param key: numeric id
+    :param lookup: function returning the name for key or None when unknown
+    :return: name or None
+    """
+    now = time.time()
+    with _credential_lock:
+        entry = _credential_cache.get((kind, key))
+        if entry is not None and entry[1] > now:
+            return entry[0]
+    try:
+        result = lookup(key)
+    except KeyError:
+        result = None
+    with _credential_lock:
+        _credential_cache[(kind, key)] = (result, now + credential_cache_ttl)
+    return result
+
+
+def flush_credential_cache():
+    """ drop all cached uid/gid lookups
+    """
+    with _credential_lock:
+        _credential_cache.clear()
 
 
 class xucred:
@@ -50,14 +85,12 @@ class xucred:
             self.cr_ngroups = tmp[2]
             self.cr_groups = tmp[3:18]
             self.cr_pid = tmp[19]
-            tmp = pwd.getpwuid(self.cr_uid)
-            if tmp:
-                self._user = tmp.pw_name
+            self._user = _cached_lookup('user', self.cr_uid, lambda x: pwd.getpwuid(x).pw_name)
             for idx, item in enumerate(self.cr_groups):
                 if idx < self.cr_ngroups:
-                    tmp = grp.getgrgid(item)
-                    if tmp:
-                        self._groups.add(tmp.gr_name)
+                    group_name = _cached_lookup('group', item, lambda x: grp.getgrgid(x).gr_name)
+                    if group_name:
+                        self._groups.add(group_name)
 
     def get_groups(self):
         return self._groups
@@ -68,7 +101,7 @@ class xucred:
 
 def get_session_context(connection):
     """
-    :param instr: string with optional tags [field.$$]
+    :param connection: socket connection
     :return: xucred
     """
 
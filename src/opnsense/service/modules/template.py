@@ -38,7 +38,10 @@ import shlex
 import collections
 import traceback
 import copy
-import codecs
+import hashlib
+import multiprocessing
+import threading
+import concurrent.futures
 import jinja2
 from .addons import template_helpers
 from . import syslog_error, syslog_notice
@@ -46,18 +49,159 @@ from . import syslog_error, syslog_notice
 __author__ = 'Ad Schellevis'
 
 
+class ConfigAccessLog(set):
+    """ set of config paths accessed during rendering, volatile marks output which depends on other sources
+    """
+    volatile = False
+
+
+class TrackedConfigNode(collections.OrderedDict):
+    """ top level config section used as template input.
+        Child nodes are copied on first access (templates may alter their input), paths of the accessed children
+        are registered in the access log, iterating the section registers the section as a whole.
+    """
+
+    def __init__(self, tracked_name, source, access_log):
+        super().__init__(source)
+        self._tracked_name = tracked_name
+        self._tracked_log = access_log
+        self._tracked_copies = set()
+
+    def _tracked_child(self, key):
+        value = super().__getitem__(key)
+        if key not in self._tracked_copies:
+            value = copy.deepcopy(value)
+            super().__setitem__(key, value)
+            self._tracked_copies.add(key)
+        return value
+
+    def __getitem__(self, key):
+        self._tracked_log.add('%s.%s' % (self._tracked_name, key))
+        return self._tracked_child(key)
+
+    def __contains__(self, key):
+        self._tracked_log.add('%s.%s' % (self._tracked_name, key))
+        return super().__contains__(key)
+
+    def get(self, key, default=None):
+        self._tracked_log.add('%s.%s' % (self._tracked_name, key))
+        return self._tracked_child(key) if super().__contains__(key) else default
+
+    def __iter__(self):
+        self._tracked_log.add(self._tracked_name)
+        return super().__iter__()
+
+    def __len__(self):
+        self._tracked_log.add(self._tracked_name)
+        return super().__len__()
+
+    def __repr__(self):
+        self._tracked_log.add(self._tracked_name)
+        return super().__repr__()
+
+    def keys(self):
+        self._tracked_log.add(self._tracked_name)
+        return super().keys()
+
+    def items(self):
+        self._tracked_log.add(self._tracked_name)
+        return [(key, self._tracked_child(key)) for key in list(super().keys())]
+
+    def values(self):
+        self._tracked_log.add(self._tracked_name)
+        return [self._tracked_child(key) for key in list(super().keys())]
+
+
+class TrackingHelpers(template_helpers.Helpers):
+    """ template helpers, flags output depending on the filesystem or time as volatile
+    """
+
+    def __init__(self, template_in_data, access_log):
+        super().__init__(template_in_data)
+        self._access_log = access_log
+
+    def getUtcTime(self):
+        self._access_log.volatile = True
+        return super().getUtcTime()
+
+    def file_exists(self, pathname):
+        self._access_log.volatile = True
+        return super().file_exists(pathname)
+
+    def glob(self, pathname):
+        self._access_log.volatile = True
+        return super().glob(pathname)
+
+
+# template object used by forked workers in parallel generation, set per worker process (see _init_worker)
+_worker_template = None
+
+# serialize parallel generation, configd handles requests in threads and forking should happen one at a time
+_parallel_lock = threading.Lock()
+
+
+def _init_worker(template):
+    """ worker process initializer, registers the template to render from
+    :param template: Template object (inherited by fork)
+    """
+    global _worker_template
+    _worker_template = template
+
+
+def _generate_worker(template_name, create_directory):
+    """ generate a single template module in a (forked) worker process
+    :param template_name: module name
+    :param create_directory: automatically create directories to place template output in
+    :return: tuple (generated filenames, stats, render state of generated files, error or None)
+    """
+    tmpl = _worker_template
+    tmpl.stats = {'rendered': 0, 'skipped': 0, 'unchanged': 0}
+    try:
+        filenames = tmpl._generate(template_name, create_directory)
+    except Exception:
+        return [], tmpl.stats, {}, traceback.format_exc()
+    render_state = {fn: tmpl._render_state[fn] for fn in filenames if fn in tmpl._render_state}
+    return filenames, tmpl.stats, render_state, None
+
+
 class Template(object):
-    def __init__(self, target_root_directory="/"):
+    # render state of generated files when running incremental (shared for the lifetime of the process)
+    _render_state = dict()
+
+    def __init__(self, target_root_directory="/", incremental=False, workers=1, bytecode_cache_dir=None):
+        """
+        :param target_root_directory: location to write output files
+        :param incremental: skip rendering and writing when template input or output did not change
+        :param workers: number of processes to render template modules in (opt-in), 0 to use all cores
+        :param bytecode_cache_dir: directory to store compiled templates in (shared between instances)
+        """
         # init config (config.xml) data
         self._config = {}
 
         # set target root (location to write output files)
         self._target_root_directory = target_root_directory
 
+        # incremental mode, skip rendering when template input did not change
+        self._incremental = incremental
+        self._config_hashes = {}
+        self._templates_stamp = None
+        self.stats = {'rendered': 0, 'skipped': 0, 'unchanged': 0}
+
+        # number of worker processes used when generating multiple modules
+        self._workers = workers if workers > 0 else os.cpu_count()
+
         # setup jinja2 environment
         self._template_dir = os.path.dirname(os.path.abspath(__file__)) + '/../templates/'
+        bytecode_cache = None
+        if bytecode_cache_dir is not None:
+            try:
+                os.makedirs(bytecode_cache_dir, mode=0o700, exist_ok=True)
+                bytecode_cache = jinja2.FileSystemBytecodeCache(bytecode_cache_dir)
+            except OSError:
+                syslog_error('unable to use template bytecode cache %s' % bytecode_cache_dir)
         self._j2_env = jinja2.Environment(loader=jinja2.FileSystemLoader(self._template_dir), trim_blocks=True,
-                                          extensions=["jinja2.ext.do", "jinja2.ext.loopcontrols"])
+                                          extensions=["jinja2.ext.do", "jinja2.ext.loopcontrols"],
+                                          bytecode_cache=bytecode_cache)
         # register additional filters
         self._j2_env.filters['decode_idna'] = lambda x:x.decode('idna')
         self._j2_env.filters['encode_idna'] = self._encode_idna
@@ -131,6 +275,74 @@ class Template(object):
         :param config_data: config data as dictionary/list structure
         """
         self._config = config_data if type(config_data) in (dict, collections.OrderedDict) else {}
+        self._config_hashes = {}
+
+    def _template_input(self, target_filters, access_log):
+        """ construct template input data, tracking which parts of the configuration are being used
+        :param target_filters: filters for this output file
+        :param access_log: ConfigAccessLog to register accessed paths in
+        :return: dict
+        """
+        result = collections.OrderedDict()
+        for key, value in self._config.items():
+            if type(value) in (dict, collections.OrderedDict):
+                result[key] = TrackedConfigNode(key, value, access_log)
+            else:
+                access_log.add(key)
+                result[key] = copy.deepcopy(value)
+        result['TARGET_FILTERS'] = target_filters
+        return result
+
+    def _config_hash(self, path):
+        """ hash config content at path (cached until the config changes)
+        :param path: path in dot notation, an empty path hashes the names of the root sections
+        :return: string
+        """
+        if path not in self._config_hashes:
+            if path == '':
+                node = list(self._config)
+            else:
+                node = self._config
+                for item in path.split('.'):
+                    node = node.get(item) if type(node) in (dict, collections.OrderedDict) else None
+            self._config_hashes[path] = hashlib.md5(repr(node).encode()).hexdigest()
+        return self._config_hashes[path]
+
+    def _get_templates_stamp(self):
+        """ fingerprint of all template sources (modification times and sizes), templates may include each other
+        :return: string
+        """
+        if self._templates_stamp is None:
+            stamps = []
+            for root, dirs, files in os.walk(self._template_dir):
+                for filename in files:
+                    st = os.stat(os.path.join(root, filename))
+                    stamps.append('%s:%d:%d' % (os.path.join(root, filename), st.st_mtime_ns, st.st_size))
+            self._templates_stamp = hashlib.md5('\n'.join(sorted(stamps)).encode()).hexdigest()
+        return self._templates_stamp
+
+    def _is_unchanged(self, filename, template_filename, target_filters):
+        """ check if the inputs of an earlier rendered output file are still the same
+        :param filename: output filename
+        :param template_filename: template source
+        :param target_filters: filters for this output file
+        :return: bool
+        """
+        state = self._render_state.get(filename)
+        if state is None or state['volatile'] or state['template'] != template_filename:
+            return False
+        elif state['templates_stamp'] != self._get_templates_stamp() or state['filters'] != repr(target_filters):
+            return False
+        try:
+            st = os.stat(filename)
+            if (st.st_mtime_ns, st.st_size) != state['output']:
+                return False
+        except OSError:
+            return False
+        for path, digest in state['inputs'].items():
+            if self._config_hash(path) != digest:
+                return False
+        return True
 
     @staticmethod
     def __find_string_tags(instr):
@@ -212,7 +424,26 @@ class Template(object):
                 if os.path.isfile(tmppart):
                     os.remove(tmppart)
                 if not os.path.exists(tmppart):
-                    os.mkdir(tmppart)
+                    try:
+                        os.mkdir(tmppart)
+                    except FileExistsError:
+                        # created by another (parallel) worker
+                        pass
+
+    @staticmethod
+    def _file_equals(filename, content):
+        """ compare file content
+        :param filename: filename
+        :param content: bytes
+        :return: bool
+        """
+        try:
+            if os.path.getsize(filename) != len(content):
+                return False
+            with open(filename, 'rb') as f_in:
+                return f_in.read() == content
+        except OSError:
+            return False
 
     def _generate(self, module_name, create_directory=True):
         """ generate configuration files for one section using bound config and template data
@@ -248,47 +479,69 @@ class Template(object):
 
             for filename in list(result_filenames):
                 if not (filename.find('[') != -1 and filename.find(']') != -1):
-                    # copy config data
-                    cnf_data = copy.deepcopy(self._config)
-                    cnf_data['TARGET_FILTERS'] = result_filenames[filename]
+                    target_filters = result_filenames[filename]
+                    # prefix filename with defined root directory
+                    output_filename = ('%s/%s' % (self._target_root_directory, filename)).replace('//', '/')
+                    # make sure we're only rendering output once
+                    if output_filename in result:
+                        continue
+                    if self._incremental and self._is_unchanged(output_filename, template_filename, target_filters):
+                        self.stats['skipped'] += 1
+                        result.append(output_filename)
+                        continue
 
-                    # link template helpers
-                    self._j2_env.globals['helpers'] = template_helpers.Helpers(cnf_data)
+                    # template input data, config sections are copied on access
+                    access_log = ConfigAccessLog()
+                    cnf_data = self._template_input(target_filters, access_log)
 
-                    # make sure we're only rendering output once
-                    if filename not in result:
-                        # render page and write to disc
-                        try:
-                            content = j2_page.render(cnf_data)
-                        except Exception as render_exception:
-                            # push exception with context if anything fails
-                            raise Exception("%s %s %s" % (module_name, template_filename, render_exception))
-
-                        # prefix filename with defined root directory
-                        filename = ('%s/%s' % (self._target_root_directory, filename)).replace('//', '/')
-                        if create_directory:
-                            # make sure the target directory exists
-                            self._create_directory(filename)
-
-                        f_out = codecs.open(filename, 'wb', encoding="utf-8")
-                        f_out.write(content)
-                        # Check if the last character of our output contains an end-of-line, if not copy it in if
-                        # it was in the original template.
-                        # It looks like Jinja sometimes isn't consistent on placing this last end-of-line in.
-                        if len(content) > 1 and content[-1] != '\n':
-                            src_file = '%s%s' % (self._template_dir, template_filename)
-                            src_file_handle = open(src_file, 'rb')
+                    # link template helpers
+                    self._j2_env.globals['helpers'] = TrackingHelpers(cnf_data, access_log)
+
+                    # render page
+                    try:
+                        content = j2_page.render(cnf_data)
+                    except Exception as render_exception:
+                        # push exception with context if anything fails
+                        raise Exception("%s %s %s" % (module_name, template_filename, render_exception))
+                    self.stats['rendered'] += 1
+
+                    # Check if the last character of our output contains an end-of-line, if not copy it in if
+                    # it was in the original template.
+                    # It looks like Jinja sometimes isn't consistent on placing this last end-of-line in.
+                    if len(content) > 1 and content[-1] != '\n':
+                        src_file = '%s%s' % (self._template_dir, template_filename)
+                        with open(src_file, 'rb') as src_file_handle:
                             src_file_handle.seek(-1, os.SEEK_END)
-                            last_bytes_template = src_file_handle.read()
-                            src_file_handle.close()
-                            if last_bytes_template in (b'\n', b'\r'):
-                                f_out.write('\n')
-                        f_out.close()
-                        # copy root permissions, without exec
-                        root_perm = stat.S_IMODE(os.lstat(os.path.dirname(filename)).st_mode)
-                        os.chmod(filename, root_perm & (~stat.S_IXGRP & ~stat.S_IXUSR & ~stat.S_IXOTH))
+                            if src_file_handle.read() in (b'\n', b'\r'):
+                                content += '\n'
+                    content = content.encode('utf-8')
 
-                        result.append(filename)
+                    if create_directory:
+                        # make sure the target directory exists
+                        self._create_directory(output_filename)
+
+                    if self._incremental and self._file_equals(output_filename, content):
+                        # identical output, leave file untouched
+                        self.stats['unchanged'] += 1
+                    else:
+                        with open(output_filename, 'wb') as f_out:
+                            f_out.write(content)
+                        # copy root permissions, without exec
+                        root_perm = stat.S_IMODE(os.lstat(os.path.dirname(output_filename)).st_mode)
+                        os.chmod(output_filename, root_perm & (~stat.S_IXGRP & ~stat.S_IXUSR & ~stat.S_IXOTH))
+
+                    if self._incremental:
+                        st = os.stat(output_filename)
+                        self._render_state[output_filename] = {
+                            'template': template_filename,
+                            'templates_stamp': self._get_templates_stamp(),
+                            'filters': repr(target_filters),
+                            'volatile': access_log.volatile,
+                            'output': (st.st_mtime_ns, st.st_size),
+                            'inputs': {path: self._config_hash(path) for path in list(access_log) + ['']}
+                        }
+
+                    result.append(output_filename)
 
         return result
 
@@ -322,7 +575,13 @@ class Template(object):
         """
         result = list()
         failed = False
-        for template_name in self.iter_modules(module_name):
+        self.stats = {'rendered': 0, 'skipped': 0, 'unchanged': 0}
+        self._templates_stamp = None
+        template_names = list(self.iter_modules(module_name))
+        if self._workers > 1 and len(template_names) > 1:
+            return self._generate_parallel(template_names, create_directory)
+
+        for template_name in template_names:
             syslog_notice("generate template container %s" % template_name)
             try:
                 for filename in self._generate(template_name, create_directory):
@@ -339,6 +598,45 @@ class Template(object):
 
         return result
 
+    def _generate_parallel(self, template_names, create_directory=True):
+        """ generate template modules using a pool of forked processes, which inherit the parsed configuration
+        :param template_names: list of module names
+        :param create_directory: automatically create directories to place template output in ( if not existing )
+        :return: list of generated output files or None if template not found
+        """
+        result = list()
+        failed = False
+        with _parallel_lock:
+            if self._incremental:
+                # calculate once, inherited by all workers
+                self._get_templates_stamp()
+            with concurrent.futures.ProcessPoolExecutor(
+                    max_workers=min(self._workers, len(template_names)),
+                    mp_context=multiprocessing.get_context('fork'),
+                    initializer=_init_worker,
+                    initargs=(self,)
+            ) as executor:
+                futures = []
+                for template_name in template_names:
+                    syslog_notice("generate template container %s" % template_name)
+                    futures.append(executor.submit(_generate_worker, template_name, create_directory))
+                # collect results in module order
+                for template_name, future in zip(template_names, futures):
+                    filenames, stats, render_state, error = future.result()
+                    if error is not None:
+                        # log failure, but proceed processing for possible wildcard search
+                        syslog_error('error generating template %s : %s' % (template_name, error))
+                        failed = True
+                    result.extend(filenames)
+                    self._render_state.update(render_state)
+                    for key in stats:
+                        self.stats[key] += stats[key]
+
+        if not result or failed:
+            return None
+
+        return result
+
     def cleanup(self, module_name):
         """
         :param module_name: module name in dot notation ( company.module ), may use wildcards
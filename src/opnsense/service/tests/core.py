@@ -143,3 +143,145 @@ class TestCoreMethods(unittest.TestCase):
         cmd_thread.run()
         response = json.loads(self.dummysock.getReceived()[:-4])
         self.assertGreater(len(response), 10, 'number of configd commands very suspicious')
+
+    def test_worker_pool(self):
+        """ execute requests using the bounded worker pool
+        :return:
+        """
+        pool = processhandler.WorkerPool(max_workers=2, max_queue=10)
+        sockets = []
+        for i in range(10):
+            sock = DummySocket()
+            sock.setTestData('xxxxxx\n')
+            sockets.append(sock)
+            pool.submit(processhandler.HandlerClient(connection=sock,
+                                                     client_address=None,
+                                                     action_handler=self.act_handler))
+        pool._queue.join()
+        stats = pool.stats()
+        self.assertEqual(stats['processed'], 10, 'not all requests processed')
+        self.assertLessEqual(stats['workers'], 2, 'worker limit exceeded')
+        for sock in sockets:
+            self.assertEqual(sock.getReceived()[-4:], '\n%c%c%c' % (chr(0), chr(0), chr(0)), "Invalid sequence")
+
+    def test_legacy_zero_prefix(self):
+        """ legacy requests starting with \\0 which aren't framed should still be handled
+        :return:
+        """
+        self.dummysock.setTestData('\x00xxxxxx\n')
+        cmd_thread = processhandler.HandlerClient(connection=self.dummysock,
+                                                  client_address=None,
+                                                  action_handler=self.act_handler)
+        cmd_thread.run()
+        self.assertTrue(self.dummysock.getReceived().startswith('Action not allowed or missing'), 'request dropped')
+
+    def test_framed_idle(self):
+        """ idle framed connections should not occupy a pooled worker
+        :return:
+        """
+        import socket
+        import time
+
+        def request(sock, command):
+            sock.sendall(struct.pack('!I', len(command)) + command)
+            response = b''
+            while True:
+                chunk_size = struct.unpack('!I', sock.recv(4, socket.MSG_WAITALL))[0]
+                if chunk_size == 0:
+                    return response.decode()
+                response += sock.recv(chunk_size, socket.MSG_WAITALL)
+
+        pool = processhandler.WorkerPool(max_workers=1, max_queue=10)
+        self.act_handler.worker_pool = pool
+        try:
+            server, client = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+            client.sendall(processhandler.HandlerClient.FRAMED_MAGIC)
+            pool.submit(processhandler.HandlerClient(connection=server,
+                                                     client_address=None,
+                                                     action_handler=self.act_handler))
+            self.assertEqual(request(client, b'xxxxxx').strip(), 'Action not allowed or missing')
+            # the only worker should be available for other clients
+            start = time.time()
+            self.dummysock.setTestData('xxxxxx\n')
+            pool.submit(processhandler.HandlerClient(connection=self.dummysock,
+                                                     client_address=None,
+                                                     action_handler=self.act_handler))
+            pool._queue.join()
+            self.assertLess(time.time() - start, 5, 'worker occupied by idle connection')
+            # the parked connection resumes on the next request
+            self.assertGreater(len(json.loads(request(client, b'configd actions json'))), 10)
+            client.close()
+            for i in range(50):
+                if pool.stats()['idle'] == 0 and pool._queue.unfinished_tasks == 0:
+                    break
+                time.sleep(0.1)
+            self.assertEqual(pool.stats()['idle'], 0, 'closed connection still parked')
+        finally:
+            self.act_handler.worker_pool = None
+
+    def test_result_cache(self):
+        """ concurrent requests for the same key should result in a single execution
+        :return:
+        """
+        import threading
+        import time
+        from modules.cache import ResultCache
+        calls = []
+
+        def func():
+            calls.append(1)
+            time.sleep(0.2)
+            return 'result'
+
+        results = []
+        threads = [
+            threading.Thread(target=lambda: results.append(ResultCache().get('test_result_cache', 60, func)))
+            for i in range(5)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(calls), 1, 'requests not coalesced')
+        self.assertEqual(results, ['result'] * 5, 'invalid results')
+        ResultCache().get('test_result_cache', 60, func)
+        self.assertEqual(len(calls), 1, 'result not cached')
+
+    def test_framed_protocol(self):
+        """ pipeline multiple requests over a single connection
+        :return:
+        """
+        import socket
+        import threading
+        server, client = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        cmd_thread = processhandler.HandlerClient(connection=server,
+                                                  client_address=None,
+                                                  action_handler=self.act_handler)
+        worker = threading.Thread(target=cmd_thread.run)
+        worker.start()
+        payload = processhandler.HandlerClient.FRAMED_MAGIC
+        for command in [b'xxxxxx', b'configd actions json']:
+            payload += struct.pack('!I', len(command)) + command
+        client.sendall(payload)
+        client.shutdown(socket.SHUT_WR)
+        responses = []
+        data = b''
+        while True:
+            chunk = client.recv(65536)
+            if not chunk:
+                break
+            data += chunk
+        response = b''
+        while data:
+            chunk_size = struct.unpack('!I', data[:4])[0]
+            if chunk_size == 0:
+                responses.append(response.decode())
+                response = b''
+            else:
+                response += data[4:4 + chunk_size]
+            data = data[4 + chunk_size:]
+        worker.join()
+        client.close()
+        self.assertEqual(len(responses), 2, 'expected two responses')
+        self.assertEqual(responses[0].strip(), 'Action not allowed or missing', 'Invalid response')
+        self.assertGreater(len(json.loads(responses[1])), 10, 'number of configd commands very suspicious')
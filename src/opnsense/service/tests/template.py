@@ -29,6 +29,7 @@
 """
 import os
 import unittest
+import threading
 import collections
 from modules import config
 from modules import template
@@ -62,6 +63,21 @@ class TestConfigMethods(unittest.TestCase):
         self.assertIn('lan', self.conf.get()['interfaces'], 'lan section missing')
         self.assertIn('ipaddr', self.conf.get()['interfaces']['lan'], 'lan address missing')
 
+    def test_snapshot(self):
+        """ test if configuration data is parsed once, while every instance owns its data
+        :return:
+        """
+        conf_path = '%s/config/config.xml' % '/'.join(__file__.split('/')[:-1])
+        parse = config.Config._parse
+        try:
+            config.Config._parse = None
+            other = config.Config(conf_path).get()
+        finally:
+            config.Config._parse = parse
+        self.assertEqual(other, self.conf.get(), 'config data differs')
+        other['interfaces']['lan']['ipaddr'] = '10.0.0.1'
+        self.assertNotEqual(self.conf.get()['interfaces']['lan']['ipaddr'], '10.0.0.1', 'config data shared')
+
 
 class TestTemplateMethods(unittest.TestCase):
     def setUp(self):
@@ -96,6 +112,46 @@ class TestTemplateMethods(unittest.TestCase):
         generated_filenames = self.tmpl.generate('OPNsense/Sample')
         self.assertEqual(len(generated_filenames), 4, 'number of output files not 4')
 
+    def test_incremental(self):
+        """ test incremental generation, only render when template input changes
+        :return:
+        """
+        tmpl = template.Template(target_root_directory=self.output_path, incremental=True)
+        tmpl.set_config(self.conf.get())
+        generated_filenames = tmpl.generate('OPNsense/Sample')
+        self.assertEqual(tmpl.stats['rendered'], 4, 'number of rendered files not 4')
+        self.assertEqual(tmpl.generate('OPNsense/Sample'), generated_filenames, 'generated files differ')
+        self.assertEqual(tmpl.stats['skipped'], 4, 'number of skipped files not 4')
+        # a fresh copy of the configuration, not shared with the template
+        config_data = config.Config('%s/config/config.xml' % '/'.join(__file__.split('/')[:-1])).get()
+        config_data['interfaces']['lan']['ipaddr'] = '10.0.0.1'
+        tmpl.set_config(config_data)
+        tmpl.generate('OPNsense/Sample')
+        self.assertGreater(tmpl.stats['rendered'] + tmpl.stats['unchanged'], 0, 'changed input not rendered')
+
+    def test_parallel(self):
+        """ test parallel generation from concurrent threads, each using its own template object
+        :return:
+        """
+        expected = sorted([os.path.relpath(x, self.output_path) for x in self.tmpl.generate('OPNsense/Sample*')])
+        results = dict()
+
+        def generate(idx):
+            os.mkdir('%s/%d' % (self.output_path, idx))
+            tmpl = template.Template(target_root_directory='%s/%d/' % (self.output_path, idx), workers=2)
+            tmpl.set_config(self.conf.get())
+            results[idx] = tmpl.generate('OPNsense/Sample*')
+
+        threads = [threading.Thread(target=generate, args=(idx,)) for idx in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for idx in range(3):
+            self.assertIsNotNone(results[idx], 'parallel generation failed')
+            generated = sorted([os.path.relpath(x, '%s/%d' % (self.output_path, idx)) for x in results[idx]])
+            self.assertEqual(generated, expected, 'unexpected output files')
+
     @unittest.skip("Very fragile test, only works on clean install")
     def test_all(self):
         """ Test if all expected templates are created, can only find test for static defined cases.